@@ -0,0 +1,132 @@
+"""Import time of the SieveAI entry points
+
+Every target runs in fresh interpreters, `--repeat` times, and reports the median import time measured
+inside the interpreter, the median wall time of the whole process and the heavy modules it loaded. The
+light targets, the package and the command line, must not load the pipeline or its dependencies, with
+--check the run fails when they do or when they take longer than --budget-ms.
+
+One JSON line per target is appended to the output.
+
+Examples:
+  python benchmarks/import_time.py
+  python benchmarks/import_time.py --check --budget-ms 50 --repeat 10
+"""
+
+import os as OS
+import sys as SYS
+import json as JSON
+import time as TIME
+import socket as SOCKET
+import argparse as ARGPARSE
+import platform as PLATFORM
+import statistics as STATISTICS
+import subprocess as SUBPROCESS
+import tempfile as TEMPFILE
+
+from pipeline import _ROOT, _git_commit
+
+_HEAVY = ["pandas", "numpy", "scipy", "pyarrow", "Bio", "pdbtools", "sqlalchemy", "psutil", "openbabel",
+  "UtilityLib.utility", "sieveai.exe", "sieveai.process", "sieveai.lib"]
+_PIPELINE = ["sieveai.exe", "sieveai.process", "sieveai.lib"]
+
+# name: (statements, modules which must not be loaded, None to only measure)
+_TARGETS = {
+  "import sieveai": ("import sieveai", _HEAVY),
+  "import sieveai.cli": ("import sieveai.cli", _HEAVY),
+  "sieveai -h": ("from sieveai import dock; SYS.argv = ['sieveai', '-h']; dock()", _PIPELINE),
+  "rescore -h": ("from sieveai import rescore; SYS.argv = ['rescore', '-h']; rescore()", _PIPELINE),
+  "import sieveai.exe": ("import sieveai.exe", None),
+}
+
+# Runs in the measured interpreter, the result is written to the file given as the first argument
+_PROBE = """
+import sys as SYS, json as JSON, time as TIME
+_result_path, _statements = SYS.argv[1], SYS.argv[2]
+_start = TIME.perf_counter()
+_status, _error = "ok", None
+try:
+  exec(_statements, {"SYS": SYS})
+except SystemExit as _e:
+  if _e.code not in (None, 0):
+    _status, _error = "error", f"Exited with {_e.code}."
+except ImportError as _e:
+  # CLI targets need the command line support of UtilityLib
+  _status, _error = ("skipped" if "UtilityLib" in str(_e) else "error"), repr(_e)
+except Exception as _e:
+  _status, _error = "error", repr(_e)
+_elapsed = TIME.perf_counter() - _start
+with open(_result_path, "w") as _fh:
+  JSON.dump({"status": _status, "error": _error, "import_s": _elapsed, "modules": sorted(SYS.modules.keys())}, _fh)
+"""
+
+def _run_probe(_statements, _result_path):
+  _start = TIME.perf_counter()
+  SUBPROCESS.run([SYS.executable, "-c", _PROBE, _result_path, _statements], cwd=_ROOT,
+    stdout=SUBPROCESS.DEVNULL, stderr=SUBPROCESS.DEVNULL, check=False)
+  _wall = TIME.perf_counter() - _start
+
+  with open(_result_path, "r") as _fh:
+    return _wall, JSON.load(_fh)
+
+def measure(_name, _repeat):
+  """Record of one target, heavy modules are those of any of its runs"""
+  _statements, _forbidden = _TARGETS[_name]
+  _walls, _imports, _loaded, _result = [], [], set(), {}
+  with TEMPFILE.TemporaryDirectory(prefix="sieveai-import-") as _dir:
+    for _ in range(_repeat):
+      _wall, _result = _run_probe(_statements, OS.path.join(_dir, "result.json"))
+      _walls.append(_wall)
+      _imports.append(_result["import_s"])
+      _loaded.update(_module for _module in _result["modules"] if _module.split(".")[0] in {_h.split(".")[0] for _h in _HEAVY})
+
+  _heavy = sorted(_h for _h in _HEAVY if _h in _loaded)
+  return {
+    "benchmark": "import_time",
+    "target": _name,
+    "status": _result.get("status"),
+    "error": _result.get("error"),
+    "import_ms": round(STATISTICS.median(_imports) * 1000, 2),
+    "process_ms": round(STATISTICS.median(_walls) * 1000, 2),
+    "heavy_modules": _heavy,
+    "forbidden_loaded": sorted(set(_forbidden or []).intersection(_heavy)),
+    "guarded": _forbidden is not None,
+  }
+
+def main():
+  _parser = ARGPARSE.ArgumentParser(description="Measure the import time of the SieveAI entry points.")
+  _parser.add_argument("--targets", nargs="*", default=list(_TARGETS.keys()), choices=list(_TARGETS.keys()))
+  _parser.add_argument("--repeat", type=int, default=5)
+  _parser.add_argument("--budget-ms", type=float, default=50, help="Import time allowed to the guarded targets with --check.")
+  _parser.add_argument("--check", action="store_true", help="Exit with 1 when a guarded target loads the pipeline or exceeds the budget.")
+  _parser.add_argument("--out", default=OS.path.join(_ROOT, "benchmarks", "results.jsonl"))
+  _args = _parser.parse_args()
+
+  # Interpreter start up, subtracted from the process wall times when reading the results
+  with TEMPFILE.TemporaryDirectory(prefix="sieveai-import-") as _dir:
+    _baseline = STATISTICS.median([_run_probe("pass", OS.path.join(_dir, "result.json"))[0] for _ in range(_args.repeat)])
+
+  _run = {"baseline_ms": round(_baseline * 1000, 2), "commit": _git_commit(), "python": PLATFORM.python_version(),
+    "host": SOCKET.gethostname(), "cpus": OS.cpu_count(), "started": TIME.time()}
+
+  _failed = []
+  with open(_args.out, "a") as _fh:
+    for _name in _args.targets:
+      _record = {**measure(_name, max(1, _args.repeat)), **_run}
+      _fh.write(JSON.dumps(_record) + "\n")
+
+      _over = _record["guarded"] and _record["status"] == "ok" and _record["import_ms"] > _args.budget_ms
+      if _record["status"] == "error" or _record["forbidden_loaded"] or _over:
+        _failed.append(_name)
+      print(f"{_name:<20} {_record['status']:<8} import {_record['import_ms']:>9.2f} ms process {_record['process_ms']:>9.2f} ms "
+        f"(start up {_run['baseline_ms']} ms) heavy {','.join(_record['heavy_modules']) or '-'}", file=SYS.stderr)
+      if _record["forbidden_loaded"]:
+        print(f"{'':<20} loads {', '.join(_record['forbidden_loaded'])}", file=SYS.stderr)
+
+  if _args.check and _failed:
+    print(f"Import time check failed for {', '.join(_failed)}.", file=SYS.stderr)
+    return 1
+
+  return 0
+
+if __name__ == "__main__":
+  SYS.exit(main())
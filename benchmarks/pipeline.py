@@ -0,0 +1,259 @@
+"""Benchmark of the SieveAI pipeline against stub executables
+
+Synthetic receptors and a ligand library are generated for every scale (number of complexes). Each scale
+runs in its own process with the stubs of `benchmarks/stubs` first on PATH. Every stage of
+`VinaBase.processes`, the result parsers and optionally the AnnapuRNA rescoring are timed. One JSON line
+per scale and stage is appended to the output:
+
+  wall_s, cpu_s (SieveAI itself), children_cpu_s (tools), peak_rss_mb, children_peak_rss_mb, items,
+  throughput_per_s and overhead_ms_per_item (SieveAI CPU milliseconds per item)
+
+Examples:
+  python benchmarks/pipeline.py --scales 10 100 1000
+  python benchmarks/pipeline.py --scales 1000000 --latency 0 --cores 32 --out results.jsonl
+  SIEVEAI_STUB_LATENCY_VINA=0.5 python benchmarks/pipeline.py --scales 100 --stages perform_docking
+"""
+
+import os as OS
+import sys as SYS
+import json as JSON
+import math as MATH
+import time as TIME
+import random as RANDOM
+import shutil as SHUTIL
+import socket as SOCKET
+import argparse as ARGPARSE
+import platform as PLATFORM
+import resource as RESOURCE
+import tempfile as TEMPFILE
+import threading as THREADING
+import subprocess as SUBPROCESS
+
+_ROOT = OS.path.dirname(OS.path.dirname(OS.path.abspath(__file__)))
+_STUBS = OS.path.join(_ROOT, "benchmarks", "stubs")
+_ELEMENTS = ["C", "C", "C", "C", "N", "O", "O", "S"]
+_RESIDUES = ["SER", "THR", "GLY", "ALA", "ASN", "GLN", "TYR", "HIS", "LYS", "ASP", "GLU", "LEU"]
+
+def _receptors_for(_scale):
+  return max(1, min(100, round(MATH.sqrt(_scale) / 3)))
+
+def generate_project(_path, _receptors, _ligands, _residues=40, _ligand_atoms=20, _seed=7):
+  """Receptor PDB files and one SDF library of `_ligands` molecules under `_path`"""
+  _rng = RANDOM.Random(_seed)
+  OS.makedirs(OS.path.join(_path, "receptor"), exist_ok=True)
+  OS.makedirs(OS.path.join(_path, "ligand"), exist_ok=True)
+
+  for _r in range(1, _receptors + 1):
+    with open(OS.path.join(_path, "receptor", f"rec{_r:04d}.pdb"), "w") as _fh:
+      _serial = 0
+      for _resid in range(1, _residues + 1):
+        _resname = _rng.choice(_RESIDUES)
+        for _name, _element in (("N", "N"), ("CA", "C"), ("C", "C"), ("O", "O"), ("CB", "C"), ("OG", "O")):
+          _serial += 1
+          _x, _y, _z = (_rng.uniform(-12, 12) for _ in range(3))
+          _fh.write(f"ATOM  {_serial:>5} {_name:<4} {_resname:>3} A{_resid:>4}    {_x:8.3f}{_y:8.3f}{_z:8.3f}  1.00 20.00          {_element:>2}\n")
+      _fh.write("TER\nEND\n")
+
+  # Streamed so that a million molecules never sit in memory
+  with open(OS.path.join(_path, "ligand", "library.sdf"), "w") as _fh:
+    for _l in range(1, _ligands + 1):
+      _fh.write(f"lig{_l:07d}\n  SieveAI-benchmark\n\n{_ligand_atoms:>3}{_ligand_atoms - 1:>3}  0  0  0  0  0  0  0  0999 V2000\n")
+      for _a in range(_ligand_atoms):
+        _x, _y, _z = (_rng.uniform(-4, 4) for _ in range(3))
+        _fh.write(f"{_x:10.4f}{_y:10.4f}{_z:10.4f} {_rng.choice(_ELEMENTS):<3} 0  0  0  0  0  0  0  0  0  0  0  0\n")
+      for _b in range(1, _ligand_atoms):
+        _fh.write(f"{_b:>3}{_b + 1:>3}  1  0\n")
+      _fh.write("M  END\n$$$$\n")
+
+class _PeakRSS():
+  """Samples the resident memory of this process while a stage runs"""
+  def __init__(self, _interval=0.05):
+    import psutil as PSUTIL
+    self.process = PSUTIL.Process()
+    self.interval = _interval
+    self.peak = 0
+    self.stop = THREADING.Event()
+    self.thread = THREADING.Thread(target=self.__sample, daemon=True)
+
+  def __sample(self):
+    while True:
+      self.peak = max(self.peak, self.process.memory_info().rss)
+      if self.stop.wait(self.interval):
+        break
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self.stop.set()
+    self.thread.join()
+
+def _measure(_record, _items, _function):
+  """Runs one stage and adds its timings to the record"""
+  _self, _children = RESOURCE.getrusage(RESOURCE.RUSAGE_SELF), RESOURCE.getrusage(RESOURCE.RUSAGE_CHILDREN)
+  _start = TIME.perf_counter()
+  _status, _error = "ok", None
+  with _PeakRSS() as _rss:
+    try:
+      _result = _function()
+      _items = _items(_result) if callable(_items) else _items
+    except Exception as _e:
+      _status, _error = "error", f"{type(_e).__name__}: {_e}"
+      _items = _items if isinstance(_items, int) else 0
+  _wall = TIME.perf_counter() - _start
+  _self_after, _children_after = RESOURCE.getrusage(RESOURCE.RUSAGE_SELF), RESOURCE.getrusage(RESOURCE.RUSAGE_CHILDREN)
+
+  _cpu = (_self_after.ru_utime - _self.ru_utime) + (_self_after.ru_stime - _self.ru_stime)
+  _record.update({
+    "status": _status,
+    "error": _error,
+    "items": _items,
+    "wall_s": round(_wall, 4),
+    "cpu_s": round(_cpu, 4),
+    "children_cpu_s": round((_children_after.ru_utime - _children.ru_utime) + (_children_after.ru_stime - _children.ru_stime), 4),
+    "peak_rss_mb": round(_rss.peak / 1048576, 1),
+    "children_peak_rss_mb": round(_children_after.ru_maxrss / 1024, 1),
+    "throughput_per_s": round(_items / _wall, 2) if _wall > 0 else None,
+    "overhead_ms_per_item": round(_cpu * 1000 / _items, 4) if _items else None,
+  })
+  return _record
+
+def _stage_items(_stage, _receptors, _ligands):
+  if _stage == "prepare_ligand":
+    return _ligands
+  if _stage in ("prepare_receptor", "prepare_grid", "prepare_maps"):
+    return _receptors
+  return _receptors * _ligands
+
+def run_scale(_settings):
+  """Runs all stages of one scale in this process, returns the records"""
+  SYS.path.insert(0, _ROOT)
+  from sieveai.exe import Vina, AnnapuRNA
+
+  _scale = int(_settings["scale"])
+  _receptors = int(_settings.get("receptors") or _receptors_for(_scale))
+  _ligands = max(1, MATH.ceil(_scale / _receptors))
+  _project = OS.path.join(_settings["workdir"], f"scale-{_scale}")
+  generate_project(_project, _receptors, _ligands)
+
+  _options = {
+    "multiprocess": True,
+    "scheduler_cores": _settings.get("cores"),
+    "analysis_backend": _settings.get("analysis_backend", "chimerax"),
+    "vina_batch_size": int(_settings.get("vina_batch_size") or 0),
+    "vina_maps": bool(_settings.get("vina_maps")),
+    "chimerax_workers": int(_settings.get("chimerax_workers") or 1),
+    "debug": 0,
+  }
+  _vina = Vina(path_base=[_project], **_options)
+  _vina.add(path_base=_project, **_options)
+
+  _base = {
+    "benchmark": "pipeline",
+    "scale": _scale,
+    "receptors": _receptors,
+    "ligands": _ligands,
+    "complexes": _receptors * _ligands,
+    "latency": {_k: _v for _k, _v in OS.environ.items() if _k.startswith("SIEVEAI_STUB_")},
+    "options": _options,
+  }
+
+  _records = []
+  _stages = _settings.get("stages") or list(_vina.processes)
+  for _stage in [_s for _s in _vina.processes if _s in _stages]:
+    _records.append(_measure({**_base, "stage": _stage}, _stage_items(_stage, _receptors, _ligands), getattr(_vina, _stage)))
+
+  if "parse_logs" in _stages:
+    _analysis = OS.path.join(_project, _vina.dir_analysis)
+    _names = sorted(_vina.archive_names(_analysis, f".{_vina.ext__hbonds}") | {_f[:-len(_vina.ext__hbonds) - 1] for _f in (OS.listdir(_analysis) if OS.path.isdir(_analysis) else []) if _f.endswith(_vina.ext__hbonds)})
+    for _kind, _ext in (("contacts", _vina.ext__contacts), ("hbonds", _vina.ext__hbonds)):
+      _paths = [OS.path.join(_analysis, f"{_name}.{_ext}") for _name in _names]
+      _records.append(_measure({**_base, "stage": f"parse_logs:{_kind}"}, len(_paths), lambda _paths=_paths, _kind=_kind: _vina.chimerax_parse_logs(_paths, _kind)))
+
+  if "read_scores" in _stages:
+    _docking = OS.path.join(_project, _vina.dir_docking)
+    _results = sorted(_f for _f in OS.listdir(_docking) if _f.endswith(_vina.ext__dock_result)) if OS.path.isdir(_docking) else []
+    _records.append(_measure({**_base, "stage": "read_scores"}, len(_results),
+      lambda: [_vina.read_vina_scores(OS.path.join(_docking, _f), OS.path.join(_docking, _f.replace(_vina.ext__dock_result, _vina.ext__dock_log))) for _f in _results]))
+
+  if "rescoring" in _stages:
+    _annapurna = AnnapuRNA(path_base=[_project], **_options)
+    _annapurna.add(path_base=_project, annapurna_path=OS.path.join(_STUBS, "annapurna.py"), annapurna_env=None,
+      annapurna_workers=int(_settings.get("annapurna_workers") or 1), **_options)
+    _records.append(_measure({**_base, "stage": "rescoring"}, _receptors * _ligands, _annapurna.rescoring_AnnapuRNA))
+
+  return _records
+
+def _git_commit():
+  try:
+    return SUBPROCESS.run(["git", "-C", _ROOT, "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10).stdout.strip() or None
+  except OSError:
+    return None
+
+def main():
+  _parser = ARGPARSE.ArgumentParser(description="Benchmark SieveAI stages against stub executables.")
+  _parser.add_argument("--scales", type=int, nargs="+", default=[10, 100, 1000], help="Numbers of complexes, up to 1000000.")
+  _parser.add_argument("--receptors", type=int, default=None, help="Receptors per scale, about sqrt(scale)/3 by default.")
+  _parser.add_argument("--stages", nargs="*", default=None, help="Stages of VinaBase.processes and parse_logs, read_scores, rescoring. All but rescoring by default.")
+  _parser.add_argument("--latency", type=float, default=None, help="Seconds of every stub call, SIEVEAI_STUB_LATENCY_<TOOL> overrides per tool.")
+  _parser.add_argument("--poses", type=int, default=None, help="Poses written by the vina stub per complex, 9 by default.")
+  _parser.add_argument("--cores", type=int, default=None)
+  _parser.add_argument("--analysis-backend", default="chimerax", choices=["chimerax", "numpy"])
+  _parser.add_argument("--vina-batch-size", type=int, default=0)
+  _parser.add_argument("--vina-maps", action="store_true")
+  _parser.add_argument("--chimerax-workers", type=int, default=1)
+  _parser.add_argument("--annapurna-workers", type=int, default=1)
+  _parser.add_argument("--workdir", default=None, help="Directory of the generated projects, a temporary one by default.")
+  _parser.add_argument("--keep", action="store_true", help="Keep the generated projects.")
+  _parser.add_argument("--out", default=OS.path.join(_ROOT, "benchmarks", "results.jsonl"))
+  _parser.add_argument("--run-scale", default=None, help=ARGPARSE.SUPPRESS)
+  _args = _parser.parse_args()
+
+  if _args.run_scale:
+    for _record in run_scale(JSON.loads(_args.run_scale)):
+      print(JSON.dumps(_record), flush=True)
+    return 0
+
+  _env = dict(OS.environ)
+  _env["PATH"] = f"{_STUBS}{OS.pathsep}{_env.get('PATH', '')}"
+  if _args.latency is not None:
+    _env["SIEVEAI_STUB_LATENCY"] = str(_args.latency)
+  if _args.poses is not None:
+    _env["SIEVEAI_STUB_POSES"] = str(_args.poses)
+
+  _workdir = _args.workdir or TEMPFILE.mkdtemp(prefix="sieveai-benchmark-")
+  _run = {"commit": _git_commit(), "python": PLATFORM.python_version(), "host": SOCKET.gethostname(), "cpus": OS.cpu_count(), "started": TIME.time()}
+  _stages = _args.stages or None
+
+  _failed = 0
+  try:
+    for _scale in _args.scales:
+      _settings = {"scale": _scale, "receptors": _args.receptors, "stages": _stages, "cores": _args.cores, "workdir": _workdir,
+        "analysis_backend": _args.analysis_backend, "vina_batch_size": _args.vina_batch_size, "vina_maps": _args.vina_maps,
+        "chimerax_workers": _args.chimerax_workers, "annapurna_workers": _args.annapurna_workers}
+
+      # A process per scale keeps peak memory of one scale apart from the others
+      _process = SUBPROCESS.run([SYS.executable, OS.path.abspath(__file__), "--run-scale", JSON.dumps(_settings)],
+        env=_env, cwd=_workdir, stdout=SUBPROCESS.PIPE, text=True)
+
+      _records = [JSON.loads(_line) for _line in _process.stdout.splitlines() if _line.startswith("{")]
+      if _process.returncode != 0:
+        _failed += 1
+        _records.append({"benchmark": "pipeline", "scale": _scale, "stage": None, "status": "error", "error": f"Exited with {_process.returncode}."})
+
+      with open(_args.out, "a") as _fh:
+        for _record in _records:
+          _record.update(_run)
+          _fh.write(JSON.dumps(_record) + "\n")
+          _failed += _record.get("status") != "ok"
+          print(f"{_scale:>8} {str(_record.get('stage')):<24} {_record.get('status'):<6} wall {_record.get('wall_s')}s "
+            f"items/s {_record.get('throughput_per_s')} overhead {_record.get('overhead_ms_per_item')} ms/item peak {_record.get('peak_rss_mb')} MB", file=SYS.stderr)
+  finally:
+    if not _args.keep and not _args.workdir:
+      SHUTIL.rmtree(_workdir, ignore_errors=True)
+
+  return 1 if _failed else 0
+
+if __name__ == "__main__":
+  SYS.exit(main())
@@ -0,0 +1,71 @@
+"""Helpers shared by the stub executables of the benchmarks
+
+Latency is read from SIEVEAI_STUB_LATENCY_<TOOL> or SIEVEAI_STUB_LATENCY in seconds, per molecule, complex
+or command depending on the tool. Outputs are deterministic for a given input name.
+"""
+
+import os as OS
+import time as TIME
+import zlib as ZLIB
+import random as RANDOM
+
+def latency(_tool):
+  _seconds = float(OS.environ.get(f"SIEVEAI_STUB_LATENCY_{_tool.upper()}", OS.environ.get("SIEVEAI_STUB_LATENCY", "0")) or 0)
+  if _seconds > 0:
+    TIME.sleep(_seconds)
+
+def rng(_name):
+  return RANDOM.Random(ZLIB.crc32(str(_name).encode("utf8")))
+
+def split_molecules(_text, _format):
+  """Molecule records of a multi-molecule text in sdf, mol2, pdb or pdbqt"""
+  if _format in ("sdf", "mol"):
+    return [_r + "$$$$\n" for _r in _text.split("$$$$\n") if _r.strip()]
+
+  if _format == "mol2":
+    return ["@<TRIPOS>MOLECULE" + _r for _r in _text.split("@<TRIPOS>MOLECULE") if _r.strip()]
+
+  _records, _current = [], []
+  for _line in _text.splitlines(True):
+    _current.append(_line)
+    if _line.startswith(("END", "ENDMDL")) and not _line.startswith(("ENDROOT", "ENDBRANCH")):
+      if any(_l.startswith(("ATOM", "HETATM")) for _l in _current):
+        _records.append("".join(_current))
+      _current = []
+  if any(_l.startswith(("ATOM", "HETATM")) for _l in _current):
+    _records.append("".join(_current))
+  return _records
+
+def atoms(_record, _format):
+  """(name, element, x, y, z) of the atoms of one molecule record"""
+  _atoms = []
+  _lines = _record.splitlines()
+  if _format in ("sdf", "mol"):
+    _count = int(_lines[3][:3]) if len(_lines) > 3 and _lines[3][:3].strip().isdigit() else 0
+    for _line in _lines[4:4 + _count]:
+      _fields = _line.split()
+      _atoms.append((f"{_fields[3]}{len(_atoms) + 1}", _fields[3], float(_fields[0]), float(_fields[1]), float(_fields[2])))
+  elif _format == "mol2":
+    _in_atoms = False
+    for _line in _lines:
+      if _line.startswith("@<TRIPOS>"):
+        _in_atoms = _line.startswith("@<TRIPOS>ATOM")
+      elif _in_atoms and _line.strip():
+        _fields = _line.split()
+        _atoms.append((_fields[1], _fields[5].split(".")[0], float(_fields[2]), float(_fields[3]), float(_fields[4])))
+  else:
+    for _line in _lines:
+      if _line.startswith(("ATOM", "HETATM")):
+        _name = _line[12:16].strip()
+        _element = _line[76:78].strip() if len(_line) > 77 and _line[76:78].strip() and not _line[77:79].strip().replace(".", "").isdigit() else _name[:1]
+        _atoms.append((_name, _element, float(_line[30:38]), float(_line[38:46]), float(_line[46:54])))
+  return _atoms
+
+def pdbqt_lines(_atoms, _record="HETATM", _resname="UNL", _chain="", _resids=None, _shift=(0.0, 0.0, 0.0)):
+  _lines = []
+  for _i, (_name, _element, _x, _y, _z) in enumerate(_atoms, start=1):
+    _resid = _resids[_i - 1] if _resids else 1
+    _res = _resname[_i - 1] if isinstance(_resname, list) else _resname
+    _lines.append(f"{_record:<6}{_i:>5} {_name[:4]:<4} {_res:>3} {_chain[:1] or ' '}{_resid:>4}    "
+      f"{_x + _shift[0]:8.3f}{_y + _shift[1]:8.3f}{_z + _shift[2]:8.3f}  1.00  0.00    {0.0:6.3f} {_element[:2]:<2}\n")
+  return _lines
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""Stub of annapurna.py writing one tab separated score table per model for the poses of a result PDBQT"""
+import os, sys, argparse
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import _stub
+
+def main():
+  _parser = argparse.ArgumentParser()
+  _parser.add_argument("-r", required=True)
+  _parser.add_argument("-l", required=True)
+  _parser.add_argument("-m", action="append", default=[])
+  _parser.add_argument("-o", required=True)
+  _parser.add_argument("-s", action="store_true")
+  _parser.add_argument("--overwrite", action="store_true")
+  _args = _parser.parse_args()
+
+  _stub.latency("annapurna")
+  with open(_args.l) as _fh:
+    _poses = len(_stub.split_molecules(_fh.read(), "pdbqt"))
+
+  _rng = _stub.rng(_args.l)
+  for _model in _args.m:
+    with open(f"{_args.o}.{_model}.csv", "w") as _fh:
+      _fh.write("\t".join(["model", "name", "interaction_model", "interaction_unit", "score_RNA-Ligand", "E_ligand", "score_ligand", "score"]) + "\n")
+      for _pose in range(1, _poses + 1):
+        _rna_ligand, _ligand = _rng.uniform(-300, -50), _rng.uniform(-20, 5)
+        _fh.write("\t".join(map(str, [_pose, os.path.basename(_args.l), 0, 0, round(_rna_ligand, 3), round(_ligand, 3), round(_ligand, 3), round(_rna_ligand + _ligand, 3)])) + "\n")
+
+if __name__ == "__main__":
+  main()
@@ -5,10 +5,31 @@ __author__ = "Vishal Kumar Sahu"
 __url__ = "https://github.com/VishalKumarSahu/SieveAI"
 __email__ = "mail@vishalkumarsahu.in"
 
-from .exe import Vina
-from .process import Docking
-from .cli import dock, rescore
-from .lib import ChimeraX, MolConverter, OpenBabel
+# Executables and processes load pandas and UtilityLib, they are imported on first access so that the
+# command line and other light users start without them
+_LAZY_ATTRIBUTES = {
+  "Vina": ".exe",
+  "AnnapuRNA": ".exe",
+  "Docking": ".process",
+  "Rescoring": ".process",
+  "dock": ".cli",
+  "rescore": ".cli",
+  "ChimeraX": ".lib",
+  "MolConverter": ".lib",
+  "OpenBabel": ".lib",
+}
+
+def __getattr__(_name):
+  if _name not in _LAZY_ATTRIBUTES:
+    raise AttributeError(f"module {__name__!r} has no attribute {_name!r}")
+
+  import importlib as IMPORTLIB
+  _value = getattr(IMPORTLIB.import_module(_LAZY_ATTRIBUTES[_name], __name__), _name)
+  globals()[_name] = _value
+  return _value
+
+def __dir__():
+  return sorted(set(globals().keys()).union(_LAZY_ATTRIBUTES.keys()))
 
 __all__ = ["__program__", "__description__", "__build__", "__author__", "__url__", "__email__"]
 
@@ -1,6 +1,7 @@
 def process_args():
+  """Parses the command line before any executable is imported, -h and -v never load the pipeline"""
   import os as OS
-  from sieveai import __program__, __build__
+  from . import __program__, __build__
   from UtilityLib import CommandUtility
 
   # key: (['arg_k1', 'arg_k2'], nargs, default, help, {})
@@ -14,8 +15,31 @@ def process_args():
     "ext_receptor": (['-er'], "*", ["*.pdb"], 'Pattern(s) for extension of receptor files.', {}),
     "path_ligand": (['-l'], None, None, 'Specify path of directory containing ligands.', {}),
     "dir_ligand": (['-dl'], None, "ligand", 'Specify name of the directory containing ligand PDB structures under base directory.', {}),
-    "ext_ligand": (['-el'], "*", ["*.pdb", "*.sdf", "*.mol2"], 'Pattern(s) for extension of ligand files.', {}),
+    "ext_ligand": (['-el'], "*", ["*.pdb", "*.sdf", "*.mol2"], 'Pattern(s) for extension of ligand files, gzipped libraries of these are also read.', {}),
+    "receptor_workers": (['-rw'], None, None, 'Number of receptors prepared in parallel, all cores by default.', {}),
+    "grid_residues": (['-gr'], "*", [], 'Residues to build the docking box around, e.g. 45 A:45 HIS. Whole receptor by default.', {}),
     "multiprocess": (['-m'], None, False, 'Multiprocessing of the complexes.', {}),
+    "vina_maps": (['-maps'], None, False, 'Precompute affinity maps per receptor and dock against them.', {}),
+    "vina_batch_size": (['-vb'], None, 0, 'Ligands docked per Vina process with --batch, 0 for one process per complex.', {}),
+    "scheduler_cores": (['-c'], None, None, 'Number of cores available for docking jobs, all cores by default.', {}),
+    "scheduler_cpu_max": (['-cj'], None, 4, 'Most cores given to one docking job, jobs run alone with -m off get all cores.', {}),
+    "processes": (['-p'], "*", None, 'Stages to run, e.g. perform_docking. All by default, perform_docking alone for queue workers.', {}),
+    "queue_enabled": (['-queue'], None, False, 'Queue the complexes of the project and dock them together with the queue workers on other nodes.', {}),
+    "queue_worker": (['-qw'], None, False, 'Join the work queue of a project submitted by another node with -queue, only docking is run.', {}),
+    "ledger_journal_mode": (['-jm'], None, None, 'SQLite journal mode of the project database, WAL by default and DELETE with -queue.', {}),
+    "project_workers": (['-pj'], None, None, 'Number of base directories processed at once sharing the cores, all by default.', {}),
+    "chimerax_workers": (['-cx'], None, 1, 'Number of persistent ChimeraX sessions for analysis, 0 to launch ChimeraX per complex.', {}),
+    "chimerax_parse_workers": (['-pw'], None, None, 'Number of processes parsing ChimeraX results, all cores by default.', {}),
+    "archive_workers": (['-aw'], None, None, 'Number of threads compressing archive shards during cleanup, all cores by default.', {}),
+    "annapurna_workers": (['-anw'], None, 1, 'Number of persistent AnnapuRNA workers, 0 to launch AnnapuRNA per complex.', {}),
+    "annapurna_env": (['-ane'], None, "annapurna", 'Conda environment of AnnapuRNA.', {}),
+    "analysis_backend": (['-ab'], None, "chimerax", 'Pose analysis backend chimerax|numpy.', {}),
+    "openbabel_batch_size": (['-obb'], None, 100, 'Number of molecules converted per OpenBabel invocation.', {}),
+    "openbabel_workers": (['-obw'], None, None, 'Number of parallel OpenBabel conversions, all cores by default.', {}),
+    "sink_format": (['-sf'], None, None, 'Format of the result tables parquet|csv, parquet when pyarrow is installed.', {}),
+    "cache_dir": (['-cache'], None, None, 'Directory of the artifact cache shared between projects, disabled by default.', {}),
+    "metrics_profile": (['-prof'], None, None, 'Profile every stage with cprofile|tracemalloc, reports are written under profiles.', {}),
+    "metrics_textfile_dir": (['-mtd'], None, None, 'Textfile collector directory of node_exporter for the Prometheus metrics, base directory by default.', {}),
     "mode": ([], None, "prod", 'Other options prod|dev|test.', {}),
     # "action": (['-a'], None, 'docking', 'Action to perform among docking|rescoring|web.', {}),
   }
@@ -29,14 +53,14 @@ def process_args():
 
 def dock():
   _args = process_args()
-  from . import Docking
+  from .process import Docking
   _process = Docking(**_args)
   print(f"Initalizing Docking...")
   _process.process()
 
 def rescore():
   _args = process_args()
-  from . import Rescoring
+  from .process import Rescoring
   _process = Rescoring(**_args)
   print(f"Initalizing Rescoring...")
   _process.process()
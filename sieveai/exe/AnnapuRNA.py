@@ -1,6 +1,22 @@
 from .VinaBase import VinaBase
 import pandas as PD
 import os as OS
+import sys as SYS
+import json as JSON
+import shlex as SHLEX
+import queue as QUEUE
+import select as SELECT
+import threading as THREADING
+import subprocess as SUBPROCESS
+from concurrent.futures import ThreadPoolExecutor
+
+_ANNAPURNA_COLUMNS = ["im", "iu", "score_RNA-Ligand", "E_ligand", "score_ligand", "score"]
+
+def _annapurna_read_model(_file_path):
+  """Rows of a tab separated AnnapuRNA model output as (conformer id, values...), header skipped"""
+  with open(_file_path, "r", encoding="utf8", errors="replace") as _fh:
+    next(_fh, None)
+    return [_fields for _fields in (_line.rstrip("\r\n").split("\t") for _line in _fh) if len(_fields) >= 8]
 
 class AnnapuRNA(VinaBase):
   def __init__(self, *args, **kwargs):
@@ -16,6 +32,13 @@ class AnnapuRNA(VinaBase):
             # 'kNN_basic',
             'kNN_modern',
           ],
+      "annapurna_env": "annapurna", # Conda environment of AnnapuRNA, None to use the current interpreter
+      "annapurna_entry": "main", # Function of annapurna.py called per complex by the workers, a script without it is run again per complex
+      "annapurna_workers": 1, # Persistent AnnapuRNA processes, 0 to launch AnnapuRNA per complex
+      "annapurna_startup_timeout": 600,
+      "annapurna_timeout": 3600, # Seconds per complex
+      "annapurna_merge_batch": 10000, # Complexes merged per part of the annapurna table
+      "annapurna_merge_workers": None, # Threads reading model outputs, all cores by default
     }
 
     # Set all defaults
@@ -24,13 +47,13 @@ class AnnapuRNA(VinaBase):
     [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
 
   def __read_results_df(self, *args, **kwargs):
-    _score_file_path = f"{self.path_base}{OS.sep}{self.file__result_score}"
+    _table = "interactions" if self.sink_exists("interactions") else "scores"
 
-    if not self.utility.check_path(_score_file_path):
-      _error = "Results Files Does Not Exist for Processing ChimeraX Results. Skipping..."
+    if not self.sink_exists(_table):
+      _error = "Results Table Does Not Exist for Processing ChimeraX Results. Skipping..."
       return _error
 
-    _results = PD.read_csv(_score_file_path)
+    _results = self.read_result_table(_table)
     _results["complex_id"] = _results['receptor'] + "--" + _results['ligand']
     _results["complex_uid"] = _results['complex_id'] + "--" + _results['conformer_id'].astype(str)
 
@@ -39,60 +62,233 @@ class AnnapuRNA(VinaBase):
 
     return _results
 
-  def annapurna_merge_rescoring(self, *args, **kwargs):
-    kwargs["_drop_conformers"] = False
-    _results = self.__read_results_df(*args, **kwargs)
-    _all_results = PD.DataFrame()
+  def __annapurna_merge_batch(self, _complex_ids):
+    """Reads the model outputs of complexes in parallel and pivots them to one row per complex_uid
 
-    _score_file_path = f"{self.path_base}{OS.sep}{self.file__result_score}"
-    self.utility.log_info(f"Processing {_results.shape}.")
+    Returns the rows and the complexes having at least one model output.
+    """
+    _paths = [(_complex_id, _am, f"{self.dir_rescoring}/{_complex_id}/{_complex_id}.{_am}.csv") for _complex_id in _complex_ids for _am in self.annapurna_models]
+    _missing = [_path for _complex_id, _am, _path in _paths if not OS.path.isfile(_path)]
+    _paths = [_p for _p in _paths if OS.path.isfile(_p[2])]
 
-    for _complex_id in self.utility.ProgressBar(_results['complex_id'].unique()):
-      _ap_complex_res_merged = PD.DataFrame()
-      for _am in self.annapurna_models:
-        _model_res_df = PD.DataFrame()
-        _updated_cols = ["conformer_id", "complex_id", f"{_am}__im", f"{_am}__iu", f"{_am}__score_RNA-Ligand",f"{_am}__E_ligand", f"{_am}__score_ligand", f"{_am}__score"]
-        _m_res_f = f"{self.dir_rescoring}/{_complex_id}/{_complex_id}.{_am}.csv"
+    if _missing:
+      self.utility.log_error(f"{len(_missing)} AnnapuRNA output(s) don't exist: {', '.join(_missing[:5])}")
 
-        if self.utility.check_path(_m_res_f):
-          _model_res_df = PD.read_csv(_m_res_f, sep="\t")
-          _model_res_df.columns = _updated_cols
-          _model_res_df['complex_id'] = _model_res_df.apply(lambda row: self.utility.file_name(row['complex_id'], num_ext = 2), axis=1)
+    _columns = {"complex_uid": [], "model": [], **{_col: [] for _col in _ANNAPURNA_COLUMNS}}
+    _workers = max(1, int(self.annapurna_merge_workers or OS.cpu_count() or 1))
+    with ThreadPoolExecutor(max_workers=_workers) as _executor:
+      for (_complex_id, _am, _path), _rows in zip(_paths, _executor.map(_annapurna_read_model, [_p[2] for _p in _paths])):
+        _columns["complex_uid"].extend(f"{_complex_id}--{_row[0].strip()}" for _row in _rows)
+        _columns["model"].extend([_am] * len(_rows))
+        for _i, _col in enumerate(_ANNAPURNA_COLUMNS, start=2):
+          _columns[_col].extend(_row[_i] for _row in _rows)
 
-          _model_res_df["complex_uid"] = _model_res_df['complex_id'] + "--" + _model_res_df['conformer_id'].astype(str)
-          _model_res_df = _model_res_df.drop(["conformer_id", "complex_id"], axis=1)
+    _found = list(dict.fromkeys(_p[0] for _p in _paths))
+    _long = PD.DataFrame(_columns)
+    if not _long.shape[0]:
+      return _long, _found
 
-          if _ap_complex_res_merged.empty:
-            _ap_complex_res_merged = _model_res_df.copy()
-          else:
-            _ap_complex_res_merged = PD.merge(_ap_complex_res_merged.set_index("complex_uid"), _model_res_df, how="outer", on="complex_uid")
-        else:
-          self.utility.log_error(f"{_m_res_f} file doesn't exist.")
+    for _col in _ANNAPURNA_COLUMNS:
+      _long[_col] = PD.to_numeric(_long[_col], errors="coerce")
 
-      if _all_results.empty:
-        _all_results = _ap_complex_res_merged.copy()
-      else:
-        _all_results = PD.concat([_all_results, _ap_complex_res_merged])
+    # All models in one pivot instead of merging model by model
+    _wide = _long.drop_duplicates(subset=["complex_uid", "model"], keep="last").set_index(["complex_uid", "model"]).unstack("model")
+    _wide.columns = [f"{_am}__{_col}" for _col, _am in _wide.columns]
+    _ordered = [f"{_am}__{_col}" for _am in self.annapurna_models for _col in _ANNAPURNA_COLUMNS]
+    return _wide[[_col for _col in _ordered if _col in _wide.columns]].reset_index(), _found
 
-      self.utility.log_info(f"Merge processed {_complex_id}.")
+  def annapurna_merge_rescoring(self, *args, **kwargs):
+    kwargs["_drop_conformers"] = False
+    _results = self.__read_results_df(*args, **kwargs)
+    _merged = self.ledger_items("merge_annapurna", "done")
 
-    _drop_columns = set(_results.columns).intersection(set(_all_results.columns))
+    _score_file_path = f"{self.path_base}{OS.sep}{self.file__result_score}"
+    self.utility.log_info(f"Processing {_results.shape}.")
+
+    _pending = [_complex_id for _complex_id in _results['complex_id'].unique() if _complex_id not in _merged]
+    _batch = max(1, int(self.annapurna_merge_batch))
+    for _start in self.utility.ProgressBar(range(0, len(_pending), _batch)):
+      _complex_ids = _pending[_start:_start + _batch]
+      _rows, _found = self.__annapurna_merge_batch(_complex_ids)
+      self.sink_append("annapurna", _rows)
+      self.ledger_mark("merge_annapurna", _found, "done")
+      self.utility.log_info(f"Merge processed {_start + len(_complex_ids)}/{len(_pending)} complexes.")
 
+    _all_results = self.sink_read("annapurna")
     if "complex_uid" in _all_results.columns:
+      _all_results = _all_results.drop_duplicates(subset="complex_uid", keep="last")
+      _drop_columns = set(_results.columns).intersection(set(_all_results.columns))
       _drop_columns.remove("complex_uid")
 
       if len(_drop_columns):
         _results = _results.drop(list(_drop_columns), axis = 1)
 
       _results = PD.merge(_results.set_index("complex_uid"), _all_results, how="outer", on="complex_uid")
-      _results.to_csv(_score_file_path, index=False)
+      self.sink_export_csv([_results], _score_file_path)
+
+    self.utility.log_info(f"Processed and Merged {_results.shape} to {_score_file_path}. Took {self.metrics_elapsed()}")
+
+  def __annapurna_outputs(self, _complex_id):
+    return [f"{self.dir_rescoring}/{_complex_id}/{_complex_id}.{_am}.csv" for _am in self.annapurna_models]
+
+  def annapurna_python(self):
+    """Python interpreter of AnnapuRNA, in the conda environment unless annapurna_env is None"""
+    return ["conda", "run", "-n", self.annapurna_env, "--no-capture-output", "python"] if self.annapurna_env else [SYS.executable]
+
+  def annapurna_worker_command(self):
+    """Command starting one persistent worker"""
+    _worker = OS.path.join(OS.path.dirname(OS.path.abspath(__file__)), "annapurna_worker.py")
+    return [*self.annapurna_python(), "-u", _worker, OS.path.expanduser(self.annapurna_path), self.annapurna_entry]
+
+  def annapurna_worker_start(self, *args, **kwargs):
+    """Starts a worker and waits until AnnapuRNA is loaded, its stderr goes to a log file in the rescoring directory"""
+    _index = args[0] if len(args) > 0 else kwargs.get("index", 0)
+
+    _log = open(f"{self.dir_rescoring}{OS.sep}.worker-{_index}.log", "ab")
+    _process = SUBPROCESS.Popen(self.annapurna_worker_command(), stdin=SUBPROCESS.PIPE, stdout=SUBPROCESS.PIPE, stderr=_log, text=True, encoding="utf8")
+    _worker = {"process": _process, "log": _log}
+
+    try:
+      _ready = self.__annapurna_receive(_worker, float(self.annapurna_startup_timeout))
+    except OSError as _e:
+      _ready = {"ready": False, "message": str(_e)}
+
+    if not _ready.get("ready"):
+      self.annapurna_worker_stop(_worker)
+      raise OSError(f"AnnapuRNA worker could not be started: {_ready.get('message')}")
+
+    return _worker
 
-    self.utility.log_info(f"Processed and Merged {_results.shape} to {_score_file_path}. Took {self.utility.time_elapsed()}")
+  def annapurna_worker_stop(self, *args, **kwargs):
+    _worker = args[0] if len(args) > 0 else kwargs.get("worker")
+    _process = _worker["process"]
+
+    try:
+      _process.stdin.close()
+      _process.wait(timeout=30)
+    except (OSError, SUBPROCESS.TimeoutExpired):
+      _process.kill()
+      _process.wait()
+
+    _worker["log"].close()
+
+  def __annapurna_receive(self, _worker, _timeout):
+    _stdout = _worker["process"].stdout
+    _readable, _, _ = SELECT.select([_stdout], [], [], _timeout)
+    if not _readable:
+      raise OSError(f"No response within {_timeout} seconds")
+
+    _line = _stdout.readline()
+    if not _line:
+      raise OSError("Worker exited unexpectedly")
+
+    return JSON.loads(_line)
+
+  def annapurna_worker_run(self, *args, **kwargs):
+    """Rescores one complex with a worker, returns the response of the worker"""
+    _worker = args[0] if len(args) > 0 else kwargs.get("worker")
+    _complex_id = args[1] if len(args) > 1 else kwargs.get("complex_id")
+    _receptor = args[2] if len(args) > 2 else kwargs.get("receptor")
+
+    _argv = ["-r", f"{self.path_receptor_pdbqt}/{_receptor}.pdbqt", "-l", f"{self.path_docking}/{_complex_id}.result.pdbqt"]
+    for _m in self.annapurna_models:
+      _argv.extend(["-m", _m])
+    _argv.extend(["-o", f"{self.dir_rescoring}/{_complex_id}/{_complex_id}", "-s", "--overwrite"])
+
+    _worker["process"].stdin.write(JSON.dumps({"id": _complex_id, "argv": _argv}) + "\n")
+    _worker["process"].stdin.flush()
+    return self.__annapurna_receive(_worker, float(self.annapurna_timeout))
+
+  def __annapurna_pool_worker(self, _index, _queue, _progress):
+    # Every worker holds one core of the budget shared with other projects
+    with self.scheduler_reserve(1):
+      _worker = None
+      try:
+        while True:
+          try:
+            _complex_id, _receptor = _queue.get_nowait()
+          except QUEUE.Empty:
+            break
+
+          # Left failed instead of running when the worker is interrupted
+          _status, _message, _duration = "failed", "interrupted", None
+          self.ledger_mark("rescoring_annapurna", _complex_id, "running")
+          try:
+            OS.makedirs(f"{self.dir_rescoring}/{_complex_id}", exist_ok=True)
+            for _attempt in range(2):
+              try:
+                if _worker is None:
+                  _worker = self.annapurna_worker_start(_index)
+                _response = self.annapurna_worker_run(_worker, _complex_id, _receptor)
+                _status, _message, _duration = _response.get("status", "failed"), _response.get("message"), _response.get("duration")
+                break
+              except OSError as _e:
+                # A crashed or hung worker is replaced and the complex is tried once more
+                _message = str(_e)
+                self.utility.log_error(f"AnnapuRNA worker {_index} failed for {_complex_id}: {_e}. Restarting worker...")
+                if _worker is not None:
+                  self.annapurna_worker_stop(_worker)
+                _worker = None
+              except Exception as _e:
+                # Not a crash, the complex would fail the same way again. The worker may be out of step and is replaced.
+                _message = f"{type(_e).__name__}: {_e}"
+                self.utility.log_error(f"AnnapuRNA rescoring failed for {_complex_id}: {_message}")
+                if _worker is not None:
+                  self.annapurna_worker_stop(_worker)
+                _worker = None
+                break
+
+            if _status == "done" and not all(OS.path.isfile(_f) for _f in self.__annapurna_outputs(_complex_id)):
+              _status, _message = "failed", "AnnapuRNA did not write all model outputs."
+          finally:
+            self.ledger_mark("rescoring_annapurna", _complex_id, _status, duration=_duration, message=_message)
+
+          with _progress["lock"]:
+            _progress["done"] += 1
+            self.utility.log_info(f"Rescoring processed {_complex_id} ({_status}) %i/%i." % (_progress["done"], _progress["total"]))
+            self.metrics_progress("rescoring_annapurna", _progress["done"], _progress["total"])
+            self.metrics_set("sieveai_queue_items", _queue.qsize(), labels={"stage": "rescoring_annapurna", "status": "pending"})
+      finally:
+        if _worker is not None:
+          self.annapurna_worker_stop(_worker)
+
+  def __rescoring_pool(self, _results):
+    """Streams pending complexes through persistent AnnapuRNA workers, complexes done in the ledger are skipped"""
+    _done = self.ledger_items("rescoring_annapurna", "done")
+    _adopted = []
+    _queue = QUEUE.Queue()
+    for _complex_id, _receptor in zip(_results['complex_id'], _results['receptor']):
+      if _complex_id in _done:
+        continue
+      if all(OS.path.isfile(_f) for _f in self.__annapurna_outputs(_complex_id)):
+        _adopted.append(_complex_id)
+        continue
+      _queue.put((_complex_id, _receptor))
+
+    if _adopted:
+      self.ledger_mark("rescoring_annapurna", _adopted, "done", message="adopted")
+
+    _workers = min(int(self.annapurna_workers), _queue.qsize())
+    self.utility.log_info(f"{_queue.qsize()} complex(es) to be rescored by {_workers} AnnapuRNA worker(s), {len(_done) + len(_adopted)} already rescored.")
+    if not _workers:
+      return
+
+    _progress = {"lock": THREADING.Lock(), "done": 0, "total": _queue.qsize()}
+    with ThreadPoolExecutor(max_workers=_workers) as _executor:
+      _futures = [_executor.submit(self.__annapurna_pool_worker, _index, _queue, _progress) for _index in range(_workers)]
+      for _future in _futures:
+        _future.result()
+
+    _counts = self.ledger_count("rescoring_annapurna")
+    self.utility.log_info(f"AnnapuRNA rescoring: {_counts.get('done', 0)} done, {_counts.get('failed', 0)} failed.")
 
   def rescoring_AnnapuRNA(self, *args, **kwargs):
     self.__update_attr(**kwargs)
-    self.utility.time_start()
+    with self.metrics_stage("rescoring_AnnapuRNA") as _stage:
+      self.__rescoring_AnnapuRNA(*args, **kwargs)
+    self.utility.log_info(f"Completed rescoring_AnnapuRNA in {_stage['wall']:.2f}s, {_stage['cpu']:.2f}s CPU.")
 
+  def __rescoring_AnnapuRNA(self, *args, **kwargs):
     kwargs["_drop_conformers"] = True
     _results = self.__read_results_df(*args, **kwargs)
 
@@ -105,6 +301,13 @@ class AnnapuRNA(VinaBase):
     self.path_receptor_pdbqt = f"{self.path_base}/{self.dir_receptor_pdbqt}"
     self.path_docking = f"{self.path_base}/{self.dir_docking}"
 
+    if int(self.annapurna_workers or 0) > 0:
+      self.__rescoring_pool(_results)
+      self.utility.log_info(f"Total Time Taken %s." % self.metrics_elapsed())
+      with self.metrics_stage("annapurna_merge_rescoring"):
+        self.annapurna_merge_rescoring(*args, **kwargs)
+      return
+
     for _idx, _complex in self.utility.ProgressBar(_results.iterrows()):
       _rec = _complex['receptor']
       _complex_uid = _complex['complex_id']
@@ -114,10 +317,11 @@ class AnnapuRNA(VinaBase):
       if self.utility.check_path(_complex_output_dir):
         self.utility.log_info(f"{_complex_uid} already analysed.")
         continue
-      _command = f"conda run -n annapurna python {self.annapurna_path} -r {_rec_pdbqt} -l {_out_pdbqt} {_models} -o {_complex_output_dir}/{_complex_uid} -s --overwrite"
+      _command = f"{SHLEX.join(self.annapurna_python())} {self.annapurna_path} -r {_rec_pdbqt} -l {_out_pdbqt} {_models} -o {_complex_output_dir}/{_complex_uid} -s --overwrite"
       # print(_command)
       _result = self.utility.cmd_run(_command)
       self.utility.log_info(f"Rescoring processed {_complex_uid}.")
 
-    self.utility.log_info(f"Total Time Taken %s." % self.utility.time_elapsed())
-    self.annapurna_merge_rescoring(*args, **kwargs)
+    self.utility.log_info(f"Total Time Taken %s." % self.metrics_elapsed())
+    with self.metrics_stage("annapurna_merge_rescoring"):
+      self.annapurna_merge_rescoring(*args, **kwargs)
@@ -4,10 +4,11 @@ from sieveai.lib import LibManager
 class ExecutableBase(LibManager):
   def __init__(self, *args, **kwargs):
     if not kwargs.get("utility") or not hasattr(self, "utility"):
-          # This will add db in first project dir only
-      kwargs["db_path"] = f"{kwargs.get('path_base')[0]}/SieveAI.db"
+          # This will add db in first project dir unless a database is given
+      kwargs["db_path"] = kwargs.get("db_path") or f"{kwargs.get('path_base')[0]}/SieveAI.db"
       _utility = UtilityManager(**kwargs)
       _utility.db_connect()
       kwargs['utility'] = _utility
     self.__defaults =  {}
-    _utility.update_attributes(self, kwargs)
+    super(ExecutableBase, self).__init__(**kwargs)
+    kwargs['utility'].update_attributes(self, kwargs)
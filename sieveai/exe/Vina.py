@@ -1,5 +1,9 @@
 import os as OS
-from pdbtools.pdb_selaltloc import select_by_occupancy as selAltLoc
+import time as TIME
+import shlex as SHLEX
+import fnmatch as FNMATCH
+import subprocess as SUBPROCESS
+from concurrent.futures import ThreadPoolExecutor
 
 from .VinaBase import VinaBase
 
@@ -7,6 +11,68 @@ class Vina(VinaBase):
   def __init__(self, *args, **kwargs):
     super(Vina, self).__init__(*args, **kwargs)
 
+  def __prepare_receptor_one(self, _rec_file):
+    """Cleans and converts one receptor, runs on a worker thread of prepare_receptor"""
+    _start = TIME.time()
+    _rec_path = f"{self.path_receptor}/{_rec_file}.pdb"
+    _rec_name = self.utility.file_name(_rec_path, with_ext = True)
+    _rec_pdbqt_path = f"{self.path_receptor_pdbqt}{OS.sep}{_rec_name}qt"
+
+    if self.utility.check_path(_rec_pdbqt_path):
+      return _rec_file, "already prepared", 0
+
+    _cache_key = None
+    if self.cache_enabled:
+      _version = self.receptor_prepare_version or self.cache_tool_version("prepare_receptor", None)
+      _cache_key = self.cache_key("prepare_receptor", _version, {"file": _rec_path}, self.receptor_prepare_flags)
+      if self.cache_fetch(_cache_key, {"receptor.pdbqt": _rec_pdbqt_path}):
+        self.ledger_mark("prepare_receptor", _rec_file, "done", duration=TIME.time() - _start, message="Restored from cache.")
+        return _rec_file, "restored from cache", TIME.time() - _start
+
+    self.ledger_mark("prepare_receptor", _rec_file, "running")
+
+    # Left failed instead of running when the receptor is interrupted
+    _status, _exit_code, _message = "failed", None, "interrupted"
+    try:
+      # Clean PDB, pdbtools is only needed by this stage
+      from pdbtools.pdb_selaltloc import select_by_occupancy as selAltLoc
+      with open(_rec_path, 'r', encoding="utf8") as file_handle:
+        lines = list(selAltLoc(file_handle))
+
+      _atom_records = [x for x in lines if not x.startswith("HETATM")]
+      _het_records = [x for x in lines if not x.startswith("ATOM") and not x.startswith("TER")]
+
+      _clean_receptor = f"{self.path_receptor_clean}{OS.sep}{_rec_name}"
+      self.utility.write(_clean_receptor, _atom_records)
+
+      _command = ["prepare_receptor", "-r", _clean_receptor, "-o", _rec_pdbqt_path, *SHLEX.split(self.receptor_prepare_flags),
+        "-v", "-d", f"{self.path_receptor_summary}{OS.sep}{_rec_name}.summary.log"]
+
+      try:
+        with self.scheduler_reserve(1):
+          _output = SUBPROCESS.run(_command, capture_output=True, text=True, timeout=float(self.receptor_prepare_timeout))
+        _exit_code = _output.returncode
+        _message = f"{_output.stdout}\n{_output.stderr}".strip()
+      except SUBPROCESS.TimeoutExpired:
+        _message = f"prepare_receptor timed out after {self.receptor_prepare_timeout} seconds."
+      except OSError as _e:
+        _message = f"prepare_receptor could not be started: {_e}"
+
+      _status = "done" if _exit_code == 0 and self.utility.check_path(_rec_pdbqt_path) else "failed"
+      if _status == "done" and _cache_key:
+        self.cache_store(_cache_key, {"receptor.pdbqt": _rec_pdbqt_path})
+
+      if _status == "failed":
+        self.utility.log_error(f"{_rec_name} ({len(_atom_records)} ATOM and {len(_het_records)} non-ATOM records) failed with {_exit_code}:\n{_message[-2000:]}")
+    except Exception as _e:
+      _status, _message = "failed", f"{type(_e).__name__}: {_e}"
+      self.utility.log_error(f"{_rec_name} could not be prepared: {_message}")
+    finally:
+      _duration = TIME.time() - _start
+      self.ledger_mark("prepare_receptor", _rec_file, _status, exit_code=_exit_code, duration=_duration, message=_message[-1000:])
+
+    return _rec_file, _status, _duration
+
   def prepare_receptor(self, *args, **kwargs):
     # return # to by pass
     self.utility.log_info("Preparing Receptors")
@@ -43,37 +109,118 @@ class Vina(VinaBase):
     else:
       self.utility.log_info(f"{len(_rec_not_prepared)}/{len(_rec_paths)} receptors are not prepared. Preparing...")
 
+    _rec_pending = []
     for _rec_file in _rec_not_prepared:
-      _rec_path = f"{self.path_receptor}/{_rec_file}.pdb"
-      _rec_name = self.utility.file_name(_rec_path, with_ext = True)
-      if self.utility.file_name(_rec_path) in self.skipped_receptor:
-        self.utility.log_warning("Receptor in skipped list.")
+      if _rec_file in self.skipped_receptor:
+        self.utility.log_warning(f"Receptor {_rec_file} in skipped list.")
         continue
+      _rec_pending.append(_rec_file)
 
-      if self.utility.check_path(f"{self.path_receptor_pdbqt}{OS.sep}{_rec_name}qt"):
-        self.utility.log_warning("Receptor already prepared. Delete the prepared receptor file.")
-        continue
+    _workers = max(1, min(len(_rec_pending), int(self.receptor_workers or self.scheduler_total_cores)))
+    with ThreadPoolExecutor(max_workers=_workers) as _executor:
+      for _rec_file, _status, _duration in self.utility.ProgressBar(_executor.map(self.__prepare_receptor_one, _rec_pending), total=len(_rec_pending)):
+        self.utility.log_info(f"{_rec_file} {_status} in {_duration:.1f}s.")
 
-      # Clean PDB
-      lines = []
-      with open(_rec_path, 'r', encoding="utf8") as file_handle:
-        lines = list(selAltLoc(file_handle))
-
-      _atom_records = [x for x in lines if not x.startswith("HETATM")]
-      _het_records = [x for x in lines if not x.startswith("ATOM") and not x.startswith("TER")]
-
-      _clean_receptor =  f"{self.path_receptor_clean}{OS.sep}{_rec_name}"
+    _summary = self.ledger_count("prepare_receptor")
+    self.utility.log_info(f"Receptor preparation status: {_summary}")
+    self.cache_evict()
+    self.utility.log_info("Receptor preparation completed.")
 
-      self.utility.write(_clean_receptor, _atom_records)
-      self.utility.log_info(f"{_rec_name} contains ATOM {len(_atom_records)} and {len(_het_records)} non-ATOM records.")
+  def __ligand_cache_misses(self, _records, _cache_keys, _restored):
+    """Yields (name, bytes) of the (name, bytes, cache key) molecules which are not restored from the artifact cache
+
+    Keys of the yielded molecules are kept in `_cache_keys` and names of the restored ones in `_restored`.
+    """
+    for _name, _molecule, _cache_key in _records:
+      if _cache_key is not None:
+        if self.cache_fetch(_cache_key, {"ligand.pdbqt": f"{self.path_ligand_pdbqt}{OS.sep}{_name}.pdbqt"}):
+          _restored.append(_name)
+          continue
+        _cache_keys[_name] = _cache_key
+      yield _name, _molecule
+
+  def __ligand_records(self, _lig_files):
+    """Yields (name, bytes, cache key) of the single ligand files to prepare, read one at a time"""
+    _version = self.cache_tool_version(self.openbabel_bin, "-V") if self.cache_enabled else None
+    for _lig_file in _lig_files:
+      _lig_path = f"{self.path_ligand}{OS.sep}{_lig_file}.pdb"
+      _lig_file_name = self.utility.file_name(_lig_path)
 
-      command = f"""prepare_receptor -r "{self.path_receptor_clean}{OS.sep}{_rec_name}" -o "{self.path_receptor_pdbqt}{OS.sep}{_rec_name}qt" -A 'bonds_hydrogens' -U 'waters' -v -d "{self.path_receptor_summary}{OS.sep}{_rec_name}.summary.log" """
+      if _lig_file_name in self.skipped_ligand:
+        self.utility.log_info("Ligand is in skipped list.")
+        continue
 
-      s = OS.popen(command)
-      output = s.read()
-      self.utility.log_info(output)
+      # Continue if already created
+      if self.utility.check_path(f"{self.path_ligand_pdbqt}{OS.sep}{_lig_file_name}.pdbqt"):
+        continue
 
-    self.utility.log_info("Receptor preparation completed.")
+      with open(_lig_path, "rb") as _fh:
+        _molecule = _fh.read()
+      yield _lig_file_name, _molecule, self.cache_key("prepare_ligand", _version, {"bytes": _molecule}, "-h") if self.cache_enabled else None
+
+  def __ledger_conversions(self, _results, _cache_keys, _restored):
+    """Caches and marks converted ligands in one transaction, failed ones with their OpenBabel message"""
+    for _name, (_status, _message) in _results.items():
+      if _status == "done" and _name in _cache_keys:
+        self.cache_store(_cache_keys[_name], {"ligand.pdbqt": f"{self.path_ligand_pdbqt}{OS.sep}{_name}.pdbqt"})
+
+    self.ledger_mark("prepare_ligand", _restored, "done", message="cache")
+    self.ledger_mark("prepare_ligand", [_name for _name, (_status, _message) in _results.items() if _status == "done"], "done")
+    for _name, (_status, _message) in _results.items():
+      if _status != "done":
+        self.ledger_mark("prepare_ligand", _name, "failed", message=_message)
+
+  def __prepare_ligand_libraries(self):
+    """Converts molecules of multi-molecule and gzipped libraries to PDBQT straight from their index
+
+    Returns file names of the libraries so that they are not treated as single molecules. Files found to
+    hold a single molecule are recorded in the ledger by name, size and mtime and are not read again
+    until they change. Molecule names are unique across the libraries and the single molecule files, see
+    mol_library_unique.
+    """
+    _libraries = []
+    _singles = self.ledger_items("index_ligand", "done")
+    _new_singles = []
+    _single_names = set()
+    _patterns = [_p for _ext in self.ext_ligand for _p in (_ext, f"{_ext}.gz")]
+    with OS.scandir(self.path_ligand) as _entries:
+      for _entry in _entries:
+        if not _entry.is_file() or not self.mol_library_format(_entry.name):
+          continue
+        if not any(FNMATCH.fnmatch(_entry.name, _p) for _p in _patterns):
+          continue
+        _stat = _entry.stat()
+        _single = f"{_entry.name}:{_stat.st_size}:{_stat.st_mtime_ns}"
+        if _single in _singles:
+          _single_names.add(OS.path.splitext(_entry.name)[0])
+          continue
+        _index = self.mol_library_index(_entry.path)
+        if _index["count"] > 1 or _entry.name.endswith(".gz"):
+          _libraries.append(_index)
+        else:
+          _new_singles.append(_single)
+          _single_names.add(OS.path.splitext(_entry.name)[0])
+
+    self.ledger_mark("index_ligand", _new_singles, "done", message="single molecule")
+    _libraries = self.mol_library_unique(sorted(_libraries, key=lambda _index: OS.path.basename(_index["source"])), _single_names)
+
+    with OS.scandir(self.path_ligand_pdbqt) as _entries:
+      _prepared = {_entry.name[:-6] for _entry in _entries if _entry.name.endswith(".pdbqt")}
+
+    _version = self.cache_tool_version(self.openbabel_bin, "-V") if self.cache_enabled else None
+    for _index in _libraries:
+      _pending = set(_index["names"]).difference(_prepared).difference(self.skipped_ligand)
+      self.utility.log_info(f"{len(_pending)}/{_index['count']} ligand(s) of {_index['source']} are not prepared. Preparing...")
+
+      # Molecules are keyed on their content, read lazily from the library
+      _records = ((_name, _molecule, self.cache_key("prepare_ligand", _version, {"bytes": _molecule}, _index["format"], "-h") if self.cache_enabled else None)
+        for _name, _molecule in self.mol_library_iter(_index, names=_pending))
+      _cache_keys, _restored = {}, []
+      _results = self.openbabel_convert_batch(self.__ligand_cache_misses(_records, _cache_keys, _restored), _index["format"], "pdbqt",
+        self.path_ligand_pdbqt, args=["-h"])
+      self.__ledger_conversions(_results, _cache_keys, _restored)
+
+    return {OS.path.basename(_index["source"]) for _index in _libraries}
 
   def prepare_ligand(self, *args, **kwargs):
     # Check if path exists or not and create accordingly
@@ -86,8 +233,9 @@ class Vina(VinaBase):
     if not self.path_ligand:
        raise Exception("Ligand directory is not provided.")
 
-    self.mol_convert_molecules(self.path_ligand, self.ext_ligand, "pdb")
-    _lig_paths = self.utility.find_files(self.path_ligand, "*.pdb")
+    _libraries = self.__prepare_ligand_libraries()
+    self.mol_convert_molecules(self.path_ligand, self.ext_ligand, "pdb", exclude=_libraries)
+    _lig_paths = [_f for _f in self.utility.find_files(self.path_ligand, "*.pdb") if OS.path.basename(_f) not in _libraries]
     _lig_pre_paths = self.utility.find_files(self.path_ligand_pdbqt, "*.pdbqt")
 
     _temp_lig_paths = {self.utility.filename(_f) for _f in _lig_paths}
@@ -100,25 +248,11 @@ class Vina(VinaBase):
     else:
       self.utility.log_info(f"{len(_lig_not_prepared)}/{len(_lig_paths)} ligand(s) are not prepared. Preparing...")
 
-    for _lig_file in _lig_not_prepared:
-      _lig_path = f"{self.path_ligand}{OS.sep}{_lig_file}.pdb"
-      _lig_file_name = self.utility.file_name(_lig_path)
-      _lig_pdbqt_path = f"{self.path_ligand_pdbqt}{OS.sep}{_lig_file_name}.pdbqt"
-
-      if self.utility.file_name(_lig_path) in self.skipped_ligand:
-        self.utility.log_info("Ligand is in skipped list.")
-        continue
-
-      # Continue if already created
-      if self.utility.check_path(_lig_pdbqt_path):
-        continue
-
-      # Directly convert pdb to pdbqt using openbabel
-      _res = self.utility.cmd_run([
-          "obabel", _lig_path, "-O", _lig_pdbqt_path, "-h",
-          "--quiet"
-        ])
-
-      self.utility.log_info(f"Converted ligand {_lig_file_name}.\n{_res}", log_wrap = False)
+    # Directly convert pdb to pdbqt using openbabel, many ligands per invocation
+    _cache_keys, _restored = {}, []
+    _records = self.__ligand_cache_misses(self.__ligand_records(_lig_not_prepared), _cache_keys, _restored)
+    _results = self.openbabel_convert_batch(_records, "pdb", "pdbqt", self.path_ligand_pdbqt, args=["-h"])
+    self.__ledger_conversions(_results, _cache_keys, _restored)
 
+    self.cache_evict()
     self.utility.log_info("Ligand preparation completed.")
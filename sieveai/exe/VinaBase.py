@@ -1,18 +1,21 @@
 import os as OS
-import math as MATH
+import json as JSON
+import glob as GLOB
+import time as TIME
+import shutil as SHUTIL
+import shlex as SHLEX
+import queue as QUEUE
+import threading as THREADING
 
-import pandas as PD
-
-import warnings as WARNINGS
+from concurrent.futures import ThreadPoolExecutor
 
-from Bio.PDB import PDBParser
-from Bio.PDB.PDBExceptions import PDBConstructionWarning
+import numpy as NP
+import pandas as PD
 
 from .ExecutableBase import ExecutableBase
 
 class VinaBase(ExecutableBase):
   def __init__(self, *args, **kwargs):
-    WARNINGS.simplefilter('ignore', PDBConstructionWarning)
     super(VinaBase, self).__init__(**kwargs)
     self.__defaults = {
         "path_base": None,
@@ -53,12 +56,15 @@ class VinaBase(ExecutableBase):
 
         "path_mgltools": None,
 
-        "processes": ["prepare_ligand", "prepare_receptor", "prepare_grid", "perform_docking", "analyse_docking", "filter_results", "cleanup_files"],
+        "processes": ["prepare_ligand", "prepare_receptor", "prepare_grid", "prepare_maps", "perform_docking", "analyse_docking", "filter_results", "cleanup_files"],
         "skipped_receptor": [],
         "skipped_ligand": [],
         "file__result_score": "result.score.csv",
         "file__result_score_excel": "Docking-Results.xlsx",
         "file__config": "sieveai.cfg",
+        "file__grid_manifest": "grid.manifest.json",
+        "grid_residues": [],
+        "grid_spacing": 1,
         "vina_config_keys": ["flex", # "receptor", "ligand",
               "center_x", "center_y", "center_z",
               "size_x", "size_y", "size_z",
@@ -67,6 +73,16 @@ class VinaBase(ExecutableBase):
               "exhaustiveness", "num_modes", "energy_range"],
 
         "multiprocess": False,
+        "chimerax_workers": 1,
+        "analysis_backend": "chimerax",
+        "vina_exhaustiveness": 32,
+        "receptor_prepare_flags": "-A 'bonds_hydrogens' -U 'waters'",
+        "receptor_prepare_version": None, # prepare_receptor has no version flag, its executable is hashed when not given
+        "vina_maps": False, # Maps are large, precomputation is opt-in
+        "vina_batch_size": 0, # Ligands docked per Vina process with --batch, 0 for one process per complex
+        "dir_receptor_maps": "maps", # Under the receptor config directory
+        "receptor_workers": None, # All logical cores by default
+        "receptor_prepare_timeout": 1800, # Seconds per receptor
       }
 
     self.utility.update_attributes(self, kwargs, self.__defaults)
@@ -77,10 +93,27 @@ class VinaBase(ExecutableBase):
 
     self.path_config = f"{self.path_base}/{self.file__config}"
 
+  def __select_grid_atoms(self, _receptor, _residues):
+    """Mask of atoms in selected residues given as `45`, `A:45` or residue names such as `HIS`, and the residues not found"""
+    _mask = NP.zeros(_receptor["coords"].shape[0], dtype=bool)
+    _missing = []
+    for _residue in _residues:
+      _residue = str(_residue).strip()
+      _chain, _, _resid = _residue.rpartition(":")
+      if _resid.lstrip("-").isdigit():
+        _selected = _receptor["resid"] == _resid
+      else:
+        _selected = _receptor["resname"] == _resid.upper()
+      if _chain:
+        _selected &= _receptor["chain"] == _chain
+      if not _selected.any():
+        _missing.append(_residue)
+      _mask |= _selected
+
+    return _mask, _missing
+
   def __write_vina_config(self, *args, **kwargs):
     """Writes VINA config"""
-    __structure = []
-    __coordinates = []
     self.properties = []
 
     _vina_config_settings = {
@@ -90,77 +123,43 @@ class VinaBase(ExecutableBase):
       "seed": 41103333,
       "num_modes": 10,
       "exhaustiveness": 16,
+      "overwrite": False,
     }
 
     _vina_config_settings.update(kwargs)
 
     __vina_config_file_location = f"{_vina_config_settings.get('destination')}{OS.sep}{_vina_config_settings.get('config_file')}"
 
-    if self.utility.exists(__vina_config_file_location):
+    if self.utility.exists(__vina_config_file_location) and not _vina_config_settings.get("overwrite"):
       self.utility.log_warning(f"{__vina_config_file_location} config file already exist. Delete this to recalculate and regenerate.")
       return
 
     _receptor_path = _vina_config_settings.get("receptor")
-    parser = PDBParser(get_header=False)
-    __structure = parser.get_structure("PDB", _receptor_path)
+    _models = self.interactions_read_pdbqt(_receptor_path)
+    if not len(_models) or not _models[0]["coords"].shape[0]:
+      self.utility.log_error(f"No atoms found in {_receptor_path}, the grid cannot be calculated.")
+      return
+    __coordinates = _models[0]["coords"]
 
     """Filter coordinates to calculate the grid of selected res only"""
 
     if _vina_config_settings.get("residues") and len(_vina_config_settings.get("residues")):
-      # If residues are set, calculate around specified residues (residue ids)
-      for chains in __structure.get_chains():
-        for chain in chains:
-          chain_vars = vars(chain)
-          if chain_vars.get("resname") in _vina_config_settings.get("residues"):
-            # print([[k for k in res.get_coord()] for res in chain])
-            __coordinates.extend([[k for k in res.get_coord()] for res in chain])
-    else:
-      # Else draw around whole the structure
-      __coordinates = []
-      for atom in __structure.get_atoms():
-        __coordinates.append(atom.get_coord())
-
-    x_total, y_total, z_total = (0, 0, 0)
-    x_min, x_max = (0, 0)
-    y_min, y_max = (0, 0)
-    z_min, z_max = (0, 0)
-
-    d_x = 0
-    d_y = 0
-    d_z = 0
-
-    center = (0, 0, 0)
-    size = (0, 0, 0)
-    distance = 0
-
-    if len(__coordinates):
-      for c in __coordinates:
-        at_x = float(c[0])
-        at_y = float(c[1])
-        at_z = float(c[2])
-        x_total += at_x
-        y_total += at_y
-        z_total += at_z
-        x_min = min(x_min, at_x)
-        x_max = max(x_max, at_x)
-        y_min = min(y_min, at_y)
-        y_max = max(y_max, at_y)
-        z_min = min(z_min, at_z)
-        z_max = max(z_max, at_z)
-
-      center = [x_total/len(__coordinates), y_total/len(__coordinates), z_total/len(__coordinates)]
-      size = [(x_max - x_min), (y_max - y_min), (z_max - z_min)]
-
-      for c in __coordinates:
-        d_x += (c[0]-center[0])**2
-        d_y += (c[1]-center[1])**2
-        d_z += (c[2]-center[2])**2
-
-      distance = MATH.sqrt((d_x+d_y+d_z)/len(__coordinates))
+      # If residues are set, calculate around specified residues
+      _mask, _missing = self.__select_grid_atoms(_models[0], _vina_config_settings.get("residues"))
+      __coordinates = __coordinates[_mask]
+      if not __coordinates.shape[0]:
+        self.utility.log_error(f"None of the residues {', '.join(_missing)} found in {_receptor_path}.")
+        return
+      if _missing:
+        self.utility.log_warning(f"Residues {', '.join(_missing)} not found in {_receptor_path}, the grid is calculated around the others.")
+
+    center = __coordinates.mean(axis=0)
+    size = __coordinates.max(axis=0) - __coordinates.min(axis=0)
+    distance = float(NP.sqrt(((__coordinates - center) ** 2).sum(axis=1).mean()))
 
     self.properties = {
-      "center": center,
-      "size": size,
+      "center": [float(_c) for _c in center],
+      "size": [float(_s) for _s in size],
       "distance": distance,
     }
 
@@ -196,92 +195,197 @@ class VinaBase(ExecutableBase):
     if _vina_config_settings.get('config_file'):
       self.utility.write(__vina_config_file_location, __vina_config_lines)
 
-  def __parse_res_score_line(self, line):
-    records = None
-    if line.startswith(" "):
-      records = str(line).split()
-      records = [r.strip() for r in records]
-
-    return records
-
-  def __parse_score_log(self, file_path):
-    __v_scores = []
-    with open(file_path, "r") as __vsf:
-      __v_scores = __vsf.readlines()
-
-    _score_table_dict = []
-    _score_headers = ["mode", "affinity", "rmsd_lb", "rmsd_ub"]
+    return __vina_config_file_location
+
+  def __read_score_remarks(self, file_path):
+    """Reads `REMARK VINA RESULT` lines of a result PDBQT as (mode, affinity, rmsd_lb, rmsd_ub)"""
+    _scores = []
+    _mode = 0
+    for _line in (self.archive_read(file_path) or "").splitlines():
+      if _line.startswith("MODEL"):
+        _mode = int(_line.split()[1])
+      elif _line.startswith("REMARK VINA RESULT:"):
+        _records = _line[19:].split()
+        _mode = _mode if _mode > len(_scores) else len(_scores) + 1
+        _scores.append((_mode, float(_records[0]), float(_records[1]), float(_records[2])))
+
+    return _scores
+
+  def __read_score_log(self, file_path):
+    """Reads the result table of a Vina log as (mode, affinity, rmsd_lb, rmsd_ub), also from the docking archive"""
+    _scores = []
     _score_flag = False
-    for _res_line in __v_scores:
-        if _score_flag:
-            score_recs = self.__parse_res_score_line(_res_line)
-            if score_recs:
-              _score_table_dict.append(score_recs)
+    for _line in (self.archive_read(file_path) or "").splitlines():
+      if _score_flag:
+        _records = _line.split()
+        if _line.startswith(" ") and len(_records) == 4:
+          _scores.append((int(_records[0]), float(_records[1]), float(_records[2]), float(_records[3])))
+      elif _line.startswith("-----+------------+----------+----------"):
+        _score_flag = True
+
+    return _scores
+
+  def read_vina_scores(self, *args, **kwargs):
+    """Returns conformer scores of a complex from the result PDBQT, or from the Vina log if the result has none"""
+    _result_file = args[0] if len(args) > 0 else kwargs.get("result_file")
+    _log_file = args[1] if len(args) > 1 else kwargs.get("log_file")
+
+    _scores = []
+    if _result_file and self.archive_exists(_result_file):
+      _scores = self.__read_score_remarks(_result_file)
 
-        if not _score_flag and _res_line.startswith("-----+------------+----------+----------"):
-            _score_flag = True
+    if not _scores and _log_file and self.archive_exists(_log_file):
+      _scores = self.__read_score_log(_log_file)
 
-    _score_df = PD.DataFrame.from_records(_score_table_dict, columns=_score_headers)
-    return _score_df
+    return _scores
 
   def prepare_grid(self, *args, **kwargs):
     # return # to by pass
     self.utility.log_info("Docking preparing grid...")
+
+    if self.path_receptor_config is None and self.dir_receptor_config:
+      self.path_receptor_config = self.utility.validate_dir(f"{self.path_base}/{self.dir_receptor_config}")
+
     _rec_pdbqt_path_list = self.utility.find_files(self.path_receptor_pdbqt, '.pdbqt')
-    _rec_pre_paths = self.utility.find_files(self.path_receptor_pdbqt, ".config")
+    _manifest_path = f"{self.path_receptor_config}{OS.sep}{self.file__grid_manifest}"
+    _manifest = {}
 
-    if len(_rec_pdbqt_path_list) == len(_rec_pre_paths):
-      self.utility.log_warning(f"{len(_rec_pdbqt_path_list)} receptor config files already exist. Continuing...")
-      return
+    if self.utility.check_path(_manifest_path):
+      with open(_manifest_path, "r", encoding="utf8") as _fh:
+        _manifest = JSON.load(_fh)
+
+    # Grid settings are part of the key so that changing the selection regenerates the boxes
+    _grid_key = JSON.dumps({"residues": list(self.grid_residues or []), "spacing": self.grid_spacing}, sort_keys=True)
+    _updated = 0
 
     for _rec in _rec_pdbqt_path_list:
       file_name = self.utility.file_name(_rec)
+      _config_file = f"{file_name}.config"
+      _rec_hash = self.cache_file_hash(_rec)
+      _entry = _manifest.get(file_name, {})
+
+      if _entry.get("sha256") == _rec_hash and _entry.get("grid") == _grid_key and self.utility.check_path(f"{self.path_receptor_config}{OS.sep}{_config_file}"):
+        continue
+
       params = {
         "receptor": f"{_rec}",
-        "config_file": f"{file_name}.config",
-        "destination": self.path_receptor_config
+        "config_file": _config_file,
+        "destination": self.path_receptor_config,
+        "residues": self.grid_residues or [],
+        "spacing": self.grid_spacing,
+        "overwrite": True,
       }
-      self.__write_vina_config(**params)
 
-  def gen_chimerax_scripts(self, *args, **kwargs):
-    _rec_pdbqt_path_list = self.utility.find_files(self.path_receptor_pdbqt, '.pdbqt')
-    _lig_pdbqt_path_list = self.utility.find_files(self.path_ligand_pdbqt, '.pdbqt')
+      if self.__write_vina_config(**params):
+        _manifest[file_name] = {"sha256": _rec_hash, "grid": _grid_key}
+        _updated += 1
+
+    if _updated:
+      with open(_manifest_path, "w", encoding="utf8") as _fh:
+        JSON.dump(_manifest, _fh, indent=2, sort_keys=True)
+
+    self.utility.log_info(f"{_updated}/{len(_rec_pdbqt_path_list)} receptor config file(s) generated, others are up to date.")
+
+  def __chimerax_conformer_commands(self, _comp, _model_id, _total_conformers):
+    """ChimeraX commands to find contacts and H-bonds of one docked conformer (model #2)"""
+    return [
+      "hide #!2.1-%s target m;" % (_total_conformers),
+      f"show #!2.{_model_id} models;",
+      f"view;",
+      f"sel #!2.{_model_id};", # Select the model
+      f"contacts (#1 & ~hbonds) restrict sel radius 0.05 log t saveFile {self.path_analysis}/{_comp}--{_model_id}.{self.ext__contacts};",
+      f"wait;",
+      f"hb #1 restrict sel reveal t show t select t radius 0.05 log t saveFile {self.path_analysis}/{_comp}--{_model_id}.{self.ext__hbonds};",
+      f"wait;",
+    ]
+
+  def __append_columns(self, _columns, *_values):
+    for _key, _value in zip(_columns.keys(), _values):
+      _columns[_key].append(_value)
+
+  def __scan_names(self, _dir_path, _suffix):
+    """Names of directory entries ending with the suffix, suffix removed, from a single scandir and the directory archive"""
+    if not _dir_path:
+      return set()
+
+    _names = self.archive_names(_dir_path, _suffix)
+    if OS.path.isdir(_dir_path):
+      with OS.scandir(_dir_path) as _entries:
+        _names.update(_entry.name[:-len(_suffix)] for _entry in _entries if _entry.name.endswith(_suffix))
+
+    return _names
+
+  def __iter_complexes(self, _skip=None):
+    """Lazily yields (receptor, ligand, receptor name, ligand name, complex) of prepared receptors x ligands
+
+    `_skip(receptor name)` returns the complexes of that receptor which are not to be yielded.
+    """
+    _receptors = sorted(self.__scan_names(self.path_receptor_pdbqt, ".pdbqt"))
+    _ligands = sorted(self.__scan_names(self.path_ligand_pdbqt, ".pdbqt"))
+
+    for _rec_fn in _receptors:
+      _skipped = _skip(_rec_fn) if _skip else set()
+      _rec = f"{self.path_receptor_pdbqt}{OS.sep}{_rec_fn}.pdbqt"
+      for _lig_fn in _ligands:
+        _comp = f"{_rec_fn.strip()}--{_lig_fn.strip()}"
+        if _comp not in _skipped:
+          yield _rec, f"{self.path_ligand_pdbqt}{OS.sep}{_lig_fn}.pdbqt", _rec_fn, _lig_fn, _comp
+
+  def __sink_adopt_scores(self):
+    """A project without a score table adopts the score columns of a result file of an earlier run once"""
+    _score_file_path = f"{self.path_base}{OS.sep}{self.file__result_score}"
+    if self.sink_exists("scores") or self.ledger_count("collect_scores") or not self.utility.check_path(_score_file_path):
+      return
 
-    _result_matrix = []
+    _scores = PD.read_csv(_score_file_path, usecols=["receptor", "ligand", "conformer_id", "conformer_score"])
+    self.sink_append("scores", _scores)
+    self.ledger_mark("collect_scores", (_scores["receptor"].astype(str) + "--" + _scores["ligand"].astype(str)).unique().tolist(), "done", message="adopted")
+    self.utility.log_info(f"{_scores.shape[0]} scores of {_score_file_path} recorded to the result table.")
 
-    _complexes = self.utility.product([_rec_pdbqt_path_list, _lig_pdbqt_path_list]) # combination
-    _complexes_to_process = []
+  def __sink_flush(self, _table, _stage, _result_matrix, _complexes):
+    """Appends buffered rows as one part and records their complexes, the buffers are emptied"""
+    self.sink_append(_table, _result_matrix)
+    self.ledger_mark(_stage, _complexes, "done")
+    for _values in _result_matrix.values():
+      _values.clear()
+    _complexes.clear()
 
-    for _rec, _lig in _complexes:
-      _rec_fn = self.utility.filename(_rec)
-      _lig_fn = self.utility.filename(_lig)
-      _comp = _rec_fn.strip() + "--" + _lig_fn.strip()
+  def read_result_table(self, *args, **kwargs):
+    """Result table of a stage, complexes appended twice by an interrupted run are read once"""
+    _table = args[0] if len(args) > 0 else kwargs.get("table", "scores")
+    return self.sink_read(_table)
 
-      _res_file = f"{self.path_docking}{OS.sep}{_comp}.result.pdbqt"
-      _log_file = self.utility.change_ext(_res_file, "log")
-      _cxc_file = f"{self.path_analysis}{OS.sep}{_comp}.{self.ext__chimera_cxc}"
+  def gen_chimerax_scripts(self, *args, **kwargs):
+    _result_matrix = {"receptor": [], "ligand": [], "conformer_id": [], "conformer_score": []}
+    _collected = []
+    _flush_rows = max(1, int(self.sink_flush_rows))
 
-      if not self.utility.check_path(_cxc_file):
-        _complexes_to_process.append((_rec_fn, _lig_fn, _comp, _rec, _lig, _res_file, _log_file, _cxc_file))
+    # Single snapshot of the output directories instead of probing each complex
+    _docked = self.__scan_names(self.path_docking, f".{self.ext__dock_result}")
+    _logged = self.__scan_names(self.path_docking, f".{self.ext__dock_log}")
 
-    for _rec_fn, _lig_fn, _comp, _rec, _lig, _res_file, _log_file, _cxc_file in _complexes_to_process:
-        # If log file is not present, or
-        if not self.utility.check_path(_log_file):
-          continue
+    self.__sink_adopt_scores()
 
-        _scores = self.__parse_score_log(_log_file)
+    # Scores of complexes already in the result table are not read again
+    for _rec, _lig, _rec_fn, _lig_fn, _comp in self.__iter_complexes(lambda _rec_fn: self.ledger_items("collect_scores", "done", prefix=f"{_rec_fn}--")):
+        if len(_result_matrix["receptor"]) >= _flush_rows:
+          self.__sink_flush("scores", "collect_scores", _result_matrix, _collected)
+
+        _res_file = f"{self.path_docking}{OS.sep}{_comp}.{self.ext__dock_result}"
+        _log_file = f"{self.path_docking}{OS.sep}{_comp}.{self.ext__dock_log}"
+        _cxc_file = f"{self.path_analysis}{OS.sep}{_comp}.{self.ext__chimera_cxc}"
 
         # Continue if out file doesn't exist
-        if not self.utility.check_path(_res_file):
-          self.utility.log_error(f"{_comp}.log file doesn't exist.")
-          _result_matrix.append({
-            "receptor": _rec_fn,
-            "ligand": _lig_fn,
-            "conformer_id": 0,
-            "conformer_score": 0,
-          })
+        if _comp not in _docked:
+          # Docking was attempted if log file is present
+          if _comp in _logged:
+            self.utility.log_error(f"{_comp}.result.pdbqt file doesn't exist.")
+            self.__append_columns(_result_matrix, _rec_fn, _lig_fn, 0, 0)
+            _collected.append(_comp)
           continue
 
+        _scores = self.read_vina_scores(_res_file, _log_file)
+
         # ToDo: Skip chimerax execution if hbonds or contacts file
 
         _complex_commads = [
@@ -293,20 +397,12 @@ class VinaBase(ExecutableBase):
           f"open {_res_file}; wait;",
         ]
 
-        _total_conformers = len(_scores['mode'].tolist())
+        _total_conformers = len(_scores)
 
-        for _idx, _conformer_details in _scores.iterrows():
-          _model_id = _conformer_details["mode"]
+        for _model_id, _affinity, _rmsd_lb, _rmsd_ub in _scores:
+          _complex_commads.append(f"# MODEL-NO-{_model_id}")
+          _complex_commads.extend(self.__chimerax_conformer_commands(_comp, _model_id, _total_conformers))
           _complex_commads.extend([
-            f"# MODEL-NO-{_model_id}",
-            "hide #!2.1-%s target m;" % (_total_conformers),
-            f"show #!2.{_model_id} models;",
-            f"view;",
-            f"sel #!2.{_model_id};", # Select the model
-            f"contacts (#1 & ~hbonds) restrict sel radius 0.05 log t saveFile {self.path_analysis}/{_comp}--{_model_id}.{self.ext__contacts};",
-            f"wait;",
-            f"hb #1 restrict sel reveal t show t select t radius 0.05 log t saveFile {self.path_analysis}/{_comp}--{_model_id}.{self.ext__hbonds};",
-            f"wait;",
             "label sel residues text {0.name}-{0.number} height 1.5 offset -2,0.25,0.25 bgColor #00000099 color white;",
             f"~sel;",
             # f"save {self.path_analysis}/{_comp}--{_model_id}.complex.png width 1200 height 838 supersample 4 transparentBackground true;",
@@ -319,39 +415,141 @@ class VinaBase(ExecutableBase):
             f"\n",
           ])
 
-          _result_matrix.append({
-            "receptor": _rec_fn,
-            "ligand": _lig_fn,
-            "conformer_id": _model_id,
-            "conformer_score": _conformer_details["affinity"],
-          })
+          self.__append_columns(_result_matrix, _rec_fn, _lig_fn, _model_id, _affinity)
 
         _complex_commads.extend([
           f"exit;",
         ])
+        _collected.append(_comp)
 
-        self.utility.write(_cxc_file, _complex_commads)
+        if self.analysis_backend == "chimerax":
+          self.utility.write(_cxc_file, _complex_commads)
         # self.chimera_files.append(f"open {_cxc_file};")
 
-    _score_file_path = f"{self.path_base}{OS.sep}{self.file__result_score}"
-    _score_file_path_xl = f"{self.path_base}{OS.sep}{self.file__result_score_excel}"
-    if _result_matrix and not self.utility.check_path(_score_file_path):
-      _f2 = PD.DataFrame(_result_matrix)
-      _f2.to_csv(_score_file_path, index=False)
-      self.utility.pd_excel(_score_file_path_xl, _f2, 'vina_score')
-      self.utility.log_info(f"AutoDock result score table updated to {_score_file_path}.")
+    if len(_collected):
+      self.__sink_flush("scores", "collect_scores", _result_matrix, _collected)
+      self.utility.log_info(f"AutoDock result score table updated in {self.sink_path('scores')}.")
     else:
-      self.utility.log_warning("No score file was saved .")
+      self.utility.log_warning("No new scores were saved.")
+
+  def __chimerax_pool_complex(self, _session, _rec, _lig, _conformers, _total_conformers):
+    _comp = f"{_rec}--{_lig}"
+    _res_file = f"{self.path_docking}{OS.sep}{_comp}.{self.ext__dock_result}"
+
+    # Receptor stays loaded and protonated as model #1 while its poses are streamed through #2
+    if _session["receptor"] != _rec:
+      self.chimerax_session_run(_session, [
+        "close",
+        f'open "{self.path_receptor_pdbqt}{OS.sep}{_rec}.pdbqt"',
+        "hide surfaces",
+        "hide atoms",
+        "addh #1",
+        "~sel",
+      ])
+      _session["receptor"] = _rec
+
+    self.chimerax_session_run(_session, f'open "{_res_file}"')
+    for _model_id in _conformers:
+      if self.archive_exists(f"{self.path_analysis}{OS.sep}{_comp}--{_model_id}.{self.ext__hbonds}"):
+        continue
+      self.chimerax_session_run(_session, self.__chimerax_conformer_commands(_comp, _model_id, _total_conformers))
+    self.chimerax_session_run(_session, ["~sel", "close #2"])
+
+  def __chimerax_pool_worker(self, _queue, _progress):
+    # Every worker holds one core of the budget shared with other projects
+    with self.scheduler_reserve(1):
+      _session = None
+      try:
+        while True:
+          try:
+            _rec, _complexes = _queue.get_nowait()
+          except QUEUE.Empty:
+            break
+
+          for _lig, _conformers, _total_conformers in _complexes:
+            # Left failed instead of running when the worker is interrupted
+            _status, _message = "failed", "interrupted"
+            self.ledger_mark("run_chimerax_scripts", f"{_rec}--{_lig}", "running")
+            try:
+              for _attempt in range(2):
+                try:
+                  if not self.chimerax_session_alive(_session):
+                    _session = self.chimerax_session_start()
+                  self.__chimerax_pool_complex(_session, _rec, _lig, _conformers, _total_conformers)
+                  _status, _message = "done", None
+                  break
+                except OSError as _e:
+                  _message = str(_e)
+                  self.utility.log_error(f"ChimeraX session failed for {_rec}--{_lig}: {_e}. Restarting session...")
+                  if _session is not None:
+                    self.chimerax_session_stop(_session)
+                  _session = None
+                except Exception as _e:
+                  # Not a session failure, the complex would fail the same way again
+                  _message = f"{type(_e).__name__}: {_e}"
+                  self.utility.log_error(f"ChimeraX analysis failed for {_rec}--{_lig}: {_message}")
+                  break
+            finally:
+              self.ledger_mark("run_chimerax_scripts", f"{_rec}--{_lig}", _status, message=_message)
+
+            with _progress["lock"]:
+              _progress["done"] += 1
+              self.utility.log_info(f"Processed {_rec}--{_lig} with ChimeraX %i/%i." % (_progress["done"], _progress["total"]))
+              self.metrics_progress("run_chimerax_scripts", _progress["done"], _progress["total"])
+              self.metrics_set("sieveai_queue_items", _queue.qsize(), labels={"stage": "run_chimerax_scripts", "status": "pending"})
+      finally:
+        if _session is not None:
+          self.chimerax_session_stop(_session)
+
+  def __run_chimerax_pool(self, _results):
+    """Streams pending conformers through persistent ChimeraX sessions grouped by receptor"""
+    if self.path_receptor_pdbqt is None and self.dir_receptor_pdbqt:
+      self.path_receptor_pdbqt = f"{self.path_base}/{self.dir_receptor_pdbqt}"
 
-  def run_chimerax_scripts(self, *args, **kwargs):
-    _results_score_file = f"{self.path_base}/{self.file__result_score}"
+    if self.path_docking is None and self.dir_docking:
+      self.path_docking = f"{self.path_base}/{self.dir_docking}"
+
+    _receptor_complexes = {}
+    _total_complexes = 0
+    _analysed = self.ledger_items("run_chimerax_scripts", "done")
+    for (_rec, _lig), _complex in _results.groupby(["receptor", "ligand"], sort=False):
+      if f"{_rec}--{_lig}" in _analysed:
+        continue
+      _conformers = _complex['conformer_id'].astype(int).tolist()
+      _pending = [_c for _c in _conformers if not self.archive_exists(f"{self.path_analysis}{OS.sep}{_rec}--{_lig}--{_c}.{self.ext__hbonds}")]
+      if not len(_pending) or not self.utility.check_path(f"{self.path_docking}{OS.sep}{_rec}--{_lig}.{self.ext__dock_result}"):
+        continue
+      _receptor_complexes.setdefault(_rec, []).append((_lig, _pending, max(_conformers)))
+      _total_complexes += 1
+
+    _workers = min(int(self.chimerax_workers), len(_receptor_complexes))
+    self.utility.log_info(f"{_total_complexes} complex(es) of {len(_receptor_complexes)} receptor(s) to be processed by {_workers} ChimeraX session(s).")
+
+    if not _workers:
+      return
+
+    _queue = QUEUE.Queue()
+    for _item in sorted(_receptor_complexes.items(), key=lambda _i: -len(_i[1])):
+      _queue.put(_item)
+
+    _progress = {"lock": THREADING.Lock(), "done": 0, "total": _total_complexes}
+    with ThreadPoolExecutor(max_workers=_workers) as _executor:
+      _futures = [_executor.submit(self.__chimerax_pool_worker, _queue, _progress) for _ in range(_workers)]
+      for _future in _futures:
+        _future.result()
 
-    self.utility.time_start()
-    if not self.utility.check_path(_results_score_file):
-      self.utility.log_warning(f"Score file {_results_score_file} does not exist to run chimerax scripts. Skipping...")
+  def run_chimerax_scripts(self, *args, **kwargs):
+    if not self.sink_exists("scores"):
+      self.utility.log_warning(f"Score table {self.sink_path('scores')} does not exist to run chimerax scripts. Skipping...")
       return None
 
-    _results = PD.read_csv(_results_score_file)
+    _results = self.read_result_table("scores")
+
+    if int(self.chimerax_workers or 0) > 0:
+      self.__run_chimerax_pool(_results)
+      self.utility.log_info(f"ChimeraX scripts execution is completed. Took {self.metrics_elapsed()}.")
+      return
+
     _results["complex_id"] = _results['receptor'] + "--" + _results['ligand']
     _results = _results.drop_duplicates(subset='complex_id', keep="last")
     _total_to_process = _results.shape[0]
@@ -370,138 +568,150 @@ class VinaBase(ExecutableBase):
       # Skip if hbonds.txt file is already generated
       self.utility.log_info(f"Processing {_complex_name} complex with ChimeraX %i/%i having {_last_conformer} conformers." % (_processed_count, _total_to_process))
       if self.utility.check_path(_cxc_file):
-        if self.utility.check_path(f"{self.path_analysis}{OS.sep}{_complex_name}--{_last_conformer}.{self.ext__hbonds}"):
+        if self.archive_exists(f"{self.path_analysis}{OS.sep}{_complex_name}--{_last_conformer}.{self.ext__hbonds}"):
           self.utility.log_info(f"{_complex_name}--{_last_conformer} is already processed by ChimeraX.")
           continue
         self.chimerax_run_file(_cxc_file)
       else:
         self.utility.log_info(f"File {_cxc_file} not found. Continuing...")
 
-    self.utility.log_info(f"ChimeraX scripts execution is completed. Took {self.utility.time_elapsed()}.")
+    self.utility.log_info(f"ChimeraX scripts execution is completed. Took {self.metrics_elapsed()}.")
 
   def process_chimerax_results(self, *args, **kwargs):
-    self.utility.time_start()
     self.utility.log_info("Starting processing ChimeraX results.")
-    _results_score_file = f"{self.path_base}{OS.sep}{self.file__result_score}"
-    _results_score_file_xl = f"{self.path_base}{OS.sep}{self.file__result_score_excel}"
 
-    if not self.utility.check_path(_results_score_file):
-      self.utility.log_warning(f"Score file {_results_score_file} does not exist for processing chimerax results. Skipping...")
+    if not self.sink_exists("scores"):
+      self.utility.log_warning(f"Score table {self.sink_path('scores')} does not exist for processing chimerax results. Skipping...")
       return None
 
-    _results = PD.read_csv(_results_score_file)
-    _result_matrix = []
+    _results = self.read_result_table("scores")
+    # Complexes ChimeraX failed on are left out so that a later run can analyse them
+    _processed = self.ledger_items("collect_interactions", "done").union(self.ledger_items("run_chimerax_scripts", "failed"))
+    _result_matrix = {_col: [] for _col in ["receptor", "ligand", "conformer_id", "conformer_score", "contacts_count", "hbonds_count", "contacts", "hbonds"]}
+    _collected = []
+    _flush_rows = max(1, int(self.sink_flush_rows))
 
-    for _idx, _complex in self.utility.ProgressBar(_results.iterrows()):
-      _rec = _complex['receptor']
-      _lig = _complex['ligand']
-      __conf_id = _complex['conformer_id']
-      __conf_file = f"{_rec}--{_lig}--{__conf_id}"
-      __contacts = self.chimerax_get_contacts_residues(f"{self.path_analysis}{OS.sep}{__conf_file}.{self.ext__contacts}")
-      __hbonds = self.chimerax_get_hbonds_residues(f"{self.path_analysis}{OS.sep}{__conf_file}.{self.ext__hbonds}")
-
-      __contacts_count, __hbonds_count = 0, 0
-      if isinstance(__contacts, PD.DataFrame):
-        __contacts["residues"] =  __contacts["atom1__resname"].astype(str) + ":" + __contacts["atom1__resid"].astype(str)
-        __contacts = __contacts["residues"].tolist()
-        __contacts_count = len(__contacts)
-        __contacts = ",".join(__contacts)
-      else:
-        __contacts = ""
+    _complexes = ((_rec, _lig, _complex['conformer_id'].tolist(), _complex['conformer_score'].tolist())
+      for (_rec, _lig), _complex in _results.groupby(["receptor", "ligand"], sort=False) if f"{_rec}--{_lig}" not in _processed)
 
-      if isinstance(__hbonds, PD.DataFrame) :
-        __hbonds["residues"] =  __hbonds["donor__resname"].astype(str) + ":" + __hbonds["donor__resid"].astype(str)
-        __hbonds = __hbonds["residues"].tolist()
-        __hbonds_count = len(__hbonds)
-        __hbonds = ",".join(__hbonds)
-      else:
-        __hbonds = ""
+    _parsed = 0
+    for (_rec, _lig, _conformer_ids, _conformer_scores), _poses in self.chimerax_summarise_complexes(_complexes, self.path_analysis,
+        ext_contacts=self.ext__contacts, ext_hbonds=self.ext__hbonds):
+      for __conf_id, __conf_score, (__contacts, __hbonds) in zip(_conformer_ids, _conformer_scores, _poses):
+        self.__append_columns(_result_matrix, _rec, _lig, __conf_id, __conf_score, len(__contacts), len(__hbonds), ",".join(__contacts), ",".join(__hbonds))
 
-      _result_matrix.append({
-          "receptor": _rec,
-          "ligand": _lig,
-          "conformer_id": _complex['conformer_id'],
-          "conformer_score": _complex['conformer_score'],
-          "contacts_count": __contacts_count,
-          "hbonds_count": __hbonds_count,
-          "contacts": __contacts,
-          "hbonds": __hbonds,
-        })
+      _collected.append(f"{_rec}--{_lig}")
+      if len(_result_matrix["receptor"]) >= _flush_rows:
+        _parsed += len(_collected)
+        self.__sink_flush("interactions", "collect_interactions", _result_matrix, _collected)
+        self.utility.log_info(f"Parsed ChimeraX results of {_parsed} complex(es).")
 
-      self.utility.log_info(f"Processed {_rec}--{_lig}--{_complex['conformer_id']}.")
+    _parsed += len(_collected)
+    self.__sink_flush("interactions", "collect_interactions", _result_matrix, _collected)
+    self.__write_ranked_results('Vina Score, HBonds and Contacts')
 
-    _f2 = PD.DataFrame(_result_matrix)
-    _f2.to_csv(_results_score_file, index=False)
-    self.utility.pd_excel(_results_score_file_xl, _f2, 'Vina Score, HBonds and Contacts')
+    self.utility.log_info(f"Processed ChimeraX results of {_parsed} complex(es). Took {self.metrics_elapsed()}.")
 
-    # Ranking the complexes and writing their Ranks
+  def __write_ranked_results(self, _sheet_name):
+    """Exports the interaction table with its ranks to the CSV and Excel files once all rows are appended"""
+    _results_score_file = f"{self.path_base}{OS.sep}{self.file__result_score}"
+    _results_score_file_xl = f"{self.path_base}{OS.sep}{self.file__result_score_excel}"
 
-    _results = _f2.copy()
-    _score_columns = _results.columns
-    _attributes = ['contacts_count', 'hbonds_count', 'conformer_score']
-    # _attributes = ['contacts_count', 'conformer_score']
-    _columns = ['receptor', 'ligand']
+    if not self.sink_exists("interactions"):
+      self.utility.log_warning("No interactions to rank.")
+      return
 
-    for _col in _attributes:
-        _results[_col] = self.utility.PD.to_numeric(_results[_col], errors='coerce')
-        _results[_col] = _results[_col].fillna(_results[_col].mean())
+    _excel_rows = int(self.sink_excel_max_rows)
+    _total = self.sink_export_csv("interactions", _results_score_file)
 
-    _rank_cols = []
-    for _col in _columns:
-        for _attr in _attributes:
-            _rcol = f"rank__{_col}__{_attr}"
-            _rank_cols.append(_rcol)
-            _results[_rcol] = _results.groupby(_col)[_attr].rank(ascending=False)
+    # Ranking the complexes and writing their Ranks
+    if _total > int(self.ranking_memory_rows):
+      self.utility.log_info(f"Ranking {_total} poses partition by partition.")
+      _top_complexes, _results = self.ranking_stream("interactions", by=["receptor", "ligand"], k=1, head=_excel_rows)
+      _f2 = next(self.sink_iter("interactions"), PD.DataFrame()).head(_excel_rows)
+    else:
+      _f2 = self.read_result_table("interactions")
+      _results = self.ranking_score(_f2)
+      _top_complexes = self.ranking_top(_results, ["receptor", "ligand"], k=1)
+
+    _score_columns = _f2.columns
+    self.sink_export_excel(_results_score_file_xl, {
+      _sheet_name: _f2,
+      'Raw Ranks All Complexes': self.ranking_add_ids(_results.head(_excel_rows).copy()),
+      'Top Ranked Complexes': _top_complexes.sort_values("ranking_score", kind="stable")[_score_columns],
+    })
+    self.utility.log_info(f"Results exported to {_results_score_file} and {_results_score_file_xl}.")
+
+  def process_interactions(self, *args, **kwargs):
+    """Finds contacts and H-bonds of all docked poses with the built-in NumPy engine instead of ChimeraX"""
+    self.utility.log_info("Starting interaction analysis of docked poses.")
+
+    if not self.sink_exists("scores"):
+      self.utility.log_warning(f"Score table {self.sink_path('scores')} does not exist for interaction analysis. Skipping...")
+      return None
 
-    _results['ranking_score'] = _results[_rank_cols].sum(axis='columns')
-    _results['complex_id'] = _results[["receptor", "ligand"]].astype(str).apply("--".join, axis='columns')
-    _results['complex_uid'] = _results[["receptor", "ligand", 'conformer_id']].astype(str).apply("--".join, axis='columns')
-    _top_complexes = _results.sort_values('ranking_score', ascending=True).groupby('complex_id').head(1).reset_index(drop=True)
+    if self.path_receptor_pdbqt is None and self.dir_receptor_pdbqt:
+      self.path_receptor_pdbqt = f"{self.path_base}/{self.dir_receptor_pdbqt}"
 
-    self.utility.pd_excel(_results_score_file_xl, _results, 'Raw Ranks All Complexes')
-    self.utility.pd_excel(_results_score_file_xl, _top_complexes[_score_columns], 'Top Ranked Complexes')
+    if self.path_docking is None and self.dir_docking:
+      self.path_docking = f"{self.path_base}/{self.dir_docking}"
+
+    _results = self.read_result_table("scores")
+    _processed = self.ledger_items("collect_interactions", "done")
+    _result_matrix = {_col: [] for _col in ["receptor", "ligand", "conformer_id", "conformer_score", "contacts_count", "hbonds_count", "contacts", "hbonds"]}
+    _collected = []
+    _flush_rows = max(1, int(self.sink_flush_rows))
+    _analysed = 0
+
+    # Sorted by receptor so that each receptor is parsed and indexed once
+    for (_rec, _lig), _complex in self.utility.ProgressBar(_results.groupby(["receptor", "ligand"], sort=True)):
+      if f"{_rec}--{_lig}" in _processed:
+        continue
 
-    self.utility.log_info(f"Processed ChimeraX results and updated to {_results_score_file}.")
+      _res_file = f"{self.path_docking}{OS.sep}{_rec}--{_lig}.{self.ext__dock_result}"
+      _poses = {}
+      if self.utility.check_path(_res_file):
+        _poses = self.interactions_analyse_complex(f"{self.path_receptor_pdbqt}{OS.sep}{_rec}.pdbqt", _res_file)
 
-  def cleanup_files(self, *args, **kwargs):
-    self.utility.update_attributes(**kwargs)
+      for _conformer_id, _conformer_score in zip(_complex['conformer_id'], _complex['conformer_score']):
+        _pose = _poses.get(int(_conformer_id), {"contacts": [], "hbonds": []})
+        self.__append_columns(_result_matrix, _rec, _lig, _conformer_id, _conformer_score,
+          len(_pose["contacts"]), len(_pose["hbonds"]), ",".join(_pose["contacts"]), ",".join(_pose["hbonds"]))
+        _analysed += 1
 
-    # Check if tgz file for the directory name is present then skip the process
-    self.utility.log_info("Cleaning up the files.")
+      _collected.append(f"{_rec}--{_lig}")
+      if len(_result_matrix["receptor"]) >= _flush_rows:
+        self.__sink_flush("interactions", "collect_interactions", _result_matrix, _collected)
 
-    self.path_analysis = f"{self.path_base}/{self.dir_analysis}"
-    self.path_analysis_tgz = f"{self.path_analysis}.tgz"
+    self.__sink_flush("interactions", "collect_interactions", _result_matrix, _collected)
+    self.__write_ranked_results('Vina Score, HBonds and Contacts')
+    self.utility.log_info(f"Processed interactions of {_analysed} poses. Took {self.metrics_elapsed()}.")
 
-    _analysis_files = self.utility.find_files(self.path_analysis, [self.ext__contacts, self.ext__hbonds, self.ext__chimera_cxc])
+  def __archive_outputs(self):
+    """Moves analysis files and docking logs into indexed zip archives next to their directories, they are still read in place"""
+    if self.path_analysis is None and self.dir_analysis:
+      self.path_analysis = f"{self.path_base}/{self.dir_analysis}"
 
-    if len(_analysis_files) > 0:
-      self.utility.log_info(f"{len(_analysis_files)} files to be compressed.")
-      self.utility.add_tgz_files(self.path_analysis_tgz, _analysis_files)
+    if self.path_docking is None and self.dir_docking:
+      self.path_docking = f"{self.path_base}/{self.dir_docking}"
 
-    if self.utility.check_path(self.path_analysis_tgz):
-      self.utility.read_tgz_file(self.path_analysis_tgz)
-      _archived_files = self.utility.tgz_files
+    _packed = self.archive_pack(self.path_analysis, [f".{self.ext__contacts}", f".{self.ext__hbonds}", f".{self.ext__chimera_cxc}"])
+    self.utility.log_info(f"{_packed} analysis file(s) archived.")
 
-      self.utility.log_info(f"{len(_analysis_files)} files in {self.path_analysis_tgz} to be deleted.")
-      for _l in self.utility.ProgressBar(_analysis_files):
-        _fname = self.utility.file_name(_l, with_ext=True)
-        if _fname in _archived_files:
-          # Delete the files
-          self.utility.delete_path(_l)
+    # ext__dock_log
+    _packed = self.archive_pack(self.path_docking, [f".{self.ext__dock_log}"])
+    self.utility.log_info(f"{_packed} docking log(s) archived.")
 
-      # As directory is empty now, delete the directory
-      self.utility.delete_path(self.path_analysis)
-    else:
-      self.utility.log_error(f"{self.path_analysis_tgz} file is not present.")
+  def cleanup_files(self, *args, **kwargs):
+    self.utility.update_attributes(**kwargs)
 
-    # ext__dock_log
-    self.path_docking = f"{self.path_base}/{self.dir_docking}"
-    self.path_docking_log_tgz = f"{self.path_docking}.log.tgz"
-    _dock_files = self.utility.find_files(self.path_docking, [self.ext__dock_log])
-    if len(_dock_files) > 0:
-      self.utility.log_info(f"{len(_dock_files)} files in {self.path_docking_log_tgz} to be compressed.")
-      self.utility.add_tgz_files(self.path_docking_log_tgz, _dock_files)
+    # Outputs left by an interrupted analysis are archived here
+    self.utility.log_info("Cleaning up the files.")
+    self.__archive_outputs()
 
+    # As directory is empty now, delete the directory
+    if OS.path.isdir(self.path_analysis) and not OS.listdir(self.path_analysis):
+      self.utility.delete_path(self.path_analysis)
 
   def analyse_docking(self, *args, **kwargs):
     # return # to by pass
@@ -509,8 +719,16 @@ class VinaBase(ExecutableBase):
       self.path_analysis = self.utility.validate_dir(f"{self.path_base}/{self.dir_analysis}")
 
     self.gen_chimerax_scripts(**kwargs)
-    self.run_chimerax_scripts(**kwargs)
-    self.process_chimerax_results(**kwargs)
+
+    if self.analysis_backend == "numpy":
+      self.process_interactions(**kwargs)
+    else:
+      self.run_chimerax_scripts(**kwargs)
+      self.process_chimerax_results(**kwargs)
+
+    # Parsed analysis files and the docking logs read for the scores are archived as the stage finishes.
+    # Logs are not packed by perform_docking as queue workers may still store them in the cache.
+    self.__archive_outputs()
 
   """
   Filter results based on DL Classifiers
@@ -519,84 +737,386 @@ class VinaBase(ExecutableBase):
     ...
 
   def dock(self, *args, **kwargs):
+    """Runs one docking command writing its output to the log file, serially through the scheduler"""
     _command = args[0] if len(args) > 0 else kwargs.get("command")
     _log_file = args[1] if len(args) > 1 else kwargs.get("log_file")
 
-    _output = self.utility.cmd_run(_command)
-    try:
-      # Write single log
-      self.utility.write(_log_file, str(_output))
-    except:
-      self.utility.log_info(f"Problem occurred in processing command {_command}. File '{_log_file}' not generated.")
+    _command = SHLEX.split(_command) if isinstance(_command, str) else list(_command)
+    _task = {"name": OS.path.basename(str(_log_file)), "command": lambda _cpu: _command, "log": _log_file}
+    _summary = self.scheduler_run([_task], max_jobs=1, cpu_max=self.scheduler_total_cores)
+    if _summary["failed"]:
+      self.utility.log_info(f"Problem occurred in processing command {_command}. Check '{_log_file}'.")
 
-    return True
+    return _summary["done"] == 1
 
-  def perform_docking(self, *args, **kwargs):
-    self.utility.time_start()
+  def __maps_prefix(self, _rec_fn):
+    """Prefix of the affinity maps of a receptor, keyed on the receptor, its box and the Vina version"""
+    _rec_pdbqt = f"{self.path_receptor_pdbqt}{OS.sep}{_rec_fn}.pdbqt"
+    _config_file = f"{self.path_receptor_config}{OS.sep}{_rec_fn}.config"
+    _key = self.cache_key("vina_maps", self.cache_tool_version("vina"), {"file": _rec_pdbqt}, {"file": _config_file})[:16]
+    return f"{self.path_receptor_config}{OS.sep}{self.dir_receptor_maps}{OS.sep}{_rec_fn}.{_key}{OS.sep}{_rec_fn}"
 
-    # _docked_results = []
+  def __maps_ready(self, _prefix):
+    return OS.path.isfile(f"{_prefix}.complete")
 
-    if self.path_docking is None and self.dir_docking:
-      self.path_docking = self.utility.validate_dir(f"{self.path_base}/{self.dir_docking}")
+  def __maps_done(self, _task, _returncode, _duration):
+    _status = "failed"
+    if _returncode == 0 and any(_f.endswith(".map") for _f in OS.listdir(OS.path.dirname(_task["prefix"]))):
+      self.utility.write(f"{_task['prefix']}.complete", [f"{_duration:.2f}"])
+      _status = "done"
 
-    # @TODO: Filter rec for skipped list
-    _rec_pdbqt_path_list = self.utility.find_files(self.path_receptor_pdbqt, '.pdbqt')
+    self.ledger_mark("prepare_maps", _task["name"], _status, exit_code=_returncode, duration=_duration)
 
-    # @TODO: Filter lig for skipped list
-    _lig_pdbqt_path_list = self.utility.find_files(self.path_ligand_pdbqt, '.pdbqt')
+  def __maps_tasks(self, _receptors):
+    for _rec_fn in _receptors:
+      _prefix = self.__maps_prefix(_rec_fn)
+      if self.__maps_ready(_prefix):
+        continue
 
-    _complexes = self.utility.product([_rec_pdbqt_path_list, _lig_pdbqt_path_list]) # combination
-    _complexes_to_process = []
+      # Maps of an earlier receptor structure or box are replaced
+      _maps_dir = OS.path.dirname(_prefix)
+      _maps_root = OS.path.dirname(_maps_dir)
+      for _stale in (OS.listdir(_maps_root) if OS.path.isdir(_maps_root) else []):
+        if _stale.startswith(f"{_rec_fn}.") and _stale != OS.path.basename(_maps_dir):
+          SHUTIL.rmtree(f"{_maps_root}{OS.sep}{_stale}", ignore_errors=True)
+      OS.makedirs(_maps_dir, exist_ok=True)
+
+      def _command(_cpu, _rec_fn=_rec_fn, _prefix=_prefix):
+        return ['vina',
+            "--cpu", str(_cpu),
+            "--receptor", f"{self.path_receptor_pdbqt}{OS.sep}{_rec_fn}.pdbqt",
+            "--config", f"{self.path_receptor_config}{OS.sep}{_rec_fn}.config",
+            "--write_maps", _prefix,
+            "--force_even_voxels",
+          ]
 
-    total_complexes = 0
-    for _rec, _lig in _complexes:
-      total_complexes += 1
-      _rec_fn = self.utility.filename(_rec)
-      _lig_fn = self.utility.filename(_lig)
-      _comp = _rec_fn.strip() + "--" + _lig_fn.strip()
-      _res_file = f"{self.path_docking}{OS.sep}{_comp}.{self.ext__dock_result}"
-      _log_file = f"{self.path_docking}{OS.sep}{_comp}.{self.ext__dock_log}"
+      self.ledger_mark("prepare_maps", _rec_fn, "running")
+      yield {"name": _rec_fn, "command": _command, "log": f"{_prefix}.log", "prefix": _prefix}
 
-      if not all((self.utility.check_path(_res_file), self.utility.check_path(_log_file))):
-        _complexes_to_process.append((_rec, _lig, _comp, _res_file))
+  def prepare_maps(self, *args, **kwargs):
+    """Precomputes Vina affinity maps per receptor and box so that docking reads them instead of rebuilding them
 
-    if self.multiprocess:
-      self.utility.log_info(f"Adding remaining {len(_complexes_to_process)}/{total_complexes} complex(s) to multiprocess queue.")
-    else:
-      self.utility.log_info(f"Processing remaining {len(_complexes_to_process)}/{total_complexes} complex(s).")
-
-    for _rec, _lig, _comp, _res_file in self.utility.ProgressBar(_complexes_to_process):
-      _log_file = self.utility.change_ext(_res_file, "log")
-      _config_file = f"{self.path_receptor_config}{OS.sep}{self.utility.filename(_rec)}.config"
-      _rec_pdbqt = f"{self.path_receptor_pdbqt}{OS.sep}{self.utility.filename(_rec)}.pdbqt"
-      if not self.utility.check_path(_config_file):
-        self.utility.log_info(f"Config file '{_config_file}' for the receptor '{self.utility.filename(_rec)}' is missing.")
+    Maps are written under the receptor config directory. Concurrent jobs of one receptor read the same
+    files, which are shared through the page cache.
+    """
+    if not self.vina_maps:
+      return
+
+    if self.path_receptor_config is None and self.dir_receptor_config:
+      self.path_receptor_config = self.utility.validate_dir(f"{self.path_base}/{self.dir_receptor_config}")
+
+    _receptors = sorted(self.__scan_names(self.path_receptor_pdbqt, ".pdbqt").intersection(self.__scan_names(self.path_receptor_config, ".config")))
+    self.utility.log_info(f"Precomputing affinity maps of {len(_receptors)} receptor(s).")
+
+    _summary = self.scheduler_run(self.__maps_tasks(_receptors), callback=self.__maps_done, stage="prepare_maps", total=len(_receptors))
+    self.utility.log_info(f"{_summary['done']} receptor map set(s) written, {_summary['failed']} failed, others are up to date.")
+
+  def __vina_config_args(self, _config_file):
+    """Settings of a receptor config as Vina arguments for docking against maps"""
+    _args = []
+    with open(_config_file, "r", encoding="utf8") as _fh:
+      for _line in _fh:
+        _key, _, _value = _line.partition("=")
+        _key, _value = _key.strip(), _value.strip()
+        # Box comes from the maps, the others are set on the command line and may not repeat
+        if _key and _value and not _key.startswith(("center_", "size_")) and _key not in ("cpu", "exhaustiveness", "out", "log"):
+          _args.extend([f"--{_key}", _value])
+
+    return _args
+
+  def __docking_cache_key(self, _rec_pdbqt, _lig, _config_file):
+    return self.cache_key("vina", self.cache_tool_version("vina"),
+      {"file": _rec_pdbqt}, {"file": _lig}, {"file": _config_file},
+      {"exhaustiveness": self.vina_exhaustiveness})
+
+  def __ledger_adopt_docked(self):
+    """A project without ledger records adopts result files of earlier runs once"""
+    _stage = "perform_docking"
+    if self.ledger_count(_stage):
+      return
+
+    _results = self.__scan_names(self.path_docking, f".{self.ext__dock_result}")
+    _adopted = list(_results.intersection(self.__scan_names(self.path_docking, f".{self.ext__dock_log}")))
+    if _adopted:
+      self.ledger_mark(_stage, _adopted, "done", message="adopted")
+      self.utility.log_info(f"{len(_adopted)} docked complex(es) found on disk recorded to the job ledger.")
+
+  def __docking_done(self, _task, _returncode, _duration):
+    if _returncode == 0 and _task.get("cache_key"):
+      self.cache_store(_task["cache_key"], {"result.pdbqt": _task["result"], "result.log": _task["log"]})
+
+    _status = "done" if _returncode == 0 and self.utility.check_path(_task["result"]) else "failed"
+    self.ledger_mark("perform_docking", _task["name"], _status, exit_code=_returncode, duration=_duration)
+
+  def __docking_resolve(self, _complex, _configs, _maps):
+    """(status, member) of one complex, a complex without config or restored from cache is settled here without a member
+
+    `_configs` are the receptors having a config, `_maps` caches the map inputs per receptor between calls.
+    """
+    _rec_pdbqt, _lig, _rec_fn, _lig_fn, _comp = _complex
+    _res_file = f"{self.path_docking}{OS.sep}{_comp}.{self.ext__dock_result}"
+    _log_file = f"{self.path_docking}{OS.sep}{_comp}.{self.ext__dock_log}"
+    _config_file = f"{self.path_receptor_config}{OS.sep}{_rec_fn}.config"
+    if _rec_fn not in _configs:
+      self.utility.log_info(f"Config file '{_config_file}' for the receptor '{_rec_fn}' is missing.")
+      self.ledger_mark("perform_docking", _comp, "failed", message="missing config")
+      return "failed", None
+
+    _cache_key = None
+    if self.cache_enabled:
+      _cache_key = self.__docking_cache_key(_rec_pdbqt, _lig, _config_file)
+      if self.cache_fetch(_cache_key, {"result.pdbqt": _res_file, "result.log": _log_file}):
+        self.utility.log_info(f"{_comp} restored from cache.")
+        self.ledger_mark("perform_docking", _comp, "done", message="cache")
+        return "done", None
+
+    if self.vina_maps and _rec_fn not in _maps:
+      _prefix = self.__maps_prefix(_rec_fn)
+      _maps[_rec_fn] = (_prefix, self.__vina_config_args(_config_file)) if self.__maps_ready(_prefix) else None
+
+    _inputs = ["--receptor", _rec_pdbqt, "--config", _config_file]
+    if self.vina_maps and _maps[_rec_fn]:
+      _inputs = ["--maps", _maps[_rec_fn][0], *_maps[_rec_fn][1]]
+
+    return "pending", {"name": _comp, "receptor": _rec_fn, "ligand": _lig, "ligand_name": _lig_fn, "inputs": _inputs,
+      "result": _res_file, "log": _log_file, "cache_key": _cache_key}
+
+  def __docking_pending(self, _complexes_to_process):
+    """Yields complexes to dock with their Vina inputs, complexes without config or restored from cache are settled here"""
+    _configs = self.__scan_names(self.path_receptor_config, ".config")
+    _maps = {}
+    for _complex in _complexes_to_process:
+      _status, _member = self.__docking_resolve(_complex, _configs, _maps)
+      if _member is not None:
+        yield _member
+
+  def __docking_task(self, _task):
+    """Adds the Vina command to a member, the --cpu is chosen by the scheduler"""
+    def _command(_cpu, _task=_task):
+      return ['vina',
+          "--cpu", str(_cpu),
+          *_task["inputs"],
+          "--ligand", _task["ligand"],
+          "--exhaustiveness", str(self.vina_exhaustiveness),
+          "--out", _task["result"],
+          "--verbosity", "2",
+        ]
+
+    self.ledger_mark("perform_docking", _task["name"], "running")
+    _task["command"] = _command
+    return _task
+
+  def __docking_tasks(self, _complexes_to_process):
+    """Yields scheduler tasks lazily"""
+    for _task in self.__docking_pending(_complexes_to_process):
+      yield self.__docking_task(_task)
+
+  def __write_score_log(self, _log_file, _scores):
+    """Vina style result table of a complex docked in a batch, readable by read_vina_scores"""
+    _lines = [
+      "mode |   affinity | dist from best mode",
+      "     | (kcal/mol) | rmsd l.b.| rmsd u.b.",
+      "-----+------------+----------+----------",
+    ]
+    _lines.extend([f"{_mode:>4d} {_affinity:>12.3f} {_lb:>10.3f} {_ub:>10.3f}" for _mode, _affinity, _lb, _ub in _scores])
+    self.utility.write(_log_file, _lines)
+
+  def __docking_batch_done(self, _task, _returncode, _duration):
+    """Maps `<ligand>_out.pdbqt` of a Vina batch back to `<receptor>--<ligand>.result.pdbqt` with its log"""
+    _message = None
+    if _returncode != 0 and OS.path.isfile(_task["log"]):
+      with open(_task["log"], "r", errors="replace") as _fh:
+        _message = _fh.read()[-1000:]
+
+    _done, _failed = [], []
+    for _member in _task["members"]:
+      _out_file = f"{_task['dir']}{OS.sep}{_member['ligand_name']}_out.pdbqt"
+      _scores = self.read_vina_scores(_out_file) if OS.path.isfile(_out_file) else []
+      if not _scores:
+        _failed.append(_member["name"])
         continue
 
-      _command = ['vina',
-            "--cpu", "4",
-            "--receptor", _rec_pdbqt,
-            "--config", _config_file,
-            "--ligand", _lig,
-            "--exhaustiveness", "32",
-            "--out", _res_file,
+      OS.replace(_out_file, _member["result"])
+      self.__write_score_log(_member["log"], _scores)
+      if _member.get("cache_key"):
+        self.cache_store(_member["cache_key"], {"result.pdbqt": _member["result"], "result.log": _member["log"]})
+      _done.append(_member["name"])
+
+    _each = _duration / max(1, len(_task["members"]))
+    self.ledger_mark("perform_docking", _done, "done", exit_code=_returncode, duration=_each)
+    self.ledger_mark("perform_docking", _failed, "failed", exit_code=_returncode, duration=_each, message=_message or "no output")
+    SHUTIL.rmtree(_task["dir"], ignore_errors=True)
+
+  def __docking_batch_tasks(self, _complexes_to_process):
+    """Groups pending ligands of a receptor into chunks docked by one Vina process with --batch"""
+    _batch_size = max(1, int(self.vina_batch_size))
+    _chunk = []
+    _count = 0
+
+    def _task(_members, _count):
+      _dir = f"{self.path_docking}{OS.sep}.batch-{_members[0]['receptor']}-{OS.getpid()}-{_count}"
+      SHUTIL.rmtree(_dir, ignore_errors=True)
+      OS.makedirs(_dir)
+
+      def _command(_cpu, _members=_members, _dir=_dir):
+        return ['vina',
+            "--cpu", str(_cpu),
+            *_members[0]["inputs"],
+            *[_arg for _member in _members for _arg in ("--batch", _member["ligand"])],
+            "--dir", _dir,
+            "--exhaustiveness", str(self.vina_exhaustiveness),
             "--verbosity", "2",
-            # "--log", f"{self.path_docking}{OS.sep}{result_file}.result.log"
           ]
-      if self.multiprocess:
-        _process = self.utility.multiprocess_add(self.dock, args=(_command, _log_file))
-      else:
-        self.dock(_command, _log_file)
 
-    if self.multiprocess:
-      self.utility.multiprocess_start()
+      self.ledger_mark("perform_docking", [_member["name"] for _member in _members], "running")
+      return {"name": f"{_members[0]['receptor']} batch of {len(_members)}", "command": _command,
+        "log": f"{_dir}{OS.sep}batch.log", "dir": _dir, "members": _members}
+
+    for _member in self.__docking_pending(_complexes_to_process):
+      if _chunk and (_chunk[0]["receptor"] != _member["receptor"] or len(_chunk) >= _batch_size):
+        _count += 1
+        yield _task(_chunk, _count)
+        _chunk = []
+      _chunk.append(_member)
+
+    if _chunk:
+      yield _task(_chunk, _count + 1)
+
+  def __docking_queue_tasks(self, _claims, _configs, _maps):
+    """Docking tasks of items claimed from the shared queue, outputs go to files of this worker until committed"""
+    while True:
+      _claimed = self.queue_claim("perform_docking", 1)
+      if not _claimed:
+        return
+
+      _item, _payload = _claimed[0]
+      _status, _member = self.__docking_resolve(tuple(_payload), _configs, _maps)
+      _claims["count"] += 1
+      if _member is None:
+        # Settled without docking, restored from the cache or missing its config
+        self.queue_complete("perform_docking", _item, _status)
+        continue
 
-    self.utility.log_info(f"Completed the docking process. Took {self.utility.time_elapsed()}.")
+      _task = self.__docking_task(_member)
+      _task["final"] = (_task["result"], _task["log"])
+      _task["result"] = f"{_task['result']}.{self.queue_owner}.part"
+      _task["log"] = f"{_task['log']}.{self.queue_owner}.part"
+      yield _task
+
+  def __docking_queue_done(self, _task, _returncode, _duration):
+    _status = "done" if _returncode == 0 and OS.path.isfile(_task["result"]) else "failed"
+    _parts = (_task["result"], _task["log"])
+
+    def _publish():
+      for _part, _final in zip(_parts, _task["final"]):
+        if OS.path.isfile(_part):
+          OS.replace(_part, _final)
+        # Leftovers of crashed workers which held the lease before
+        for _stale in GLOB.glob(f"{GLOB.escape(_final)}.*.part"):
+          OS.remove(_stale)
+
+    # Only the current lease holder publishes its outputs, before the item is committed so that a crash in
+    # between leaves the item leased, a worker whose lease was taken over discards them
+    if self.queue_complete("perform_docking", _task["name"], _status, message=None if _returncode is None else f"Exit code {_returncode}.", publish=_publish):
+      _task["result"], _task["log"] = _task["final"]
+      self.__docking_done(_task, _returncode, _duration)
+    else:
+      self.utility.log_warning(f"Lease of {_task['name']} was taken over by another worker, discarding its results.")
+      for _part in _parts:
+        if OS.path.isfile(_part):
+          OS.remove(_part)
+
+  def __docking_distributed(self, _complexes_to_process):
+    """Docks complexes claimed from the queue in the project database together with workers on other nodes
+
+    The submitting node queues the pending complexes, items already queued are left as they are unless the
+    ledger lacks them as done. Queue workers only claim, they wait until the complexes are queued. Leases
+    are renewed by a heartbeat, so items of crashed workers return to the queue after queue_lease seconds.
+    """
+    if self.queue_worker:
+      if not self.queue_count("perform_docking"):
+        self.utility.log_info(f"Waiting for the submitting node to queue the complexes of {self.path_base}.")
+      while not self.queue_count("perform_docking"):
+        TIME.sleep(float(self.queue_poll_interval))
+    else:
+      _added = self.queue_submit("perform_docking", ((_c[4], list(_c)) for _c in _complexes_to_process))
+      self.utility.log_info(f"{_added} complex(es) added to the work queue as {self.queue_owner}, {self.queue_count('perform_docking')}.")
 
-    del _rec_pdbqt_path_list
-    del _lig_pdbqt_path_list
-    del _complexes
-    del _complexes_to_process
+    if int(self.vina_batch_size or 0) > 0:
+      self.utility.log_warning("Vina batch mode is not used with the work queue, complexes are claimed one by one.")
+
+    _claims = {"count": 0}
+    _configs, _maps = self.__scan_names(self.path_receptor_config, ".config"), {}
+    self.queue_heartbeat_start()
+    try:
+      while True:
+        _tasks = self.__docking_queue_tasks(_claims, _configs, _maps)
+        if self.multiprocess:
+          self.scheduler_run(_tasks, callback=self.__docking_queue_done, stage="perform_docking")
+        else:
+          self.scheduler_run(_tasks, callback=self.__docking_queue_done, max_jobs=1, cpu_max=self.scheduler_total_cores, stage="perform_docking")
+
+        # Items leased by other workers are claimable here once their lease expires
+        _counts = self.queue_count("perform_docking")
+        if not _counts.get("pending", 0) and not _counts.get("leased", 0):
+          break
+        TIME.sleep(float(self.queue_poll_interval))
+    finally:
+      self.queue_heartbeat_stop()
+      self.queue_release()
+
+    self.utility.log_info(f"{_claims['count']} complex(es) claimed by {self.queue_owner}, queue {self.queue_count('perform_docking')}.")
+
+  def perform_docking(self, *args, **kwargs):
+
+    # _docked_results = []
+
+    if self.path_docking is None and self.dir_docking:
+      self.path_docking = self.utility.validate_dir(f"{self.path_base}/{self.dir_docking}")
+
+    # Queue workers run this stage alone
+    for _attr in ["receptor_pdbqt", "ligand_pdbqt", "receptor_config"]:
+      if getattr(self, f"path_{_attr}") is None and getattr(self, f"dir_{_attr}"):
+        setattr(self, f"path_{_attr}", f"{self.path_base}/{getattr(self, f'dir_{_attr}')}")
+
+    if self.queue_worker:
+      self.__docking_distributed(())
+      self.utility.log_info(f"Docking status: {self.ledger_count('perform_docking')}.")
+      self.cache_evict()
+      return
+
+    self.__ledger_adopt_docked()
+
+    # Done complexes are looked up per receptor to keep memory bounded by the ligand library
+    _complexes_to_process = self.__iter_complexes(lambda _rec_fn: self.ledger_items("perform_docking", "done", prefix=f"{_rec_fn}--"))
+    _docked = self.ledger_count("perform_docking").get("done", 0)
+
+    if self.queue_enabled:
+      self.__docking_distributed(_complexes_to_process)
+      self.utility.log_info(f"Docking status: {self.ledger_count('perform_docking')}.")
+      self.cache_evict()
+      return
+
+    # Upper bound for the ETA, complexes restored from the cache or without config are not scheduled
+    _total = len(self.__scan_names(self.path_receptor_pdbqt, ".pdbqt")) * len(self.__scan_names(self.path_ligand_pdbqt, ".pdbqt"))
+    _total = max(0, _total - _docked)
+    _tasks, _callback = self.__docking_tasks(_complexes_to_process), self.__docking_done
+    if int(self.vina_batch_size or 0) > 0:
+      # Ligands of a receptor in chunks, one Vina process per chunk
+      _tasks, _callback, _total = self.__docking_batch_tasks(_complexes_to_process), self.__docking_batch_done, None
+
+    if self.multiprocess:
+      self.utility.log_info(f"Scheduling remaining complex(s), {_docked} already docked, on {self.scheduler_total_cores} core(s).")
+      self.scheduler_run(_tasks, callback=_callback, total=_total, stage="perform_docking")
+    else:
+      # One job at a time using all the cores
+      self.utility.log_info(f"Processing remaining complex(s), {_docked} already docked.")
+      self.scheduler_run(_tasks, callback=_callback, max_jobs=1, cpu_max=self.scheduler_total_cores, total=_total, stage="perform_docking")
+
+    _counts = self.ledger_count("perform_docking")
+    self.utility.log_info(f"{_counts.get('done', 0) - _docked} complex(es) docked, {_counts.get('failed', 0)} failed.")
+    self.cache_evict()
+    self.utility.log_info(f"Completed the docking process. Took {self.metrics_elapsed()}.")
 
   def prepare_dynamics(self, *args, **kwargs):
     pass
@@ -604,16 +1124,31 @@ class VinaBase(ExecutableBase):
   def add(self, *args, **kwargs):
     self.utility.update_attributes(self, kwargs)
 
+  def run_stages(self):
+    """Stages to run, all by default. Queue workers only dock, the submitting node prepares, analyses and exports"""
+    _processes = self.processes or self.__defaults["processes"]
+    _processes = [_processes] if isinstance(_processes, str) else list(_processes)
+    if self.queue_worker:
+      _skipped = [_process for _process in _processes if _process != "perform_docking"]
+      if _skipped and self.processes:
+        self.utility.log_warning(f"Queue workers only run perform_docking, skipping {', '.join(_skipped)}.")
+      _processes = ["perform_docking"]
+
+    return _processes
+
   def run(self, *args, **kwargs):
     """Run all options from the given settings."""
-    _start_time = self.utility.time_get()
-    self.utility.log_info("Starting %s." % " -> ".join(self.processes))
+    _processes = self.run_stages()
+    self.utility.log_info("Starting %s." % " -> ".join(_processes))
     _result = {}
-    for _process in self.processes:
-      _method = getattr(self, _process, None)
-      if hasattr(_method, '__call__'):
-        _result[_process] = _method(**kwargs)
-      else:
-        self.utility.log_error(f"{_method} is not callable.")
+    with self.metrics_stage("run", profile=False):
+      for _process in _processes:
+        _method = getattr(self, _process, None)
+        if hasattr(_method, '__call__'):
+          with self.metrics_stage(_process) as _stage:
+            _result[_process] = _method(**kwargs)
+          self.utility.log_info(f"Completed {_process} in {_stage['wall']:.2f}s, {_stage['cpu']:.2f}s CPU.")
+        else:
+          self.utility.log_error(f"{_method} is not callable.")
     self.utility.log_info(f"Completed all the processes.")
     return _result
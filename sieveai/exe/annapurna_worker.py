@@ -0,0 +1,88 @@
+"""Long-lived AnnapuRNA worker, started in the AnnapuRNA environment by `AnnapuRNA.rescoring_AnnapuRNA`
+
+Usage: python -u annapurna_worker.py path/to/annapurna.py [entry]
+
+annapurna.py is loaded once as a module, with AnnapuRNA and its dependencies. Requests are read from
+stdin as JSON lines `{"id": ..., "argv": [...]}` and each one calls the `entry` function of the module
+(main by default) with sys.argv set to the given arguments. A script without that function is run again
+as __main__ per request. One JSON line `{"id": ..., "status": "done"|"failed", "message": ..., "duration": ...}`
+is written back per request, after a first `{"ready": true}` line. Anything else printed goes to stderr.
+
+Only the standard library is used as the AnnapuRNA environment does not have SieveAI installed.
+"""
+
+import os as OS
+import sys as SYS
+import json as JSON
+import time as TIME
+import runpy as RUNPY
+import traceback as TRACEBACK
+import importlib.util as IMPORTLIB_UTIL
+
+def _send(_protocol, _message):
+  _protocol.write(JSON.dumps(_message) + "\n")
+  _protocol.flush()
+
+def _run(_annapurna_path, _entry):
+  """Runs one request, returns (status, message)"""
+  _returned = None
+  try:
+    if _entry is not None:
+      _returned = _entry()
+    else:
+      RUNPY.run_path(_annapurna_path, run_name="__main__")
+  except SystemExit as _e:
+    _returned = _e.code
+  except Exception as _e:
+    TRACEBACK.print_exc()
+    return "failed", repr(_e)
+
+  if _returned not in (None, 0):
+    return "failed", f"Exited with {_returned}."
+  return "done", None
+
+def main():
+  _annapurna_path = OS.path.abspath(OS.path.expanduser(SYS.argv[1]))
+  _entry_name = SYS.argv[2] if len(SYS.argv) > 2 else "main"
+
+  # The protocol keeps the original stdout, output of AnnapuRNA and its libraries goes to stderr
+  _protocol = OS.fdopen(OS.dup(1), "w", encoding="utf8")
+  OS.dup2(2, 1)
+  SYS.stdout = SYS.stderr
+
+  SYS.path.insert(0, OS.path.dirname(_annapurna_path))
+  SYS.argv = [_annapurna_path]
+  try:
+    # Module level imports (models, numerical libraries) are loaded once for all requests
+    _spec = IMPORTLIB_UTIL.spec_from_file_location("annapurna", _annapurna_path)
+    _module = IMPORTLIB_UTIL.module_from_spec(_spec)
+    SYS.modules["annapurna"] = _module
+    _spec.loader.exec_module(_module)
+  except SystemExit:
+    pass
+  except Exception as _e:
+    TRACEBACK.print_exc()
+    _send(_protocol, {"ready": False, "message": repr(_e)})
+    return 1
+
+  _entry = getattr(_module, _entry_name, None)
+  _entry = _entry if callable(_entry) else None
+  if _entry is None:
+    print(f"{_annapurna_path} has no {_entry_name}(), it is run again for every request.", file=SYS.stderr)
+
+  _send(_protocol, {"ready": True, "pid": OS.getpid(), "entry": _entry_name if _entry is not None else None})
+
+  for _line in SYS.stdin:
+    if not _line.strip():
+      continue
+
+    _request = JSON.loads(_line)
+    _start = TIME.time()
+    SYS.argv = [_annapurna_path, *_request.get("argv", [])]
+    _status, _message = _run(_annapurna_path, _entry)
+    _send(_protocol, {"id": _request.get("id"), "status": _status, "message": _message, "duration": TIME.time() - _start})
+
+  return 0
+
+if __name__ == "__main__":
+  SYS.exit(main())
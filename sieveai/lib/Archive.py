@@ -0,0 +1,242 @@
+import os as OS
+import json as JSON
+import zlib as ZLIB
+import shutil as SHUTIL
+import zipfile as ZIPFILE
+import threading as THREADING
+from concurrent.futures import ThreadPoolExecutor
+
+from .Metrics import Metrics
+
+_ARCHIVE_MANIFEST = "manifest.json"
+_ARCHIVE_HANDLES = {}
+_ARCHIVE_MANIFESTS = {}
+_ARCHIVE_LOCK = THREADING.Lock()
+
+def _archive_dir(_dir_path):
+  return f"{OS.path.normpath(_dir_path)}.archive"
+
+def _archive_shard(_name, _shards):
+  """Members are placed by a stable hash of their name so that a lookup opens a single shard"""
+  return ZLIB.crc32(_name.encode("utf8")) % _shards
+
+def _archive_manifest(_archive_path):
+  """Manifest of an archive, kept once read as it does not change after the archive is created"""
+  if _archive_path in _ARCHIVE_MANIFESTS:
+    return _ARCHIVE_MANIFESTS[_archive_path]
+
+  _manifest_path = OS.path.join(_archive_path, _ARCHIVE_MANIFEST)
+  if not OS.path.isfile(_manifest_path):
+    return None
+
+  with open(_manifest_path, "r", encoding="utf8") as _fh:
+    _ARCHIVE_MANIFESTS[_archive_path] = JSON.load(_fh)
+
+  return _ARCHIVE_MANIFESTS[_archive_path]
+
+def _archive_handle(_shard_path):
+  """Zip handle of a shard opened once per process, reopened when the shard was replaced by a new generation"""
+  _stat = OS.stat(_shard_path)
+  _generation = (_stat.st_ino, _stat.st_mtime_ns)
+  with _ARCHIVE_LOCK:
+    _handle = _ARCHIVE_HANDLES.get(_shard_path)
+    if _handle is None or _handle[0] != _generation:
+      if _handle is not None:
+        _handle[1].close()
+      _handle = (_generation, ZIPFILE.ZipFile(_shard_path, "r"), THREADING.Lock())
+      _ARCHIVE_HANDLES[_shard_path] = _handle
+
+  return _handle
+
+def _archive_member(_file_path):
+  """(shard path, member name) of a file of an archived directory, None if the directory has no archive"""
+  _dir_path, _name = OS.path.split(OS.path.normpath(_file_path))
+  _archive_path = _archive_dir(_dir_path)
+  _manifest = _archive_manifest(_archive_path)
+  if _manifest is None:
+    return None
+
+  _shard_path = OS.path.join(_archive_path, f"shard-{_archive_shard(_name, _manifest['shards']):03d}.zip")
+  return (_shard_path, _name) if OS.path.isfile(_shard_path) else None
+
+def _archive_read(_file_path, _binary=False):
+  """Content of a file from disk or, once packed, from its directory archive. None if it exists in neither"""
+  if OS.path.isfile(_file_path):
+    with open(_file_path, "rb" if _binary else "r", **({} if _binary else {"encoding": "utf8", "errors": "replace"})) as _fh:
+      return _fh.read()
+
+  _member = _archive_member(_file_path)
+  if _member is None:
+    return None
+
+  _generation, _zip, _lock = _archive_handle(_member[0])
+  with _lock:
+    try:
+      _content = _zip.read(_member[1])
+    except KeyError:
+      return None
+
+  return _content if _binary else _content.decode("utf8", errors="replace")
+
+def _archive_crc(_file_path):
+  _crc = 0
+  with open(_file_path, "rb") as _fh:
+    for _chunk in iter(lambda: _fh.read(1048576), b""):
+      _crc = ZLIB.crc32(_chunk, _crc)
+  return _crc
+
+def _archive_members(_shard_path):
+  """{name: (CRC-32, size)} of the central directory of a shard, empty if it does not exist"""
+  if not OS.path.isfile(_shard_path):
+    return {}
+
+  with ZIPFILE.ZipFile(_shard_path, "r") as _zip:
+    return {_info.filename: (_info.CRC, _info.file_size) for _info in _zip.infolist()}
+
+def _archive_pack_shard(_shard_path, _files, _compresslevel):
+  """Adds files to one shard, returns the files whose member matches them by CRC-32 and size and the number of stale members
+
+  New names are appended, members of the same name with other content are stale and left out. The next
+  generation of the shard is written to a temporary file and synced before it replaces the shard, so that
+  a crash while packing leaves the previous generation and the files intact.
+  """
+  _expected = {OS.path.basename(_file_path): (_archive_crc(_file_path), OS.path.getsize(_file_path)) for _file_path in _files}
+  _members = _archive_members(_shard_path)
+  _stale = {_name for _name, _member in _members.items() if _name in _expected and _member != _expected[_name]}
+  _write = [_file_path for _file_path in _files if OS.path.basename(_file_path) not in _members or OS.path.basename(_file_path) in _stale]
+
+  if _write:
+    _temp = f"{_shard_path}.tmp"
+    if _stale:
+      with ZIPFILE.ZipFile(_shard_path, "r") as _old, ZIPFILE.ZipFile(_temp, "w", ZIPFILE.ZIP_DEFLATED, compresslevel=_compresslevel) as _zip:
+        for _info in _old.infolist():
+          if _info.filename not in _stale:
+            _zip.writestr(_info, _old.read(_info))
+        for _file_path in _write:
+          _zip.write(_file_path, OS.path.basename(_file_path))
+    else:
+      # Members are copied as they are, only the new files are compressed
+      if _members:
+        SHUTIL.copyfile(_shard_path, _temp)
+      elif OS.path.isfile(_temp):
+        OS.remove(_temp)
+      with ZIPFILE.ZipFile(_temp, "a", ZIPFILE.ZIP_DEFLATED, compresslevel=_compresslevel) as _zip:
+        for _file_path in _write:
+          _zip.write(_file_path, OS.path.basename(_file_path))
+
+    with open(_temp, "rb") as _fh:
+      OS.fsync(_fh.fileno())
+    OS.replace(_temp, _shard_path)
+
+  # A file changed while it was packed does not match its member and is kept
+  _members = _archive_members(_shard_path)
+  return [_file_path for _file_path in _files if _members.get(OS.path.basename(_file_path)) == _expected[OS.path.basename(_file_path)]], len(_stale)
+
+class Archive(Metrics):
+  def __init__(self, *args, **kwargs):
+    super(Archive, self).__init__(**kwargs)
+    self.__update_attr(*args, **kwargs)
+
+  def __update_attr(self, *args, **kwargs):
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "archive_shards": 16, # Fixed for an archive once it is created
+        "archive_workers": None, # All logical cores by default
+        "archive_compresslevel": 6,
+      }
+
+    # Set all defaults
+    [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
+    self.__defaults = dict() # Unset defaults to prevent running for second time
+    [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  def archive_read(self, *args, **kwargs):
+    """Reads a file in place, from disk or from the archive of its directory"""
+    _file_path = args[0] if len(args) > 0 else kwargs.get("file_path")
+    return _archive_read(_file_path, kwargs.get("binary", False))
+
+  def archive_exists(self, *args, **kwargs):
+    _file_path = args[0] if len(args) > 0 else kwargs.get("file_path")
+    if OS.path.isfile(_file_path):
+      return True
+
+    _member = _archive_member(_file_path)
+    if _member is None:
+      return False
+
+    _generation, _zip, _lock = _archive_handle(_member[0])
+    return _member[1] in _zip.NameToInfo
+
+  def archive_names(self, *args, **kwargs):
+    """Names of the archived members of a directory ending with the suffix, suffix removed"""
+    _dir_path = args[0] if len(args) > 0 else kwargs.get("dir_path")
+    _suffix = args[1] if len(args) > 1 else kwargs.get("suffix", "")
+
+    _archive_path = _archive_dir(_dir_path)
+    _manifest = _archive_manifest(_archive_path)
+    if _manifest is None:
+      return set()
+
+    _names = set()
+    for _shard in range(_manifest["shards"]):
+      _shard_path = OS.path.join(_archive_path, f"shard-{_shard:03d}.zip")
+      if OS.path.isfile(_shard_path):
+        _names.update(_archive_handle(_shard_path)[1].NameToInfo.keys())
+
+    return {_name[:len(_name) - len(_suffix)] for _name in _names if _name.endswith(_suffix)}
+
+  def archive_pack(self, *args, **kwargs):
+    """Moves files of a directory ending with any of `suffixes` into its sharded zip archive
+
+    Shards are compressed in parallel and each file is deleted once the CRC-32 and size of its member
+    in the central directory of the new shard match the file. Packing again adds to the same archive, a
+    file packed again with other content replaces its member.
+    """
+    _dir_path = args[0] if len(args) > 0 else kwargs.get("dir_path")
+    _suffixes = tuple(args[1] if len(args) > 1 else kwargs.get("suffixes", ("",)))
+    _delete = kwargs.get("delete", True)
+
+    if not _dir_path or not OS.path.isdir(_dir_path):
+      return 0
+
+    _archive_path = _archive_dir(_dir_path)
+    _manifest = _archive_manifest(_archive_path)
+    if _manifest is None:
+      OS.makedirs(_archive_path, exist_ok=True)
+      _manifest = {"shards": int(self.archive_shards), "format": "zip"}
+      with open(OS.path.join(_archive_path, _ARCHIVE_MANIFEST), "w", encoding="utf8") as _fh:
+        JSON.dump(_manifest, _fh)
+
+    _shards = {}
+    with OS.scandir(_dir_path) as _entries:
+      for _entry in _entries:
+        if _entry.is_file() and _entry.name.endswith(_suffixes):
+          _shards.setdefault(_archive_shard(_entry.name, _manifest["shards"]), []).append(_entry.path)
+
+    if not _shards:
+      return 0
+
+    _total = sum(len(_files) for _files in _shards.values())
+    _workers = max(1, min(len(_shards), int(self.archive_workers or OS.cpu_count() or 1)))
+    self.utility.log_info(f"Packing {_total} file(s) of {_dir_path} into {len(_shards)} shard(s) of {_archive_path}.")
+
+    # zlib releases the GIL so that shards are compressed in parallel by threads
+    _packed, _replaced = [], 0
+    with ThreadPoolExecutor(max_workers=_workers) as _executor:
+      _futures = [_executor.submit(_archive_pack_shard, OS.path.join(_archive_path, f"shard-{_shard:03d}.zip"), _files, int(self.archive_compresslevel))
+        for _shard, _files in _shards.items()]
+      for _future in _futures:
+        _verified, _stale = _future.result()
+        _packed.extend(_verified)
+        _replaced += _stale
+
+    if _replaced:
+      self.utility.log_info(f"{_replaced} stale member(s) of {_archive_path} replaced by the files packed again.")
+
+    if len(_packed) != _total:
+      self.utility.log_error(f"{_total - len(_packed)} file(s) of {_dir_path} could not be verified in the archive and are kept.")
+
+    if _delete:
+      for _file_path in _packed:
+        OS.remove(_file_path)
+
+    return len(_packed)
@@ -0,0 +1,168 @@
+import os as OS
+import json as JSON
+import time as TIME
+import shutil as SHUTIL
+import hashlib as HASHLIB
+import subprocess as SUBPROCESS
+
+from .Scheduler import Scheduler
+
+class ArtifactCache(Scheduler):
+  def __init__(self, *args, **kwargs):
+    super(ArtifactCache, self).__init__(**kwargs)
+    self.__update_attr(*args, **kwargs)
+    self.__file_hashes = {}
+    self.__tool_versions = {}
+
+  def __update_attr(self, *args, **kwargs):
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "cache_dir": None, # Caching is disabled unless a directory is given
+        "cache_max_size": 50 * 1024, # MB
+      }
+
+    # Set all defaults
+    [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
+    self.__defaults = dict() # Unset defaults to prevent running for second time
+    [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  @property
+  def cache_enabled(self):
+    return bool(self.cache_dir)
+
+  def cache_file_hash(self, *args, **kwargs):
+    """SHA-256 of a file's content, memoised on path, size and modification time"""
+    _file_path = args[0] if len(args) > 0 else kwargs.get("path")
+    _stat = OS.stat(_file_path)
+    _memo_key = (OS.path.abspath(_file_path), _stat.st_size, _stat.st_mtime_ns)
+
+    if _memo_key not in self.__file_hashes:
+      _hash = HASHLIB.sha256()
+      with open(_file_path, "rb") as _fh:
+        for _chunk in iter(lambda: _fh.read(1 << 20), b""):
+          _hash.update(_chunk)
+      self.__file_hashes[_memo_key] = _hash.hexdigest()
+
+    return self.__file_hashes[_memo_key]
+
+  def cache_tool_version(self, *args, **kwargs):
+    """First line of `tool --version`, or path and content hash of the executable if the tool has no version flag"""
+    _tool = args[0] if len(args) > 0 else kwargs.get("tool")
+    _flag = args[1] if len(args) > 1 else kwargs.get("flag", "--version")
+
+    if _tool not in self.__tool_versions:
+      _version = None
+      if _flag is not None:
+        try:
+          _output = SUBPROCESS.run([_tool, _flag], capture_output=True, text=True, timeout=30)
+          _lines = (_output.stdout or _output.stderr).strip().splitlines()
+          _version = _lines[0] if _lines else None
+        except (OSError, SUBPROCESS.TimeoutExpired):
+          pass
+      if not _version:
+        _tool_path = SHUTIL.which(_tool)
+        _version = f"{_tool_path} {self.cache_file_hash(_tool_path)}" if _tool_path else _tool
+      self.__tool_versions[_tool] = _version
+
+    return self.__tool_versions[_tool]
+
+  def cache_key(self, *args, **kwargs):
+    """Content address of the inputs: file parts are given as {"file": path} or {"bytes": content}, everything else is hashed as JSON"""
+    _parts = []
+    for _part in args:
+      if isinstance(_part, dict) and "file" in _part:
+        _parts.append(self.cache_file_hash(_part["file"]))
+      elif isinstance(_part, dict) and "bytes" in _part:
+        _parts.append(HASHLIB.sha256(_part["bytes"]).hexdigest())
+      else:
+        _parts.append(JSON.dumps(_part, sort_keys=True, default=str))
+
+    return HASHLIB.sha256("\n".join(_parts).encode("utf8")).hexdigest()
+
+  def __cache_entry(self, _key):
+    return OS.path.join(self.cache_dir, _key[:2], _key)
+
+  def __cache_place(self, _source, _destination):
+    """Hard links when source and destination share a filesystem, copies otherwise"""
+    _temp = f"{_destination}.{OS.getpid()}.tmp"
+    try:
+      OS.link(_source, _temp)
+    except OSError:
+      SHUTIL.copyfile(_source, _temp)
+    OS.replace(_temp, _destination)
+
+  def cache_fetch(self, *args, **kwargs):
+    """Places cached artifacts of the key at {member: destination} and returns True on a complete hit"""
+    _key = args[0] if len(args) > 0 else kwargs.get("key")
+    _destinations = args[1] if len(args) > 1 else kwargs.get("destinations", {})
+
+    if not self.cache_enabled:
+      return False
+
+    _entry = self.__cache_entry(_key)
+    if not all(OS.path.isfile(OS.path.join(_entry, _member)) for _member in _destinations.keys()):
+      return False
+
+    for _member, _destination in _destinations.items():
+      self.__cache_place(OS.path.join(_entry, _member), _destination)
+
+    # Access time for least recently used eviction
+    OS.utime(_entry, None)
+    return True
+
+  def cache_store(self, *args, **kwargs):
+    """Stores {member: source} files under the key, the entry appears atomically once complete"""
+    _key = args[0] if len(args) > 0 else kwargs.get("key")
+    _sources = args[1] if len(args) > 1 else kwargs.get("sources", {})
+
+    if not self.cache_enabled or not all(OS.path.isfile(_source) for _source in _sources.values()):
+      return False
+
+    _entry = self.__cache_entry(_key)
+    if OS.path.isdir(_entry):
+      OS.utime(_entry, None)
+      return True
+
+    _temp_entry = f"{_entry}.{OS.getpid()}.{TIME.time_ns()}.tmp"
+    OS.makedirs(_temp_entry)
+    for _member, _source in _sources.items():
+      SHUTIL.copyfile(_source, OS.path.join(_temp_entry, _member))
+
+    try:
+      OS.rename(_temp_entry, _entry)
+    except OSError:
+      # Stored concurrently by another process
+      SHUTIL.rmtree(_temp_entry, ignore_errors=True)
+
+    return True
+
+  def cache_evict(self, *args, **kwargs):
+    """Deletes least recently used entries until the cache fits in cache_max_size"""
+    _max_size = float(args[0] if len(args) > 0 else kwargs.get("max_size", self.cache_max_size)) * 1024 * 1024
+
+    if not self.cache_enabled or not OS.path.isdir(self.cache_dir):
+      return 0
+
+    _entries = []
+    with OS.scandir(self.cache_dir) as _shards:
+      for _shard in _shards:
+        if not _shard.is_dir():
+          continue
+        with OS.scandir(_shard.path) as _items:
+          for _item in _items:
+            if _item.is_dir() and not _item.name.endswith(".tmp"):
+              _size = sum(_f.stat().st_size for _f in OS.scandir(_item.path) if _f.is_file())
+              _entries.append((_item.stat().st_mtime, _size, _item.path))
+
+    _total = sum(_e[1] for _e in _entries)
+    _evicted = 0
+    for _mtime, _size, _path in sorted(_entries):
+      if _total <= _max_size:
+        break
+      SHUTIL.rmtree(_path, ignore_errors=True)
+      _total -= _size
+      _evicted += 1
+
+    if _evicted:
+      self.utility.log_info(f"Evicted {_evicted} cache entries from {self.cache_dir}.")
+
+    return _evicted
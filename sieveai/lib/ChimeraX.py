@@ -1,9 +1,85 @@
+import os as OS
 import re as REGEX
+import time as TIME
+import itertools as ITERTOOLS
+import collections as COLLECTIONS
+import socket as SOCKET
+import subprocess as SUBPROCESS
+import urllib.parse as URLPARSE
+import urllib.request as URLREQUEST
+from concurrent.futures import ProcessPoolExecutor
+import numpy as NP
 import pandas as PD
 
-from .OpenBabel import OpenBabel
-
-class ChimeraX(OpenBabel):
+from .Archive import Archive, _archive_read
+
+# `#2.1/A GLU 12 OE1`, the model is left out by ChimeraX when a single structure is open
+_ATOM_SPEC = r"(?:#(\d+)(?:\.(\d+))?(?:\.\d+)*)?/(\S*)\s+(\S+)\s+(\S+)\s+(\S+)"
+_LOG_PATTERNS = {
+  "contacts": (
+    REGEX.compile(r"(\d+) contacts"),
+    REGEX.compile(rf"^[ \t]*{_ATOM_SPEC}[ \t]+{_ATOM_SPEC}[ \t]+(\S+)[ \t]+(\S+)[ \t]*$", REGEX.M),
+    ["atom1", "atom2"], ["overlap", "distance"],
+  ),
+  # Lines without a hydrogen (`no hydrogen`) are not counted as H-bonds
+  "hbonds": (
+    REGEX.compile(r"(\d+) H-bonds"),
+    REGEX.compile(rf"^[ \t]*{_ATOM_SPEC}[ \t]+{_ATOM_SPEC}[ \t]+{_ATOM_SPEC}[ \t]+(\S+)[ \t]+(\S+)[ \t]*$", REGEX.M),
+    ["donor", "acceptor", "hydrogen"], ["da_distance", "dha_distance"],
+  ),
+}
+_ATOM_FIELDS = ["model_id", "sub_model_id", "chain", "resname", "resid", "atom"]
+
+def _chimerax_parse_log(_text, _kind):
+  """Columns of a ChimeraX contacts or H-bonds log, all records of the text matched by one regex scan"""
+  _header, _record, _atoms, _values = _LOG_PATTERNS[_kind]
+  _match = _header.search(_text)
+  _rows = _record.findall(_text, _match.end()) if _match and int(_match.group(1)) > 0 else []
+  _fields = list(zip(*_rows)) if _rows else [()] * (len(_atoms) * len(_ATOM_FIELDS) + len(_values))
+
+  _columns = {}
+  for _i, _atom in enumerate(_atoms):
+    for _j, _field in enumerate(_ATOM_FIELDS):
+      _columns[f"{_atom}__{_field}"] = _fields[_i * len(_ATOM_FIELDS) + _j]
+  for _i, _value in enumerate(_values):
+    _columns[_value] = _fields[len(_atoms) * len(_ATOM_FIELDS) + _i]
+
+  for _atom in _atoms:
+    _model = NP.array(_columns[f"{_atom}__model_id"], dtype=object)
+    _model[_model == ""] = "1"
+    _columns[f"{_atom}__model_id"] = _model.astype(NP.int32)
+    _columns[f"{_atom}__sub_model_id"] = PD.to_numeric(PD.Series(_columns[f"{_atom}__sub_model_id"], dtype=object).replace("", None)).astype("Int32").array
+
+    # Residue numbers with insertion codes stay text
+    _resid = NP.array(_columns[f"{_atom}__resid"], dtype=object)
+    _numeric = PD.to_numeric(PD.Series(_resid), errors="coerce")
+    _columns[f"{_atom}__resid"] = _numeric.astype(NP.int64).to_numpy() if not _numeric.isna().any() else _resid
+
+    for _field in ["chain", "resname", "atom"]:
+      _columns[f"{_atom}__{_field}"] = NP.array(_columns[f"{_atom}__{_field}"], dtype=object)
+  for _value in _values:
+    _columns[_value] = PD.to_numeric(PD.Series(_columns[_value], dtype=object), errors="coerce").to_numpy(dtype=float)
+
+  return _columns
+
+def _chimerax_summarise_complexes(_path_analysis, _ext_contacts, _ext_hbonds, _complexes):
+  """Contacting and H-bond donor residues of every pose of (receptor, ligand, conformer ids, ...) complexes"""
+  _summaries = []
+  for _complex in _complexes:
+    _rec, _lig, _conformer_ids = _complex[:3]
+    _poses = []
+    for _conformer_id in _conformer_ids:
+      _pose = []
+      for _ext, _kind, _atom in ((_ext_contacts, "contacts", "atom1"), (_ext_hbonds, "hbonds", "donor")):
+        _text = _archive_read(f"{_path_analysis}{OS.sep}{_rec}--{_lig}--{_conformer_id}.{_ext}")
+        _columns = _chimerax_parse_log(_text or "", _kind)
+        _pose.append([f"{_resname}:{_resid}" for _resname, _resid in zip(_columns[f"{_atom}__resname"], _columns[f"{_atom}__resid"])])
+      _poses.append(tuple(_pose))
+    _summaries.append(_poses)
+
+  return _summaries
+
+class ChimeraX(Archive):
   def __init__(self, *args, **kwargs):
     super(ChimeraX, self).__init__(**kwargs)
     self.__update_attr(*args, **kwargs)
@@ -11,190 +87,91 @@ class ChimeraX(OpenBabel):
   def __update_attr(self, *args, **kwargs):
     if not hasattr(self, "__defaults"): self.__defaults =  {
         "aa__polar": ["SER", "THR", "CYS", "ASN", "GLN", "TYR"],
+        "chimerax_bin": "chimerax",
+        "chimerax_startup_timeout": 120,
+        "chimerax_command_timeout": 600,
+        "chimerax_parse_workers": None, # All logical cores by default
+        "chimerax_parse_chunk": 200, # Complexes per task of the parsing pool
       }
     # Set all defaults
     [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
     self.__defaults = dict() # Unset defaults to prevent running for second time
     [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
 
-  def __parse_hbond_line(self, line):
-    result = None
-    if "#" in line:
-      pass
-    elif "/" in line:
-      # Since Model ID is 1 and only Chain ID is given so appending to keep the syntax intact
-      line = str(line).replace("/", "Structure #1/")
-    else:
-      raise Exception("Unknown type of col separators.")
+  def chimerax_parse_log(self, *args, **kwargs):
+    """Typed columns of a ChimeraX `contacts` or `hbonds` log file, read in place once archived, None if the file is missing"""
+    _file_path = args[0] if len(args) > 0 else kwargs.get("file_path")
+    _kind = args[1] if len(args) > 1 else kwargs.get("kind", "contacts")
 
-    cols = line.split("#")
+    _text = self.archive_read(_file_path)
+    return None if _text is None else _chimerax_parse_log(_text, _kind)
 
-    if len(cols):
-      try:
-        # Use Second Column to get Donor
-        donor = tuple(cols[1].split()[:4])
-        # Use Third Column to get acceptor
-        acceptor = tuple(cols[2].split()[:4])
-        # Use fourth colun to get Hydrogen and HBond length
-        hydrogen = tuple(cols[3].split()[:4])
-        length = tuple(cols[3].split()[-2:])
-        result = {
-          "donor": donor,
-          "acceptor": acceptor,
-          "hydrogen": hydrogen,
-          "length": length
-        }
-      except:
-        length = None
-        print(line)
-
-    return result
-
-  def chimerax_parse_hbonds_file(self, file_url):
-    hbond_attribs = []
-
-    if self.utility.check_path(file_url):
-      key_term = "H-bonds"
-      search_regex = REGEX.compile(f"(\d+) {key_term}")
-      with open(file_url, 'r', encoding="utf8") as f:
-        hbonds = f.readlines()
-
-      residues_line_flag = False
-
-      for line in hbonds:
-        # print(residues_line_flag, search_regex.search(line))
-        if residues_line_flag and not line.startswith(key_term) and "#" in line:
-          _res = self.__parse_hbond_line(line)
-          if _res:
-            hbond_attribs.append(_res)
-        if not residues_line_flag and search_regex.search(line):
-          residues_line_flag = True
-          if not int(search_regex.search(line).group(1)) > 0:
-            return hbond_attribs
-
-    return hbond_attribs
-
-  def __parse_contacts_line(self, line):
-    result = None
-    if "#" in line:
-      pass
-    elif "/" in line:
-      # Since Model ID is 1 and only Chain ID is given so appending to keep the syntax intact
-      line = str(line).replace("/", "Structure #1/")
-    else:
-      raise Exception("Unknown type of col separators.")
-
-    cols = line.split("#")
-    # print(cols); raise Exception("Unknown type of col separators.")
-
-    if len(cols):
-      # Use Second Column to get Atom1
-      atom1 = tuple(cols[1].split()[:4])
-      # Use Third Column to get Atom2
-      atom2 = tuple(cols[2].split()[:4])
-      # Use fourth colun to get Hydrogen and HBond length
-      overlap = cols[2].split()[-2]
-      distance = cols[2].split()[-1]
-      result = {
-        "atom1": atom1,
-        "atom2": atom2,
-        "overlap": overlap,
-        "distance": distance
-      }
+  def chimerax_parse_logs(self, *args, **kwargs):
+    """Parses many logs of one kind into a single table, `source` holds the index of the file in `file_paths`"""
+    _file_paths = args[0] if len(args) > 0 else kwargs.get("file_paths", [])
+    _kind = args[1] if len(args) > 1 else kwargs.get("kind", "contacts")
 
-    return result
-
-  def chimerax_parse_contacts_file(self, file_url):
-    contact_attribs = []
-    if self.utility.check_path(file_url):
-      key_term = "contacts"
-      search_regex = REGEX.compile(f"(\d+) {key_term}")
-      with open(file_url, 'r', encoding="utf8") as f:
-        contacts = f.readlines()
-
-      residues_line_flag = False
-
-      for line in contacts:
-        if residues_line_flag and not len({"atom1", "atom2"}.intersection(set(line.split()))):
-          _res = self.__parse_contacts_line(line)
-          if _res:
-            contact_attribs.append(_res)
-        if not residues_line_flag and search_regex.search(line):
-          residues_line_flag = True
-          if not int(search_regex.search(line).group(1)) > 0:
-            return contact_attribs
-
-    return contact_attribs
-
-  def __parse_atom_identity(self, atom_details: tuple = ()):
-    if atom_details and type(atom_details) is tuple and len(atom_details) == 4:
-      atom_details_model = atom_details[0].split("/")[0]
-      atom_details_chain = atom_details[0].split("/")[1]
-      atom_details_resname = atom_details[1]
-      atom_details_resid = atom_details[2]
-      atom_details_atom = atom_details[3]
-
-      model_id = atom_details_model
-      sub_model_id = None
-      if "." in atom_details_model:
-        model_id = atom_details_model.split(".")[0]
-        sub_model_id = atom_details_model.split(".")[1]
-
-      __result = {
-        "model_id": model_id,
-        "sub_model_id": sub_model_id,
-        "chain": atom_details_chain,
-        "resname": atom_details_resname,
-        "resid": atom_details_resid,
-        "atom": atom_details_atom,
-      }
+    _tables = []
+    for _source, _file_path in enumerate(_file_paths):
+      _columns = self.chimerax_parse_log(_file_path, _kind)
+      if _columns is not None and len(next(iter(_columns.values()))):
+        _table = PD.DataFrame(_columns)
+        _table.insert(0, "source", _source)
+        _tables.append(_table)
 
-      return __result
-    else:
-      raise Exception(f"Problem in atom records {atom_details}")
+    if not _tables:
+      return PD.DataFrame(_chimerax_parse_log("", _kind)).assign(source=NP.array([], dtype=int))
 
-  def chimerax_get_contacts_residues(self, file_url):
-    __contacts = PD.DataFrame(self.chimerax_parse_contacts_file(file_url))
+    return PD.concat(_tables, ignore_index=True)
 
-    if not __contacts.shape[0]:
-        return None
+  def chimerax_summarise_complexes(self, *args, **kwargs):
+    """Yields (complex, [(contacts, hbonds) per pose]) for (receptor, ligand, conformer ids, ...) complexes
 
-    __contacts["atom1"] = __contacts["atom1"].apply(self.__parse_atom_identity)
-    __contacts["atom2"] = __contacts["atom2"].apply(self.__parse_atom_identity)
+    Logs are parsed in chunks on a process pool. Results come back in input order while only a few chunks
+    per worker are in flight.
+    """
+    _complexes = iter(args[0] if len(args) > 0 else kwargs.get("complexes", []))
+    _path_analysis = args[1] if len(args) > 1 else kwargs.get("path_analysis")
+    _ext_contacts = kwargs.get("ext_contacts", "contacts.txt")
+    _ext_hbonds = kwargs.get("ext_hbonds", "hbonds.txt")
 
-    __contacts = PD.concat([__contacts.drop(['atom1'], axis=1), __contacts['atom1'].apply(PD.Series)], axis=1)
-    __contacts.rename(columns={'model_id': 'atom1__model_id', 'sub_model_id': 'atom1__sub_model_id', 'chain': 'atom1__chain', 'resname': 'atom1__resname', 'resid': 'atom1__resid', 'atom': 'atom1__atom'}, inplace=True)
+    _workers = max(1, int(self.chimerax_parse_workers or OS.cpu_count() or 1))
+    _chunk_size = max(1, int(self.chimerax_parse_chunk))
 
-    __contacts = PD.concat([__contacts.drop(['atom2'], axis=1), __contacts['atom2'].apply(PD.Series)], axis=1)
-    __contacts.rename(columns={'model_id': 'atom2__model_id', 'sub_model_id': 'atom2__sub_model_id', 'chain': 'atom2__chain', 'resname': 'atom2__resname', 'resid': 'atom2__resid', 'atom': 'atom2__atom'}, inplace=True)
+    _pending = COLLECTIONS.deque()
+    with ProcessPoolExecutor(max_workers=_workers) as _executor:
+      while True:
+        _chunk = list(ITERTOOLS.islice(_complexes, _chunk_size))
+        if _chunk:
+          _pending.append((_chunk, _executor.submit(_chimerax_summarise_complexes, _path_analysis, _ext_contacts, _ext_hbonds, _chunk)))
 
-    return __contacts
+        while _pending and (not _chunk or len(_pending) >= 2 * _workers):
+          _done_chunk, _future = _pending.popleft()
+          yield from zip(_done_chunk, _future.result())
 
-  def chimerax_get_hbonds_residues(self, file_url):
-    __hbonds = PD.DataFrame(self.chimerax_parse_hbonds_file(file_url))
+        if not _chunk:
+          break
 
-    if not __hbonds.shape[0]:
-        return None
+  def chimerax_get_contacts_residues(self, file_url):
+    __contacts = self.chimerax_parse_log(file_url, "contacts")
 
-    __hbonds["donor"] = __hbonds["donor"].apply(self.__parse_atom_identity)
-    __hbonds["acceptor"] = __hbonds["acceptor"].apply(self.__parse_atom_identity)
-    __hbonds["hydrogen"] = __hbonds["hydrogen"].apply(self.__parse_atom_identity)
+    if __contacts is None or not len(__contacts["overlap"]):
+        return None
 
-    __hbonds = PD.concat([__hbonds.drop(['donor'], axis=1), __hbonds['donor'].apply(PD.Series)], axis=1)
-    __hbonds.rename(columns={'model_id': 'donor__model_id', 'sub_model_id': 'donor__sub_model_id', 'chain': 'donor__chain', 'resname': 'donor__resname', 'resid': 'donor__resid', 'atom': 'donor__atom'}, inplace=True)
+    return PD.DataFrame(__contacts)
 
-    __hbonds = PD.concat([__hbonds.drop(['acceptor'], axis=1), __hbonds['acceptor'].apply(PD.Series)], axis=1)
-    __hbonds.rename(columns={'model_id': 'acceptor__model_id', 'sub_model_id': 'acceptor__sub_model_id', 'chain': 'acceptor__chain', 'resname': 'acceptor__resname', 'resid': 'acceptor__resid', 'atom': 'acceptor__atom'}, inplace=True)
+  def chimerax_get_hbonds_residues(self, file_url):
+    __hbonds = self.chimerax_parse_log(file_url, "hbonds")
 
-    __hbonds = PD.concat([__hbonds.drop(['hydrogen'], axis=1), __hbonds['hydrogen'].apply(PD.Series)], axis=1)
-    __hbonds.rename(columns={'model_id': 'hydrogen__model_id', 'sub_model_id': 'hydrogen__sub_model_id', 'chain': 'hydrogen__chain', 'resname': 'hydrogen__resname', 'resid': 'hydrogen__resid', 'atom': 'hydrogen__atom'}, inplace=True)
+    if __hbonds is None or not len(__hbonds["da_distance"]):
+        return None
 
-    return __hbonds
+    return PD.DataFrame(__hbonds)
 
   def chimerax_run_file(self, *args, **kwargs):
     _cxc_file = args[0] if len(args) > 0 else kwargs.get("file")
 
-    _res = self.utility.cmd_run(["chimerax",
+    _res = self.utility.cmd_run([self.chimerax_bin,
       "--cmd", f"open {_cxc_file}",
       "--silent",
       "--offscreen",
@@ -202,6 +179,91 @@ class ChimeraX(OpenBabel):
 
     return _res
 
+  def __chimerax_free_port(self):
+    with SOCKET.socket(SOCKET.AF_INET, SOCKET.SOCK_STREAM) as _sock:
+      _sock.bind(("127.0.0.1", 0))
+      return _sock.getsockname()[1]
+
+  def chimerax_session_start(self, *args, **kwargs):
+    """Starts a long-lived headless ChimeraX controlled through its REST remote control."""
+    _port = args[0] if len(args) > 0 else kwargs.get("port", self.__chimerax_free_port())
+
+    # stdin is kept open so that the nogui command loop does not exit
+    _process = SUBPROCESS.Popen([self.chimerax_bin,
+        "--nogui",
+        "--offscreen",
+        "--silent",
+        "--cmd", f"remotecontrol rest start port {_port}",
+      ],
+      stdin=SUBPROCESS.PIPE,
+      stdout=SUBPROCESS.DEVNULL,
+      stderr=SUBPROCESS.DEVNULL)
+
+    _session = {
+      "process": _process,
+      "port": _port,
+      "receptor": None,
+    }
+
+    _deadline = TIME.time() + float(self.chimerax_startup_timeout)
+    while TIME.time() < _deadline:
+      if _process.poll() is not None:
+        break
+      try:
+        self.chimerax_session_run(_session, "version", timeout=5)
+        return _session
+      except OSError:
+        TIME.sleep(0.5)
+
+    # OSError so that callers restart or fail the session like any other session error
+    _exit_code = _process.poll()
+    self.chimerax_session_stop(_session)
+    if _exit_code is not None:
+      raise OSError(f"ChimeraX exited with {_exit_code} before its remote control started on port {_port}.")
+    raise TimeoutError(f"ChimeraX remote control did not start on port {_port} in {self.chimerax_startup_timeout}s.")
+
+  def chimerax_session_run(self, *args, **kwargs):
+    """Runs one or more commands in a ChimeraX session and returns the log text."""
+    _session = args[0] if len(args) > 0 else kwargs.get("session")
+    _commands = args[1] if len(args) > 1 else kwargs.get("commands", [])
+    _timeout = kwargs.get("timeout", float(self.chimerax_command_timeout))
+
+    if isinstance(_commands, str):
+      _commands = [_commands]
+
+    _output = []
+    for _command in _commands:
+      _command = _command.strip().rstrip(";").strip()
+      if not _command or _command.startswith("#"):
+        continue
+      _url = f"http://127.0.0.1:{_session['port']}/run?command={URLPARSE.quote(_command)}"
+      with URLREQUEST.urlopen(_url, timeout=_timeout) as _response:
+        _output.append(_response.read().decode("utf8", errors="replace"))
+
+    return "".join(_output)
+
+  def chimerax_session_stop(self, *args, **kwargs):
+    _session = args[0] if len(args) > 0 else kwargs.get("session")
+    _process = _session.get("process")
+
+    if _process is None or _process.poll() is not None:
+      return
+
+    try:
+      self.chimerax_session_run(_session, "exit", timeout=10)
+    except OSError:
+      pass
+
+    try:
+      _process.stdin.close()
+      _process.wait(timeout=30)
+    except (OSError, SUBPROCESS.TimeoutExpired):
+      _process.kill()
+
+  def chimerax_session_alive(self, *args, **kwargs):
+    _session = args[0] if len(args) > 0 else kwargs.get("session")
+    return _session is not None and _session["process"].poll() is None
+
   def chimerax_convert(self, *args, **kwargs):
     _mol_path = args[0] if len(args) > 0 else kwargs.get("mol_path")
     _ext_to = args[1] if len(args) > 1 else kwargs.get("ext_to")
@@ -0,0 +1,274 @@
+import numpy as NP
+
+from .MolConverter import MolConverter
+
+_CKDTREE = False
+
+def _ckdtree():
+  """scipy's cKDTree imported on first use as scipy is slow to load, None when scipy is not installed"""
+  global _CKDTREE
+  if _CKDTREE is False:
+    try:
+      from scipy.spatial import cKDTree
+      _CKDTREE = cKDTree
+    except ImportError:
+      _CKDTREE = None
+  return _CKDTREE
+
+# Bondi van der Waals radii
+VDW_RADII = {
+  "H": 1.10, "C": 1.70, "N": 1.55, "O": 1.52, "S": 1.80, "P": 1.80,
+  "F": 1.47, "CL": 1.75, "BR": 1.85, "I": 1.98, "SE": 1.90,
+  "MG": 1.73, "ZN": 1.39, "FE": 1.94, "CA": 2.31, "MN": 1.97, "NA": 2.27, "K": 2.75,
+}
+
+# AutoDock atom types which are not plain element symbols
+AD_TYPE_ELEMENTS = {
+  "A": "C", "OA": "O", "NA": "N", "NS": "N", "OS": "O", "SA": "S", "HD": "H", "HS": "H",
+}
+
+AD_ACCEPTORS = ("OA", "NA", "NS", "OS")
+
+def _ad_element(ad_type):
+  ad_type = ad_type.strip()
+  return AD_TYPE_ELEMENTS.get(ad_type, ad_type.upper())
+
+def _read_pdbqt_models(file_path):
+  """Reads PDBQT ATOM/HETATM records into one dict of NumPy arrays per MODEL"""
+  _models = []
+  _records = []
+  _model_id = 1
+
+  def _flush():
+    if not _records:
+      return
+    _types = NP.array([_r[5] for _r in _records])
+    _elements = NP.array([_ad_element(_t) for _t in _types])
+    _models.append({
+      "model_id": _model_id,
+      "name": NP.array([_r[0] for _r in _records]),
+      "resname": NP.array([_r[1] for _r in _records]),
+      "chain": NP.array([_r[2] for _r in _records]),
+      "resid": NP.array([_r[3] for _r in _records]),
+      "coords": NP.array([_r[4] for _r in _records], dtype=NP.float64),
+      "ad_type": _types,
+      "element": _elements,
+      "radius": NP.array([VDW_RADII.get(_e, 1.80) for _e in _elements]),
+    })
+
+  with open(file_path, "r", encoding="utf8") as _fh:
+    for _line in _fh:
+      if _line.startswith(("ATOM", "HETATM")):
+        _records.append((
+          _line[12:16].strip(),
+          _line[17:21].strip(),
+          _line[21:22].strip(),
+          _line[22:26].strip(),
+          (float(_line[30:38]), float(_line[38:46]), float(_line[46:54])),
+          _line[77:79].strip() or _line[12:14].strip(),
+        ))
+      elif _line.startswith("MODEL"):
+        _flush()
+        _records = []
+        _model_id = int(_line.split()[1]) if len(_line.split()) > 1 else len(_models) + 1
+      elif _line.startswith("ENDMDL"):
+        _flush()
+        _records = []
+        _model_id = len(_models) + 1
+
+  _flush()
+  return _models
+
+def _expand_ranges(starts, counts):
+  """Flat indices of the ranges [starts[i], starts[i] + counts[i])"""
+  _total = int(counts.sum())
+  if not _total:
+    return NP.zeros(0, dtype=NP.int64)
+  _offsets = NP.arange(_total) - NP.repeat(NP.cumsum(counts) - counts, counts)
+  return NP.repeat(starts, counts) + _offsets
+
+class _CellList():
+  """Uniform grid over fixed coordinates answering fixed-radius neighbour queries"""
+  def __init__(self, coords, cell):
+    self.coords = coords
+    self.cell = float(cell)
+    self.origin = coords.min(axis=0) - self.cell
+    _cells = NP.floor((coords - self.origin) / self.cell).astype(NP.int64)
+    self.dims = _cells.max(axis=0) + 2
+    _keys = self.__keys(_cells)
+    self.order = NP.argsort(_keys, kind="stable")
+    self.keys = _keys[self.order]
+
+  def __keys(self, cells):
+    return (cells[:, 0] * self.dims[1] + cells[:, 1]) * self.dims[2] + cells[:, 2]
+
+  def pairs(self, points, cutoff):
+    _cells = NP.floor((points - self.origin) / self.cell).astype(NP.int64)
+    _query, _found = [], []
+    for _dx in (-1, 0, 1):
+      for _dy in (-1, 0, 1):
+        for _dz in (-1, 0, 1):
+          _nc = _cells + NP.array([_dx, _dy, _dz])
+          _valid = NP.all((_nc >= 0) & (_nc < self.dims), axis=1)
+          _keys = self.__keys(NP.where(_valid[:, None], _nc, 0))
+          _starts = NP.searchsorted(self.keys, _keys, side="left")
+          _counts = NP.where(_valid, NP.searchsorted(self.keys, _keys, side="right") - _starts, 0)
+          _query.append(NP.repeat(NP.arange(points.shape[0]), _counts))
+          _found.append(self.order[_expand_ranges(_starts, _counts)])
+
+    _query = NP.concatenate(_query)
+    _found = NP.concatenate(_found)
+    _keep = NP.linalg.norm(points[_query] - self.coords[_found], axis=1) <= cutoff
+    return _query[_keep], _found[_keep]
+
+class _KDTree():
+  def __init__(self, coords, cell):
+    self.coords = coords
+    self.tree = _ckdtree()(coords)
+
+  def pairs(self, points, cutoff):
+    _neighbours = self.tree.query_ball_point(points, cutoff)
+    _counts = NP.array([len(_n) for _n in _neighbours], dtype=NP.int64)
+    _query = NP.repeat(NP.arange(points.shape[0]), _counts)
+    _found = NP.concatenate([NP.asarray(_n, dtype=NP.int64) for _n in _neighbours]) if _counts.sum() else NP.zeros(0, dtype=NP.int64)
+    return _query, _found
+
+def _donor_hydrogens(model, pairs=None, max_bond=1.1):
+  """(heavy atom, hydrogen) index pairs of polar N/O donors"""
+  _is_h = model["element"] == "H"
+  _is_polar = NP.isin(model["element"], ("N", "O"))
+  if pairs is None:
+    _h_idx = NP.flatnonzero(_is_h)
+    _p_idx = NP.flatnonzero(_is_polar)
+    if not len(_h_idx) or not len(_p_idx):
+      return NP.zeros((0, 2), dtype=NP.int64)
+    _dist = NP.linalg.norm(model["coords"][_p_idx][:, None, :] - model["coords"][_h_idx][None, :, :], axis=2)
+    _pi, _hi = NP.nonzero(_dist <= max_bond)
+    return NP.stack([_p_idx[_pi], _h_idx[_hi]], axis=1)
+
+  _hydrogen, _heavy = pairs
+  _keep = _is_polar[_heavy]
+  return NP.stack([_heavy[_keep], _hydrogen[_keep]], axis=1)
+
+class Interactions(MolConverter):
+  def __init__(self, *args, **kwargs):
+    super(Interactions, self).__init__(**kwargs)
+    self.__update_attr(*args, **kwargs)
+    self.__receptor = (None, None)
+
+  def __update_attr(self, *args, **kwargs):
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "interactions_overlap_cutoff": -0.4,
+        "interactions_hbond_allowance": 0.4,
+        "interactions_hbond_distance": 3.5,
+        "interactions_hbond_angle": 120,
+      }
+
+    # Set all defaults
+    [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
+    self.__defaults = dict() # Unset defaults to prevent running for second time
+    [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  @property
+  def interactions_cutoff(self):
+    return max(2 * max(VDW_RADII.values()) - float(self.interactions_overlap_cutoff), float(self.interactions_hbond_distance))
+
+  def interactions_read_pdbqt(self, *args, **kwargs):
+    """Reads all models of a PDB/PDBQT file as NumPy arrays of atom attributes"""
+    _file_path = args[0] if len(args) > 0 else kwargs.get("path")
+    return _read_pdbqt_models(_file_path)
+
+  def interactions_load_receptor(self, *args, **kwargs):
+    """Parses a receptor PDBQT and builds its spatial index once, reusing it for consecutive calls"""
+    _receptor_path = args[0] if len(args) > 0 else kwargs.get("receptor")
+
+    if self.__receptor[0] == _receptor_path:
+      return self.__receptor[1]
+
+    _models = _read_pdbqt_models(_receptor_path)
+    if not len(_models):
+      raise Exception(f"No atoms found in receptor {_receptor_path}.")
+
+    _receptor = _models[0]
+    _index_class = _KDTree if _ckdtree() is not None else _CellList
+    _receptor["index"] = _index_class(_receptor["coords"], self.interactions_cutoff)
+    _hydrogens = NP.flatnonzero(_receptor["element"] == "H")
+    _query, _found = _receptor["index"].pairs(_receptor["coords"][_hydrogens], 1.1)
+    _receptor["donor_h"] = _donor_hydrogens(_receptor, (_hydrogens[_query], _found))
+    _receptor["acceptor"] = NP.isin(_receptor["ad_type"], AD_ACCEPTORS)
+
+    self.__receptor = (_receptor_path, _receptor)
+    return _receptor
+
+  def __hbonds(self, donor, acceptor, donor_h, candidates):
+    """Donor-acceptor pairs within H-bond distance satisfying the D-H...A angle, with the hydrogens satisfying it"""
+    _donors, _acceptors = candidates
+    _keep = NP.isin(_donors, donor_h[:, 0]) & acceptor["acceptor"][_acceptors]
+    _keep &= NP.linalg.norm(donor["coords"][_donors] - acceptor["coords"][_acceptors], axis=1) <= float(self.interactions_hbond_distance)
+    _donors, _acceptors = _donors[_keep], _acceptors[_keep]
+    if not len(_donors):
+      return _donors, _acceptors, _donors
+
+    # Expand every candidate pair over the hydrogens of its donor
+    _order = NP.argsort(donor_h[:, 0], kind="stable")
+    _dh = donor_h[_order]
+    _starts = NP.searchsorted(_dh[:, 0], _donors, side="left")
+    _counts = NP.searchsorted(_dh[:, 0], _donors, side="right") - _starts
+    _pair = NP.repeat(NP.arange(len(_donors)), _counts)
+    _hydrogens = _dh[_expand_ranges(_starts, _counts), 1]
+
+    _hd = donor["coords"][_donors[_pair]] - donor["coords"][_hydrogens]
+    _ha = acceptor["coords"][_acceptors[_pair]] - donor["coords"][_hydrogens]
+    _cos = (_hd * _ha).sum(axis=1) / (NP.linalg.norm(_hd, axis=1) * NP.linalg.norm(_ha, axis=1))
+    _angle = NP.degrees(NP.arccos(NP.clip(_cos, -1, 1)))
+    _bonded = _angle >= float(self.interactions_hbond_angle)
+    _valid = NP.unique(_pair[_bonded])
+    return _donors[_valid], _acceptors[_valid], NP.unique(_hydrogens[_bonded])
+
+  def interactions_analyse_pose(self, *args, **kwargs):
+    """Finds VDW contacts and geometric H-bonds between a receptor and a single ligand pose
+
+    Returns receptor residues as `RES:ID` for every contacting atom pair and donor residues for every
+    H-bond. As with `contacts (#1 & ~hbonds)` of the ChimeraX backend, receptor atoms taking part in an
+    H-bond, as donor, hydrogen or acceptor, make no contacts.
+    """
+    _receptor = args[0] if len(args) > 0 else kwargs.get("receptor")
+    _ligand = args[1] if len(args) > 1 else kwargs.get("ligand")
+
+    _lig_idx, _rec_idx = _receptor["index"].pairs(_ligand["coords"], self.interactions_cutoff)
+    _ligand["acceptor"] = NP.isin(_ligand["ad_type"], AD_ACCEPTORS)
+    _lig_donor_h = _donor_hydrogens(_ligand)
+
+    _rec_donors, _lig_acceptors, _rec_hydrogens = self.__hbonds(_receptor, _ligand, _receptor["donor_h"], (_rec_idx, _lig_idx))
+    _lig_donors, _rec_acceptors, _lig_hydrogens = self.__hbonds(_ligand, _receptor, _lig_donor_h, (_lig_idx, _rec_idx))
+
+    _hbonded = NP.zeros(_receptor["coords"].shape[0], dtype=bool)
+    _hbonded[NP.concatenate([_rec_donors, _rec_hydrogens, _rec_acceptors])] = True
+
+    _distance = NP.linalg.norm(_ligand["coords"][_lig_idx] - _receptor["coords"][_rec_idx], axis=1)
+    _polar = NP.isin(_receptor["element"][_rec_idx], ("N", "O")) & NP.isin(_ligand["element"][_lig_idx], ("N", "O"))
+    _overlap = _receptor["radius"][_rec_idx] + _ligand["radius"][_lig_idx] - _distance - NP.where(_polar, float(self.interactions_hbond_allowance), 0)
+    _contact = (_overlap >= float(self.interactions_overlap_cutoff)) & ~_hbonded[_rec_idx]
+
+    _contact_rec = _rec_idx[_contact]
+    _contacts = NP.char.add(NP.char.add(_receptor["resname"][_contact_rec], ":"), _receptor["resid"][_contact_rec]).tolist()
+
+    _hbonds = NP.char.add(NP.char.add(_receptor["resname"][_rec_donors], ":"), _receptor["resid"][_rec_donors]).tolist()
+    _hbonds.extend(NP.char.add(NP.char.add(_ligand["resname"][_lig_donors], ":"), _ligand["resid"][_lig_donors]).tolist())
+
+    return {
+      "contacts": _contacts,
+      "hbonds": _hbonds,
+    }
+
+  def interactions_analyse_complex(self, *args, **kwargs):
+    """Analyses every pose of a docking result PDBQT keyed by the conformer (model) number"""
+    _receptor_path = args[0] if len(args) > 0 else kwargs.get("receptor")
+    _poses_path = args[1] if len(args) > 1 else kwargs.get("poses")
+
+    _receptor = self.interactions_load_receptor(_receptor_path)
+    _results = {}
+    for _pose in _read_pdbqt_models(_poses_path):
+      _results[_pose["model_id"]] = self.interactions_analyse_pose(_receptor, _pose)
+
+    return _results
@@ -0,0 +1,133 @@
+import os as OS
+import time as TIME
+import sqlite3 as SQLITE
+import threading as THREADING
+
+from .ArtifactCache import ArtifactCache
+
+class JobLedger(ArtifactCache):
+  def __init__(self, *args, **kwargs):
+    super(JobLedger, self).__init__(**kwargs)
+    self.__update_attr(*args, **kwargs)
+    self.__ledger = (None, None)
+    self.__ledger_lock = THREADING.RLock()
+
+  def __update_attr(self, *args, **kwargs):
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "db_path": None, # Project database, file__ledger under the base directory by default
+        "file__ledger": "SieveAI.db",
+        "ledger_journal_mode": None, # WAL, DELETE with the work queue as workers on several nodes share the project over a network filesystem
+      }
+
+    # Set all defaults
+    [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
+    self.__defaults = dict() # Unset defaults to prevent running for second time
+    [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  @property
+  def ledger_db_path(self):
+    return self.db_path or f"{self.path_base}{OS.sep}{self.file__ledger}"
+
+  def ledger_connect(self, *args, **kwargs):
+    """Connection to the job ledger of the current project, opened once per project database"""
+    _db_path = args[0] if len(args) > 0 else kwargs.get("db_path") or self.ledger_db_path
+
+    with self.__ledger_lock:
+      if self.__ledger[0] == _db_path:
+        return self.__ledger[1]
+
+      if self.__ledger[1] is not None:
+        self.__ledger[1].close()
+
+      _connection = SQLITE.connect(_db_path, timeout=60, check_same_thread=False)
+      self.ledger_journal(_connection, _db_path)
+      _connection.execute("PRAGMA synchronous=NORMAL")
+      _connection.executescript("""
+        CREATE TABLE IF NOT EXISTS job_ledger (
+          stage TEXT NOT NULL,
+          item TEXT NOT NULL,
+          status TEXT NOT NULL,
+          attempts INTEGER NOT NULL DEFAULT 0,
+          exit_code INTEGER,
+          started REAL,
+          finished REAL,
+          duration REAL,
+          message TEXT,
+          PRIMARY KEY (stage, item)
+        );
+        CREATE INDEX IF NOT EXISTS job_ledger_stage_status ON job_ledger (stage, status);
+      """)
+      self.__ledger = (_db_path, _connection)
+      return _connection
+
+  def ledger_journal(self, *args, **kwargs):
+    """Sets the journal mode of a connection to the project database, returns the mode in effect"""
+    _connection = args[0] if len(args) > 0 else kwargs.get("connection")
+    _mode = (self.ledger_journal_mode or "WAL").upper()
+    return _connection.execute(f"PRAGMA journal_mode={_mode}").fetchone()[0].upper()
+
+  def ledger_items(self, *args, **kwargs):
+    """Set of items of a stage having the given status(es), optionally only items starting with `prefix`"""
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+    _status = args[1] if len(args) > 1 else kwargs.get("status", "done")
+    _prefix = kwargs.get("prefix")
+    _status = [_status] if isinstance(_status, str) else list(_status)
+
+    _query = f"SELECT item FROM job_ledger WHERE stage = ? AND status IN ({','.join('?' * len(_status))})"
+    _params = [_stage, *_status]
+    if _prefix:
+      # Range on the primary key instead of LIKE so that the index is used
+      _query = f"{_query} AND item >= ? AND item < ?"
+      _params.extend([_prefix, _prefix[:-1] + chr(ord(_prefix[-1]) + 1)])
+
+    with self.__ledger_lock:
+      _cursor = self.ledger_connect().execute(_query, _params)
+      return {_row[0] for _row in _cursor}
+
+  def ledger_count(self, *args, **kwargs):
+    """Number of items of a stage by status"""
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+
+    with self.__ledger_lock:
+      _cursor = self.ledger_connect().execute("SELECT status, COUNT(*) FROM job_ledger WHERE stage = ? GROUP BY status", (_stage,))
+      return dict(_cursor.fetchall())
+
+  def ledger_mark(self, *args, **kwargs):
+    """Sets the status of one or many items of a stage in a single transaction"""
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+    _items = args[1] if len(args) > 1 else kwargs.get("items", [])
+    _status = args[2] if len(args) > 2 else kwargs.get("status", "pending")
+    _items = [_items] if isinstance(_items, str) else _items
+
+    _now = TIME.time()
+    _started = _now if _status == "running" else None
+    _finished = _now if _status in ("done", "failed") else None
+    _rows = [(_stage, _item, _status, 1 if _status == "running" else 0, kwargs.get("exit_code"),
+              _started, _finished, kwargs.get("duration"), kwargs.get("message")) for _item in _items]
+
+    with self.__ledger_lock:
+      _connection = self.ledger_connect()
+      with _connection:
+        _connection.executemany("""
+          INSERT INTO job_ledger (stage, item, status, attempts, exit_code, started, finished, duration, message)
+          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+          ON CONFLICT (stage, item) DO UPDATE SET
+            status = excluded.status,
+            attempts = job_ledger.attempts + excluded.attempts,
+            exit_code = excluded.exit_code,
+            started = COALESCE(excluded.started, job_ledger.started),
+            finished = excluded.finished,
+            duration = COALESCE(excluded.duration, CASE WHEN excluded.finished IS NOT NULL THEN excluded.finished - job_ledger.started END),
+            message = excluded.message
+        """, _rows)
+
+    if _status in ("done", "failed") and _rows:
+      self.metrics_items(_stage, [_row[1] for _row in _rows], _status, exit_code=kwargs.get("exit_code"), duration=kwargs.get("duration"), message=kwargs.get("message"))
+
+    return len(_rows)
+
+  def ledger_close(self, *args, **kwargs):
+    with self.__ledger_lock:
+      if self.__ledger[1] is not None:
+        self.__ledger[1].close()
+      self.__ledger = (None, None)
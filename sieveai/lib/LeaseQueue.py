@@ -0,0 +1,248 @@
+import os as OS
+import json as JSON
+import time as TIME
+import uuid as UUID
+import socket as SOCKET
+import sqlite3 as SQLITE
+import itertools as ITERTOOLS
+import threading as THREADING
+
+from .JobLedger import JobLedger
+
+class LeaseQueue(JobLedger):
+  def __init__(self, *args, **kwargs):
+    super(LeaseQueue, self).__init__(**kwargs)
+    self.__update_attr(*args, **kwargs)
+    self.__queue = (None, None)
+    self.__queue_lock = THREADING.RLock()
+    self.__heartbeat = None
+    self.__journal_warned = set()
+    self.queue_owner = f"{SOCKET.gethostname()}-{OS.getpid()}-{UUID.uuid4().hex[:8]}"
+
+  def __update_attr(self, *args, **kwargs):
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "queue_enabled": False, # Queue the work and claim it together with workers on other nodes
+        "queue_worker": False, # Only claim work queued by the submitting node, implies queue_enabled
+        "queue_lease": 300, # Seconds a claimed item is reserved without a heartbeat
+        "queue_heartbeat": 30, # Seconds between lease renewals
+        "queue_max_attempts": 3, # Leases of an item before it is failed
+        "queue_poll_interval": 10, # Seconds between checks for items leased by other workers
+      }
+
+    # Set all defaults
+    [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
+    self.__defaults = dict() # Unset defaults to prevent running for second time
+    [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  def queue_connect(self, *args, **kwargs):
+    """Connection to the work queue in the project database, transactions are started explicitly"""
+    _db_path = args[0] if len(args) > 0 else kwargs.get("db_path") or self.ledger_db_path
+
+    with self.__queue_lock:
+      if self.__queue[0] == _db_path:
+        return self.__queue[1]
+
+      if self.__queue[1] is not None:
+        self.__queue[1].close()
+
+      _connection = SQLITE.connect(_db_path, timeout=120, check_same_thread=False, isolation_level=None)
+      self.ledger_journal(_connection, _db_path)
+      _connection.executescript("""
+        CREATE TABLE IF NOT EXISTS work_queue (
+          stage TEXT NOT NULL,
+          item TEXT NOT NULL,
+          payload TEXT,
+          status TEXT NOT NULL DEFAULT 'pending',
+          owner TEXT,
+          lease_expires REAL,
+          attempts INTEGER NOT NULL DEFAULT 0,
+          updated REAL,
+          message TEXT,
+          PRIMARY KEY (stage, item)
+        );
+        CREATE INDEX IF NOT EXISTS work_queue_stage_status ON work_queue (stage, status);
+        CREATE INDEX IF NOT EXISTS work_queue_owner ON work_queue (owner, status);
+        CREATE TABLE IF NOT EXISTS queue_workers (
+          owner TEXT PRIMARY KEY,
+          host TEXT,
+          pid INTEGER,
+          started REAL,
+          heartbeat REAL
+        );
+      """)
+      self.__queue = (_db_path, _connection)
+      return _connection
+
+  def ledger_journal(self, *args, **kwargs):
+    """With the work queue the project database uses the DELETE journal unless configured, WAL needs memory shared by all workers"""
+    _connection = args[0] if len(args) > 0 else kwargs.get("connection")
+    _db_path = args[1] if len(args) > 1 else kwargs.get("db_path")
+    if not (self.queue_enabled or self.queue_worker):
+      return super(LeaseQueue, self).ledger_journal(_connection)
+
+    _mode = (self.ledger_journal_mode or "DELETE").upper()
+    _set = _connection.execute(f"PRAGMA journal_mode={_mode}").fetchone()[0].upper()
+    if _db_path not in self.__journal_warned:
+      if _set != _mode:
+        self.__journal_warned.add(_db_path)
+        self.utility.log_warning(f"Journal mode of {_db_path} stays {_set} instead of {_mode}, close the other processes using it.")
+      elif _mode == "WAL":
+        self.__journal_warned.add(_db_path)
+        self.utility.log_warning(f"WAL journal of {_db_path} is only safe for queue workers on one node, use -jm DELETE across nodes.")
+
+    return _set
+
+  def __queue_transaction(self, _statements):
+    """Runs `_statements(connection)` in one write transaction taken before reading, so that claims never overlap"""
+    with self.__queue_lock:
+      _connection = self.queue_connect()
+      _connection.execute("BEGIN IMMEDIATE")
+      try:
+        _result = _statements(_connection)
+        _connection.execute("COMMIT")
+        return _result
+      except BaseException:
+        _connection.execute("ROLLBACK")
+        raise
+
+  def queue_submit(self, *args, **kwargs):
+    """Adds (item, payload) pairs to a stage. Returns the number of items added or returned to pending
+
+    Items already queued keep their state, except done or failed items which are not done in the job
+    ledger. These were lost by a crash after their commit or failed in an earlier run and are queued again.
+    """
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+    _items = iter(args[1] if len(args) > 1 else kwargs.get("items", []))
+
+    # The job ledger shares the database, its table is created before it is looked up
+    self.ledger_connect()
+
+    def _submit(_connection, _chunk):
+      _added = _connection.executemany("INSERT OR IGNORE INTO work_queue (stage, item, payload, updated) VALUES (?, ?, ?, ?)", _chunk).rowcount
+      _added += _connection.executemany("""
+        UPDATE work_queue SET status = 'pending', owner = NULL, lease_expires = NULL, attempts = 0, payload = ?, updated = ?, message = NULL
+        WHERE stage = ? AND item = ? AND status IN ('done', 'failed') AND NOT EXISTS (
+          SELECT 1 FROM job_ledger WHERE job_ledger.stage = work_queue.stage AND job_ledger.item = work_queue.item AND job_ledger.status = 'done')
+      """, [(_payload, _updated, _stage, _item) for _stage, _item, _payload, _updated in _chunk]).rowcount
+      return _added
+
+    _added = 0
+    while True:
+      _chunk = [(_stage, _item, JSON.dumps(_payload), TIME.time()) for _item, _payload in ITERTOOLS.islice(_items, 10000)]
+      if not _chunk:
+        break
+      _added += self.__queue_transaction(lambda _c: _submit(_c, _chunk))
+
+    return _added
+
+  def queue_claim(self, *args, **kwargs):
+    """Leases up to `count` pending items, or items whose lease expired, to this worker as [(item, payload)]"""
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+    _count = int(args[1] if len(args) > 1 else kwargs.get("count", 1))
+
+    def _claim(_connection):
+      _now = TIME.time()
+      # Items of crashed workers are given up after max attempts
+      _connection.execute("""
+        UPDATE work_queue SET status = 'failed', owner = NULL, lease_expires = NULL, updated = ?, message = 'Lease expired too many times.'
+        WHERE stage = ? AND status = 'leased' AND lease_expires < ? AND attempts >= ?
+      """, (_now, _stage, _now, int(self.queue_max_attempts)))
+
+      _rows = _connection.execute("""
+        SELECT item, payload FROM work_queue
+        WHERE stage = ? AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) LIMIT ?
+      """, (_stage, _now, _count)).fetchall()
+
+      _connection.executemany("""
+        UPDATE work_queue SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ?
+        WHERE stage = ? AND item = ?
+      """, [(self.queue_owner, _now + float(self.queue_lease), _now, _stage, _item) for _item, _payload in _rows])
+
+      return [(_item, JSON.loads(_payload) if _payload else None) for _item, _payload in _rows]
+
+    return self.__queue_transaction(_claim)
+
+  def queue_complete(self, *args, **kwargs):
+    """Commits the outcome of a leased item, True only for the current lease holder so that each item is committed once
+
+    `publish()` is called while the lease is held, before the commit, to move the outputs of the item in
+    place. The item stays leased when it raises or the worker crashes, so that it is claimed again.
+    """
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+    _item = args[1] if len(args) > 1 else kwargs.get("item")
+    _status = args[2] if len(args) > 2 else kwargs.get("status", "done")
+    _publish = kwargs.get("publish")
+
+    def _complete(_connection):
+      _held = _connection.execute("SELECT 1 FROM work_queue WHERE stage = ? AND item = ? AND owner = ? AND status = 'leased'",
+        (_stage, _item, self.queue_owner)).fetchone()
+      if _held is None:
+        return False
+
+      # Other workers wait for the write lock, so the lease cannot be taken over while publishing
+      if _publish:
+        _publish()
+
+      _connection.execute("""
+        UPDATE work_queue SET status = ?, lease_expires = NULL, updated = ?, message = ?
+        WHERE stage = ? AND item = ? AND owner = ? AND status = 'leased'
+      """, (_status, TIME.time(), kwargs.get("message"), _stage, _item, self.queue_owner))
+      return True
+
+    return self.__queue_transaction(_complete)
+
+  def queue_release(self, *args, **kwargs):
+    """Returns items leased by this worker to the queue, e.g. on shutdown"""
+    return self.__queue_transaction(lambda _c: _c.execute("""
+      UPDATE work_queue SET status = 'pending', owner = NULL, lease_expires = NULL, attempts = attempts - 1, updated = ?
+      WHERE owner = ? AND status = 'leased'
+    """, (TIME.time(), self.queue_owner)).rowcount)
+
+  def queue_count(self, *args, **kwargs):
+    """Number of items of a stage by status"""
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+
+    with self.__queue_lock:
+      _counts = dict(self.queue_connect().execute("SELECT status, COUNT(*) FROM work_queue WHERE stage = ? GROUP BY status", (_stage,)).fetchall())
+
+    self.metrics_queue(_stage, _counts)
+    return _counts
+
+  def queue_renew(self, *args, **kwargs):
+    """Extends the leases of this worker and records its heartbeat"""
+    def _renew(_connection):
+      _now = TIME.time()
+      _connection.execute("UPDATE work_queue SET lease_expires = ? WHERE owner = ? AND status = 'leased'", (_now + float(self.queue_lease), self.queue_owner))
+      _connection.execute("""
+        INSERT INTO queue_workers (owner, host, pid, started, heartbeat) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (owner) DO UPDATE SET heartbeat = excluded.heartbeat
+      """, (self.queue_owner, SOCKET.gethostname(), OS.getpid(), _now, _now))
+
+    self.__queue_transaction(_renew)
+
+  def queue_heartbeat_start(self):
+    """Renews the leases of this worker from a background thread until queue_heartbeat_stop"""
+    if self.__heartbeat is not None:
+      return
+
+    _stop = THREADING.Event()
+    def _beat():
+      while not _stop.wait(float(self.queue_heartbeat)):
+        try:
+          self.queue_renew()
+        except SQLITE.Error as _e:
+          self.utility.log_warning(f"Queue heartbeat failed: {_e}")
+
+    self.queue_renew()
+    _thread = THREADING.Thread(target=_beat, name="queue-heartbeat", daemon=True)
+    _thread.start()
+    self.__heartbeat = (_thread, _stop)
+
+  def queue_heartbeat_stop(self):
+    if self.__heartbeat is None:
+      return
+
+    _thread, _stop = self.__heartbeat
+    _stop.set()
+    _thread.join()
+    self.__heartbeat = None
@@ -1,6 +1,6 @@
-from .MolConverter import MolConverter
+from .Ranking import Ranking
 
-class LibManager(MolConverter):
+class LibManager(Ranking):
   def __init__(self, *args, **kwargs):
     super(LibManager, self).__init__(**kwargs)
     self.__update_attr(*args, **kwargs)
@@ -0,0 +1,346 @@
+import os as OS
+import json as JSON
+import time as TIME
+import zlib as ZLIB
+import pstats as PSTATS
+import cProfile as CPROFILE
+import threading as THREADING
+import tracemalloc as TRACEMALLOC
+import contextlib as CONTEXTLIB
+
+from .OpenBabel import OpenBabel
+
+# name: (type, help) of the families written to the Prometheus textfile
+_METRICS_FAMILIES = {
+  "sieveai_stage_runs_total": ("counter", "Stage runs by outcome."),
+  "sieveai_stage_active": ("gauge", "1 while the stage is running."),
+  "sieveai_stage_wall_seconds_total": ("counter", "Wall time spent in the stage."),
+  "sieveai_stage_cpu_seconds_total": ("counter", "CPU time of SieveAI and its finished subprocesses during the stage."),
+  "sieveai_stage_peak_memory_bytes": ("gauge", "Peak Python memory of the last traced run of the stage."),
+  "sieveai_items_total": ("counter", "Items settled in the job ledger by status."),
+  "sieveai_item_seconds_total": ("counter", "Recorded durations of the settled items."),
+  "sieveai_subprocess_total": ("counter", "Finished subprocess jobs by exit code."),
+  "sieveai_subprocess_seconds_total": ("counter", "Wall time of finished subprocess jobs."),
+  "sieveai_subprocess_cpu_seconds_total": ("counter", "CPU time of finished subprocess jobs."),
+  "sieveai_scheduler_running_jobs": ("gauge", "Subprocess jobs running."),
+  "sieveai_queue_items": ("gauge", "Items of the work queue by status."),
+  "sieveai_progress_done": ("gauge", "Items processed by the running stage."),
+  "sieveai_progress_total": ("gauge", "Items to be processed by the running stage."),
+  "sieveai_throughput_items_per_second": ("gauge", "Items processed per second since the stage started."),
+  "sieveai_eta_seconds": ("gauge", "Estimated seconds until the stage has processed all items."),
+  "sieveai_last_update_timestamp_seconds": ("gauge", "Time of the last metrics update."),
+}
+
+def _metrics_label(_value):
+  return str(_value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _metrics_cpu():
+  """CPU seconds of this process and of its reaped children"""
+  _times = OS.times()
+  return _times.user + _times.system + _times.children_user + _times.children_system
+
+class Metrics(OpenBabel):
+  def __init__(self, *args, **kwargs):
+    super(Metrics, self).__init__(**kwargs)
+    self.__update_attr(*args, **kwargs)
+    self.__metrics_lock = THREADING.RLock()
+    self.__metrics_values = {}
+    self.__metrics_stages = []
+    self.__metrics_progress = {}
+    self.__metrics_profiling = False
+    self.__metrics_written = 0
+    self.__metrics_started = TIME.time()
+
+  def __update_attr(self, *args, **kwargs):
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "metrics_enabled": True,
+        "file__metrics": "metrics.jsonl", # Events as JSON lines under the base directory
+        "file__metrics_prom": "metrics.prom", # Prometheus textfile under the base directory
+        "metrics_textfile_dir": None, # Textfile collector directory of node_exporter, the base directory by default
+        "metrics_interval": 30, # Seconds between progress events and textfile updates
+        "metrics_item_events": True, # One event per settled item of the job ledger
+        "metrics_profile": None, # cprofile or tracemalloc to profile stages
+        "metrics_profile_stages": None, # Stages to profile, all by default
+        "dir_metrics_profile": "profiles",
+      }
+
+    # Set all defaults
+    [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
+    self.__defaults = dict() # Unset defaults to prevent running for second time
+    [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  @property
+  def metrics_project(self):
+    return str(getattr(self, "path_base", None) or OS.getcwd())
+
+  @property
+  def metrics_textfile(self):
+    if not self.metrics_textfile_dir:
+      return f"{self.metrics_project}{OS.sep}{self.file__metrics_prom}"
+
+    # Projects share the collector directory, every project writes its own file
+    _project = OS.path.abspath(self.metrics_project)
+    _name = f"sieveai-{OS.path.basename(_project) or 'project'}-{ZLIB.crc32(_project.encode('utf8')):08x}.prom"
+    return f"{self.metrics_textfile_dir}{OS.sep}{_name}"
+
+  def metrics_event(self, *args, **kwargs):
+    """Appends an event, or one per fields of a list, to the JSON lines file of the project"""
+    _event = args[0] if len(args) > 0 else kwargs.get("event")
+    if not self.metrics_enabled or not OS.path.isdir(self.metrics_project):
+      return
+
+    _fields = args[1] if len(args) > 1 else kwargs.get("fields", {})
+    _fields = [_fields] if isinstance(_fields, dict) else _fields
+    _time = round(TIME.time(), 3)
+    _lines = "".join(JSON.dumps({"time": _time, "event": _event, "project": self.metrics_project, **_f}, default=str) + "\n" for _f in _fields)
+    with self.__metrics_lock:
+      with open(f"{self.metrics_project}{OS.sep}{self.file__metrics}", "a", encoding="utf8") as _fh:
+        _fh.write(_lines)
+
+  def metrics_add(self, *args, **kwargs):
+    """Increments a counter of the textfile"""
+    _name = args[0] if len(args) > 0 else kwargs.get("name")
+    _value = args[1] if len(args) > 1 else kwargs.get("value", 1)
+    _key = (_name, self.metrics_project, tuple(sorted((_k, str(_v)) for _k, _v in (kwargs.get("labels") or {}).items())))
+    with self.__metrics_lock:
+      self.__metrics_values[_key] = self.__metrics_values.get(_key, 0) + float(_value or 0)
+
+  def metrics_set(self, *args, **kwargs):
+    """Sets a gauge of the textfile"""
+    _name = args[0] if len(args) > 0 else kwargs.get("name")
+    _value = args[1] if len(args) > 1 else kwargs.get("value")
+    _key = (_name, self.metrics_project, tuple(sorted((_k, str(_v)) for _k, _v in (kwargs.get("labels") or {}).items())))
+    with self.__metrics_lock:
+      self.__metrics_values[_key] = float(_value or 0)
+
+  def metrics_write(self, *args, **kwargs):
+    """Writes the Prometheus textfile atomically, at most once per metrics_interval unless forced"""
+    _force = args[0] if len(args) > 0 else kwargs.get("force", False)
+    if not self.metrics_enabled or not OS.path.isdir(self.metrics_project):
+      return
+
+    with self.__metrics_lock:
+      _now = TIME.time()
+      if not _force and _now - self.__metrics_written < float(self.metrics_interval):
+        return
+      self.__metrics_written = _now
+      self.metrics_set("sieveai_last_update_timestamp_seconds", _now)
+
+      # An executable going through several base directories writes the values of each to its own file
+      _families = {}
+      for (_name, _project, _labels), _value in self.__metrics_values.items():
+        if _project == self.metrics_project:
+          _families.setdefault(_name, []).append((_labels, _value))
+
+      _lines = []
+      for _name in sorted(_families.keys()):
+        _type, _help = _METRICS_FAMILIES.get(_name, ("untyped", _name))
+        _lines.extend([f"# HELP {_name} {_help}", f"# TYPE {_name} {_type}"])
+        for _labels, _value in sorted(_families[_name]):
+          _labels = ",".join(f'{_k}="{_metrics_label(_v)}"' for _k, _v in (("project", self.metrics_project), *_labels))
+          _lines.append(f"{_name}{{{_labels}}} {_value!r}")
+
+      # node_exporter must never read a partially written file
+      _path = self.metrics_textfile
+      _temp_path = f"{_path}.{OS.getpid()}.tmp"
+      try:
+        with open(_temp_path, "w", encoding="utf8") as _fh:
+          _fh.write("\n".join(_lines) + "\n")
+        OS.replace(_temp_path, _path)
+      except OSError as _e:
+        self.utility.log_warning(f"Could not write metrics to {_path}: {_e}")
+
+  def metrics_current_stage(self):
+    with self.__metrics_lock:
+      return self.__metrics_stages[-1]["stage"] if self.__metrics_stages else None
+
+  def metrics_elapsed(self):
+    """Formatted wall time of the innermost running stage, or since the executable was created"""
+    with self.__metrics_lock:
+      _start = self.__metrics_stages[-1]["start"] if self.__metrics_stages else self.__metrics_started
+    return f"{TIME.time() - _start:.2f}s"
+
+  def __metrics_profiler(self, _stage):
+    """Starts the profiler of a stage, returns a callable stopping it and saving its report"""
+    if not self.metrics_profile or (self.metrics_profile_stages and _stage not in self.metrics_profile_stages):
+      return None
+
+    # Profilers do not nest, stages within a profiled stage are part of its report
+    with self.__metrics_lock:
+      if self.__metrics_profiling:
+        return None
+      _stop = self.__metrics_profiler_start(_stage)
+      self.__metrics_profiling = _stop is not None
+
+    if _stop is None:
+      return None
+
+    def _stop_profiling(_record):
+      try:
+        _stop(_record)
+      finally:
+        self.__metrics_profiling = False
+    return _stop_profiling
+
+  def __metrics_profiler_start(self, _stage):
+    _dir = f"{self.metrics_project}{OS.sep}{self.dir_metrics_profile}"
+    OS.makedirs(_dir, exist_ok=True)
+    _prefix = f"{_dir}{OS.sep}{_stage}.{TIME.strftime('%Y%m%d-%H%M%S')}"
+
+    if self.metrics_profile == "cprofile":
+      _profiler = CPROFILE.Profile()
+      try:
+        _profiler.enable()
+      except ValueError as _e:
+        # Another stage of a concurrent project is being profiled
+        self.utility.log_warning(f"Stage {_stage} is not profiled: {_e}")
+        return None
+
+      def _stop(_record):
+        _profiler.disable()
+        _profiler.dump_stats(f"{_prefix}.prof")
+        with open(f"{_prefix}.txt", "w", encoding="utf8") as _fh:
+          PSTATS.Stats(_profiler, stream=_fh).sort_stats("cumulative").print_stats(50)
+        _record["profile"] = f"{_prefix}.prof"
+      return _stop
+
+    if self.metrics_profile == "tracemalloc":
+      _owner = not TRACEMALLOC.is_tracing()
+      if _owner:
+        TRACEMALLOC.start(10)
+      if hasattr(TRACEMALLOC, "reset_peak"):
+        TRACEMALLOC.reset_peak()
+
+      def _stop(_record):
+        _snapshot = TRACEMALLOC.take_snapshot()
+        _record["peak_memory"] = TRACEMALLOC.get_traced_memory()[1]
+        if _owner:
+          TRACEMALLOC.stop()
+        with open(f"{_prefix}.tracemalloc.txt", "w", encoding="utf8") as _fh:
+          _fh.write(f"Peak traced memory {_record['peak_memory']} bytes\n")
+          for _stat in _snapshot.statistics("lineno")[:50]:
+            _fh.write(f"{_stat}\n")
+        _record["profile"] = f"{_prefix}.tracemalloc.txt"
+        self.metrics_set("sieveai_stage_peak_memory_bytes", _record["peak_memory"], labels={"stage": _stage})
+      return _stop
+
+    raise Exception(f"Unknown metrics_profile {self.metrics_profile}, use cprofile or tracemalloc.")
+
+  @CONTEXTLIB.contextmanager
+  def metrics_stage(self, *args, **kwargs):
+    """Times a stage with its own timer, nested stages keep their own
+
+    Yields the record of the stage which holds wall and CPU seconds once the stage is left. CPU time is
+    process wide, including subprocesses reaped meanwhile, so it overlaps between concurrent projects.
+    Stages are profiled with metrics_profile unless `profile` is False.
+    """
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+    _stop_profiler = self.__metrics_profiler(_stage) if kwargs.get("profile", True) else None
+    _record = {"stage": _stage, "start": TIME.time(), "cpu_start": _metrics_cpu(), "status": "done"}
+
+    with self.__metrics_lock:
+      self.__metrics_stages.append(_record)
+      self.__metrics_progress.pop(_stage, None)
+    self.metrics_set("sieveai_stage_active", 1, labels={"stage": _stage})
+    self.metrics_event("stage_start", {"stage": _stage})
+    self.metrics_write(True)
+
+    try:
+      yield _record
+    except BaseException as _e:
+      _record["status"], _record["error"] = "failed", repr(_e)
+      raise
+    finally:
+      if _stop_profiler:
+        try:
+          _stop_profiler(_record)
+        except Exception as _e:
+          self.utility.log_warning(f"Could not save the profile of {_stage}: {_e}")
+
+      _record["wall"] = TIME.time() - _record["start"]
+      _record["cpu"] = _metrics_cpu() - _record.pop("cpu_start")
+      with self.__metrics_lock:
+        self.__metrics_stages.remove(_record)
+
+      _labels = {"stage": _stage}
+      self.metrics_add("sieveai_stage_runs_total", 1, labels={**_labels, "status": _record["status"]})
+      self.metrics_add("sieveai_stage_wall_seconds_total", _record["wall"], labels=_labels)
+      self.metrics_add("sieveai_stage_cpu_seconds_total", _record["cpu"], labels=_labels)
+      self.metrics_set("sieveai_stage_active", 0, labels=_labels)
+      self.metrics_event("stage_end", {_k: _v for _k, _v in _record.items() if _k != "start"})
+      self.metrics_write(True)
+
+  def metrics_items(self, *args, **kwargs):
+    """Records items of a stage settled as done or failed with their exit code and duration"""
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+    _items = args[1] if len(args) > 1 else kwargs.get("items", [])
+    _status = args[2] if len(args) > 2 else kwargs.get("status", "done")
+    _duration = kwargs.get("duration")
+
+    _labels = {"stage": _stage}
+    self.metrics_add("sieveai_items_total", len(_items), labels={**_labels, "status": _status})
+    if _duration is not None:
+      self.metrics_add("sieveai_item_seconds_total", float(_duration) * len(_items), labels=_labels)
+
+    if self.metrics_item_events:
+      self.metrics_event("item", [{"stage": _stage, "item": _item, "status": _status, "exit_code": kwargs.get("exit_code"),
+        "duration": _duration, "message": kwargs.get("message")} for _item in _items])
+
+    self.metrics_write()
+
+  def metrics_subprocess(self, *args, **kwargs):
+    """Records a finished subprocess job with its exit code, wall and CPU seconds"""
+    _name = args[0] if len(args) > 0 else kwargs.get("name")
+    _returncode = args[1] if len(args) > 1 else kwargs.get("returncode")
+    _wall = args[2] if len(args) > 2 else kwargs.get("wall")
+    _cpu = kwargs.get("cpu")
+    _stage = kwargs.get("stage") or self.metrics_current_stage()
+
+    _labels = {"stage": _stage}
+    self.metrics_add("sieveai_subprocess_total", 1, labels={**_labels, "exit_code": "none" if _returncode is None else _returncode})
+    self.metrics_add("sieveai_subprocess_seconds_total", _wall, labels=_labels)
+    if _cpu is not None:
+      self.metrics_add("sieveai_subprocess_cpu_seconds_total", _cpu, labels=_labels)
+
+    self.metrics_event("subprocess", {"stage": _stage, "item": _name, "exit_code": _returncode, "wall": _wall, "cpu": _cpu, "cores": kwargs.get("cores")})
+    self.metrics_write()
+
+  def metrics_progress(self, *args, **kwargs):
+    """Updates done and total items of a stage, logs throughput and ETA every metrics_interval seconds"""
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+    _done = int(args[1] if len(args) > 1 else kwargs.get("done", 0))
+    _total = args[2] if len(args) > 2 else kwargs.get("total")
+
+    _now = TIME.time()
+    with self.__metrics_lock:
+      _state = self.__metrics_progress.setdefault(_stage, {"start": _now, "logged": _now})
+      _rate = _done / (_now - _state["start"]) if _now > _state["start"] else 0
+      _eta = (int(_total) - _done) / _rate if _total is not None and _rate > 0 else None
+      _log = _now - _state["logged"] >= float(self.metrics_interval) or (_total is not None and _done >= int(_total))
+      if _log:
+        _state["logged"] = _now
+
+    _labels = {"stage": _stage}
+    self.metrics_set("sieveai_progress_done", _done, labels=_labels)
+    self.metrics_set("sieveai_throughput_items_per_second", _rate, labels=_labels)
+    if _total is not None:
+      self.metrics_set("sieveai_progress_total", _total, labels=_labels)
+      self.metrics_set("sieveai_eta_seconds", _eta or 0, labels=_labels)
+    if "running" in kwargs:
+      self.metrics_set("sieveai_scheduler_running_jobs", kwargs.get("running"), labels=_labels)
+
+    if _log:
+      _eta_text = f", ETA {_eta / 60:.1f} min" if _eta is not None else ""
+      self.utility.log_info(f"{_stage}: {_done}/{_total if _total is not None else '?'} at {_rate * 60:.1f}/min{_eta_text}.")
+      self.metrics_event("progress", {"stage": _stage, "done": _done, "total": _total, "throughput": _rate, "eta": _eta, "running": kwargs.get("running")})
+    self.metrics_write()
+
+  def metrics_queue(self, *args, **kwargs):
+    """Records the number of items of a work queue stage by status"""
+    _stage = args[0] if len(args) > 0 else kwargs.get("stage")
+    _counts = args[1] if len(args) > 1 else kwargs.get("counts", {})
+
+    for _status in set(["pending", "leased", "done", "failed", *_counts.keys()]):
+      self.metrics_set("sieveai_queue_items", _counts.get(_status, 0), labels={"stage": _stage, "status": _status})
+    self.metrics_event("queue", {"stage": _stage, "counts": _counts})
+    self.metrics_write()
@@ -1,3 +1,9 @@
+import os as OS
+import re as REGEX
+import gzip as GZIP
+import mmap as MMAP
+import numpy as NP
+
 from .ChimeraX import ChimeraX
 
 class MolConverter(ChimeraX):
@@ -8,6 +14,8 @@ class MolConverter(ChimeraX):
   def __update_attr(self, *args, **kwargs):
     if not hasattr(self, "__defaults"): self.__defaults =  {
       "utility": None,
+      "dir_library_cache": "ligand-library",
+      "path_library_cache": None,
     }
 
     # Set all defaults
@@ -16,75 +24,197 @@ class MolConverter(ChimeraX):
     [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
 
   def mol_split_sdf(self, *args, **kwargs):
+    """Writes every molecule of an SDF library next to it as its own file, returns their paths"""
     _file_path = args[0] if len(args) > 0 else kwargs.get("file_path")
     _ext_to = args[2] if len(args) > 2 else kwargs.get("ext_to", "sdf")
-    _sdf_id_delimiter = args[3] if len(args) > 3 else kwargs.get("id_delimiter", "> <SYBYL.NAME>")
-    _sdf_model_delimiter = args[4] if len(args) > 4 else kwargs.get("model_delimiter", "$$$$")
 
-    _new_fn = None
-    _last_line = ""
+    _file_dir = OS.path.dirname(_file_path)
     _splitted_sdf_files = []
-    with open(_file_path, 'r', encoding='UTF8') as _fh:
-      _model_n_content = []
-      for _line in _fh:
-        _line = _line.strip('\n')
-        if _last_line.startswith(_sdf_id_delimiter):
-          _new_fn = _line
-        elif _new_fn is None:
-          _new_fn = _line
-
-        if _line.startswith(_sdf_model_delimiter):
-          _file_dir = self.utility.file_dir(_file_path)
-          _new_fp = f"{_file_dir}/{_new_fn}.{_ext_to}"
-          if not self.utility.check_path(_new_fp):
-            self.utility.write(_new_fp, _model_n_content)
-            self.utility.log_info(f"{_new_fp} splitted from {_file_path}.")
-          else:
-            self.utility.log_warning(f"{_new_fp} already exists. Skipping writing.")
-
-          _splitted_sdf_files.append(_new_fp)
-          _model_n_content = []
-        else:
-          _model_n_content.append(_line)
-
-        _last_line = _line
+    for _name, _content in self.mol_library_iter(self.mol_library_index(_file_path)):
+      _new_fp = f"{_file_dir}{OS.sep}{_name}.{_ext_to}"
+      if not OS.path.isfile(_new_fp):
+        with open(_new_fp, "wb") as _fh:
+          _fh.write(_content)
+      _splitted_sdf_files.append(_new_fp)
 
+    self.utility.log_info(f"{len(_splitted_sdf_files)} molecule(s) splitted from {_file_path}.")
     return _splitted_sdf_files
 
   def mol_validate_sdf(self, *args, **kwargs):
+    """Files of the molecules of an SDF, split from it when it holds more than one"""
     _file_path = args[0] if len(args) > 0 else kwargs.get("file_path")
-    _sdf_list = []
-    _model_count = 0
-    with open(_file_path, 'r', encoding='UTF8') as _fh:
-      for _line in _fh:
-        if _line.startswith("$$$$"):
-          _model_count += 1
-
-    if _model_count > 1:
-      _splitted_files = self.mol_split_sdf(_file_path, **kwargs)
-      _sdf_list.extend(_splitted_files)
-    else:
-      _sdf_list.append(_file_path)
+    if self.mol_library_index(_file_path)["count"] > 1:
+      return self.mol_split_sdf(_file_path, **kwargs)
 
-    return _sdf_list
+    return [_file_path]
 
   def mol_split_multimodel(self, *args, **kwargs):
     _file_path = args[0] if len(args) > 0 else kwargs.get("path")
     _converted_paths = []
 
-    _file_ext = self.utility.ext(_file_path)
+    ## SDF, other formats are served from their index, see mol_library_iter
+    if self.mol_library_format(_file_path) == "sdf":
+      _converted_paths.extend(self.mol_validate_sdf(_file_path, **kwargs))
 
-    ## SDF
-    if _file_ext == "sdf":
-      _sdf_list = self.mol_validate_sdf(_file_path, **kwargs)
-      _converted_paths.extend(_sdf_list)
+    return _converted_paths
 
-    ## PDB
-    if _file_ext == "pdb":
-      # self.validate_pdb(_mol_path, **kwargs)
-      pass
+  def mol_library_format(self, *args, **kwargs):
+    """Molecule format of a (gzipped) library file: sdf, mol2, pdb or None"""
+    _file_path = args[0] if len(args) > 0 else kwargs.get("path")
+    _name = _file_path[:-3] if _file_path.endswith(".gz") else _file_path
+    _ext = _name.rsplit(".", 1)[-1].lower()
+    return _ext if _ext in ("sdf", "mol2", "pdb") else None
 
-    return _converted_paths
+  def __mol_record_bounds(self, _fh, _format, _out=None):
+    """Scans a file once returning (start, end, name) of every molecule, optionally copying the bytes to _out"""
+    _records = []
+    _pos, _start, _name, _previous = 0, None, None, b""
+
+    for _line in _fh:
+      if _out is not None:
+        _out.write(_line)
+
+      if _format == "sdf":
+        if _start is None:
+          _start, _name = _pos, _line.strip()
+        elif _previous.startswith(b"> <SYBYL.NAME>"):
+          _name = _line.strip()
+        if _line.startswith(b"$$$$"):
+          _records.append((_start, _pos + len(_line), _name))
+          _start = None
+      elif _format == "mol2":
+        if _line.startswith(b"@<TRIPOS>MOLECULE"):
+          if _start is not None:
+            _records.append((_start, _pos, _name))
+          _start, _name = _pos, None
+        elif _start is not None and _name is None:
+          _name = _line.strip()
+      elif _format == "pdb":
+        if _line.startswith(b"MODEL"):
+          _start, _name = _pos, _line.split()[1] if len(_line.split()) > 1 else None
+        elif _line.startswith(b"ENDMDL") and _start is not None:
+          _records.append((_start, _pos + len(_line), _name))
+          _start = None
+
+      _previous = _line
+      _pos += len(_line)
+
+    # Last record without terminator, or a PDB without models
+    if _format == "pdb" and not _records and _pos:
+      _records.append((0, _pos, None))
+    elif _start is not None and _pos > _start and (_format == "mol2" or _name):
+      _records.append((_start, _pos, _name))
+
+    return _records
+
+  def __mol_library_stem(self, _file_path):
+    return OS.path.basename(_file_path).split(".")[0]
+
+  def __mol_record_names(self, _file_path, _format, _names):
+    """File-safe unique molecule names, falling back to the library name and serial number
+
+    Models of a PDB are numbered in every file, they are named after the library as `{library}_{model}`.
+    """
+    _stem = self.__mol_library_stem(_file_path)
+    _unique = []
+    _seen = set()
+    for _idx, _name in enumerate(_names, 1):
+      _name = REGEX.sub(r"[^\w.+-]+", "_", (_name or b"").decode("utf8", errors="replace")).strip("_.")
+      if _name and _format == "pdb":
+        _name = f"{_stem}_{_name}"
+      if not _name or _name in _seen:
+        _name = f"{_stem}_{_idx}"
+      _seen.add(_name)
+      _unique.append(_name)
+
+    return _unique
+
+  def mol_library_unique(self, *args, **kwargs):
+    """Indexes with molecule names unique across all of them and the `taken` names, in the order given
+
+    Titles of SDF and MOL2 molecules are unique within their file only. A name used by an earlier library
+    or taken is prefixed with the library name, and numbered if that is used as well.
+    """
+    _indexes = args[0] if len(args) > 0 else kwargs.get("indexes", [])
+    _taken = set(args[1] if len(args) > 1 else kwargs.get("taken", []))
+
+    _unique = []
+    for _index in _indexes:
+      _stem = self.__mol_library_stem(_index["source"])
+      _names = []
+      for _name in _index["names"]:
+        if _name in _taken:
+          _renamed, _serial = f"{_stem}_{_name}", 1
+          while _renamed in _taken:
+            _serial += 1
+            _renamed = f"{_stem}_{_name}_{_serial}"
+          _name = _renamed
+        _taken.add(_name)
+        _names.append(_name)
+      _unique.append({**_index, "names": _names})
+
+    return _unique
+
+  def mol_library_index(self, *args, **kwargs):
+    """Byte offset index of the molecules in an SDF, MOL2 or multi-model PDB file, plain or gzipped
+
+    The file is scanned once. Gzipped libraries are decompressed during that scan. Index and data of
+    multi-molecule libraries persist under path_library_cache and are reused while the source is unchanged.
+    """
+    _file_path = args[0] if len(args) > 0 else kwargs.get("path")
+    _format = self.mol_library_format(_file_path)
+    _stat = OS.stat(_file_path)
+
+    if self.path_library_cache is None:
+      self.path_library_cache = f"{self.path_base}{OS.sep}{self.dir_library_cache}"
+
+    _cache_name = OS.path.basename(_file_path)
+    _index_path = f"{self.path_library_cache}{OS.sep}{_cache_name}.idx.npz"
+    _data_path = f"{self.path_library_cache}{OS.sep}{_cache_name[:-3]}" if _file_path.endswith(".gz") else _file_path
+
+    if OS.path.isfile(_index_path) and OS.path.isfile(_data_path):
+      _saved = NP.load(_index_path)
+      if int(_saved["size"]) == _stat.st_size and int(_saved["mtime"]) == _stat.st_mtime_ns:
+        return {"source": _file_path, "data": _data_path, "format": _format,
+                "bounds": _saved["bounds"], "names": _saved["names"].tolist(), "count": _saved["bounds"].shape[0]}
+
+    if _file_path.endswith(".gz"):
+      OS.makedirs(self.path_library_cache, exist_ok=True)
+      with GZIP.open(_file_path, "rb") as _fh, open(f"{_data_path}.tmp", "wb") as _out:
+        _records = self.__mol_record_bounds(_fh, _format, _out)
+      OS.replace(f"{_data_path}.tmp", _data_path)
+    else:
+      with open(_file_path, "rb") as _fh:
+        _records = self.__mol_record_bounds(_fh, _format)
+
+    _bounds = NP.array([(_r[0], _r[1]) for _r in _records], dtype=NP.int64).reshape(-1, 2)
+    _names = self.__mol_record_names(_file_path, _format, [_r[2] for _r in _records])
+
+    # Single molecule files are not libraries and do not need a persistent index
+    if _bounds.shape[0] > 1 or _file_path.endswith(".gz"):
+      OS.makedirs(self.path_library_cache, exist_ok=True)
+      with open(f"{_index_path}.tmp", "wb") as _fh:
+        NP.savez(_fh, bounds=_bounds, names=NP.array(_names, dtype=str), size=_stat.st_size, mtime=_stat.st_mtime_ns)
+      OS.replace(f"{_index_path}.tmp", _index_path)
+
+    return {"source": _file_path, "data": _data_path, "format": _format, "bounds": _bounds, "names": _names, "count": _bounds.shape[0]}
+
+  def mol_library_iter(self, *args, **kwargs):
+    """Yields (name, bytes) of the molecules of an indexed library read through mmap, optionally only `names`"""
+    _index = args[0] if len(args) > 0 else kwargs.get("index")
+    _only = kwargs.get("names")
+
+    if not _index["count"]:
+      return
+
+    with open(_index["data"], "rb") as _fh, MMAP.mmap(_fh.fileno(), 0, access=MMAP.ACCESS_READ) as _mm:
+      for (_start, _end), _name in zip(_index["bounds"], _index["names"]):
+        if _only is None or _name in _only:
+          yield _name, _mm[_start:_end]
+
+  def __mol_read(self, _file_path):
+    with open(_file_path, "rb") as _fh:
+      return _fh.read()
 
   def mol_convert_molecules(self, *args, **kwargs):
     _dir_path = args[0] if len(args) > 0 else kwargs.get("path")
@@ -97,20 +227,30 @@ class MolConverter(ChimeraX):
 
     self.utility.log_info(f"Processing {len(_file_paths)} molecules for conversion to {_ext_to}.")
 
-    # Split and get paths if there are multimodel
+    _exclude = kwargs.get("exclude")
+
+    # Multi-molecule libraries are served from their index instead of being split, see mol_library_iter
     for _mol_path in _file_paths:
-      _files_to_convert.extend(self.mol_split_multimodel(_mol_path))
+      if _exclude is not None:
+        if OS.path.basename(_mol_path) in _exclude:
+          continue
+      elif self.mol_library_format(_mol_path) and self.mol_library_index(_mol_path)["count"] > 1:
+        continue
+      _files_to_convert.append(_mol_path)
 
-    # Convert the single file
+    # Convert the single files in batches grouped by directory and format
+    _batches = {}
     for _mol_path in _files_to_convert:
       _file_ext = self.utility.ext(_mol_path)
       _converted_path = self.utility.change_ext(_mol_path, _ext_to)
       _files_converted.append(_converted_path)
 
       if not self.utility.check_path(_converted_path):
-        # Convert to the extension using OpenBabel
-        self.utility.log_info(f"Writing conversion to {_converted_path}")
-        _command = f"""obabel -i{_file_ext} {_mol_path} -o{_ext_to} -O {_converted_path} """
-        _output = self.utility.cmd_run(_command)
+        _batches.setdefault((OS.path.dirname(_converted_path), _file_ext), []).append(_mol_path)
+
+    for (_out_dir, _file_ext), _mol_paths in _batches.items():
+      self.utility.log_info(f"Writing conversion of {len(_mol_paths)} molecule(s) to {_out_dir}")
+      _records = ((OS.path.splitext(OS.path.basename(_mol_path))[0], self.__mol_read(_mol_path)) for _mol_path in _mol_paths)
+      self.openbabel_convert_batch(_records, _file_ext, _ext_to, _out_dir, args=[])
 
     return _files_converted
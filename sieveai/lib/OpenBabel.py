@@ -1,12 +1,158 @@
+import os as OS
+import shutil as SHUTIL
+import tempfile as TEMPFILE
+import itertools as ITERTOOLS
+import subprocess as SUBPROCESS
+import concurrent.futures as FUTURES
+from concurrent.futures import ProcessPoolExecutor
+
+_PYBEL = False
+
+def _pybel():
+  """OpenBabel Python bindings imported on first use, None when they are not installed"""
+  global _PYBEL
+  if _PYBEL is False:
+    try:
+      from openbabel import pybel as PYBEL
+      _PYBEL = PYBEL
+    except ImportError:
+      _PYBEL = None
+  return _PYBEL
+
+def _openbabel_convert_pybel(_records, _format_in, _format_out, _out_paths, _args):
+  """Converts molecules in-process, each molecule failing on its own"""
+  _results = []
+  for (_name, _molecule), _out_path in zip(_records, _out_paths):
+    try:
+      _mol = _pybel().readstring(_format_in, _molecule.decode("utf8", errors="replace"))
+      if "-h" in _args:
+        _mol.addh()
+      _mol.write(_format_out, _out_path, overwrite=True)
+      _results.append((_name, "done", None))
+    except Exception as _e:
+      _results.append((_name, "failed", str(_e)))
+
+  return _results
+
+def _openbabel_convert_cli(_bin, _records, _format_in, _format_out, _out_paths, _args, _timeout):
+  """Converts a chunk of molecules with one obabel process reading stdin and splitting the output with -m
+
+  obabel numbers the split files by successful molecules only, so the outputs are mapped back to the
+  input molecules only when all of them converted. Otherwise the chunk is halved until the failing
+  molecules are isolated.
+  """
+  _temp_dir = TEMPFILE.mkdtemp(prefix=".obabel-", dir=OS.path.dirname(_out_paths[0]) or ".")
+  try:
+    _output = SUBPROCESS.run([_bin, f"-i{_format_in}", f"-o{_format_out}", "-O", OS.path.join(_temp_dir, f"mol.{_format_out}"), "-m", *_args],
+      input=b"".join(_molecule if _molecule.endswith(b"\n") else _molecule + b"\n" for _name, _molecule in _records),
+      capture_output=True, timeout=_timeout)
+    _message = _output.stderr.decode("utf8", errors="replace").strip()[-1000:] or None
+
+    _converted = [OS.path.join(_temp_dir, f"mol{_i}.{_format_out}") for _i in range(1, len(_records) + 1)]
+    if len(_records) == 1 and not OS.path.isfile(_converted[0]):
+      # Some versions write a single molecule without a number
+      _converted = [OS.path.join(_temp_dir, f"mol.{_format_out}")]
+
+    if all(OS.path.isfile(_f) and OS.path.getsize(_f) for _f in _converted):
+      for _converted_path, _out_path in zip(_converted, _out_paths):
+        OS.replace(_converted_path, _out_path)
+      return [(_name, "done", _message) for _name, _molecule in _records]
+  except SUBPROCESS.TimeoutExpired:
+    _message = f"Timed out after {_timeout} seconds."
+  except OSError as _e:
+    return [(_name, "failed", str(_e)) for _name, _molecule in _records]
+  finally:
+    SHUTIL.rmtree(_temp_dir, ignore_errors=True)
+
+  if len(_records) == 1:
+    return [(_records[0][0], "failed", _message)]
+
+  _half = len(_records) // 2
+  return _openbabel_convert_cli(_bin, _records[:_half], _format_in, _format_out, _out_paths[:_half], _args, _timeout) + \
+    _openbabel_convert_cli(_bin, _records[_half:], _format_in, _format_out, _out_paths[_half:], _args, _timeout)
+
+def _openbabel_convert_chunk(_backend, _bin, _records, _format_in, _format_out, _out_paths, _args, _timeout):
+  if _backend == "pybel":
+    return _openbabel_convert_pybel(_records, _format_in, _format_out, _out_paths, _args)
+
+  return _openbabel_convert_cli(_bin, _records, _format_in, _format_out, _out_paths, _args, _timeout)
 
 class OpenBabel():
   def __init__(self, *args, **kwargs):
     self.__update_attr(*args, **kwargs)
 
   def __update_attr(self, *args, **kwargs):
-    if not hasattr(self, "__defaults"): self.__defaults =  {}
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "openbabel_bin": "obabel",
+        "openbabel_backend": "auto", # pybel when the bindings are installed, obabel otherwise
+        "openbabel_batch_size": 100, # Molecules per obabel invocation
+        "openbabel_workers": None, # All logical cores by default
+        "openbabel_timeout": 600, # Seconds per chunk
+      }
 
     # Set all defaults
     [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
     self.__defaults = dict() # Unset defaults to prevent running for second time
     [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  @property
+  def openbabel_active_backend(self):
+    if self.openbabel_backend == "pybel" and _pybel() is None:
+      raise Exception("OpenBabel Python bindings are not installed.")
+
+    if self.openbabel_backend == "auto":
+      return "pybel" if _pybel() is not None else "obabel"
+
+    return self.openbabel_backend
+
+  def openbabel_convert_batch(self, *args, **kwargs):
+    """Converts an iterable of (name, bytes) molecules in chunks across a process pool
+
+    Each molecule is written to `{out_dir}/{name}.{format_out}`. Returns {name: (status, message)} so that
+    failures are tracked per molecule. Only `-h` is understood by the pybel backend, other arguments are
+    passed to obabel as they are.
+    """
+    _records = args[0] if len(args) > 0 else kwargs.get("records", [])
+    _format_in = args[1] if len(args) > 1 else kwargs.get("format_in")
+    _format_out = args[2] if len(args) > 2 else kwargs.get("format_out", "pdbqt")
+    _out_dir = args[3] if len(args) > 3 else kwargs.get("out_dir")
+    _args = list(kwargs.get("args", ["-h"]))
+
+    _backend = self.openbabel_active_backend
+    if _backend == "pybel" and set(_args).difference(["-h"]):
+      _backend = "obabel"
+
+    _batch_size = max(1, int(self.openbabel_batch_size))
+    _workers = max(1, int(self.openbabel_workers or OS.cpu_count() or 1))
+    self.utility.log_info(f"Converting molecules from {_format_in} to {_format_out} in chunks of {_batch_size} using {_backend}.")
+
+    _results = {}
+    def _collect(_future):
+      for _name, _status, _message in _future.result():
+        _results[_name] = (_status, _message)
+
+    # Records are pulled lazily and only a few chunks per worker are held in memory
+    _records = iter(_records)
+    _pending = set()
+    with ProcessPoolExecutor(max_workers=_workers) as _executor:
+      while True:
+        _chunk = list(ITERTOOLS.islice(_records, _batch_size))
+        if not _chunk:
+          break
+
+        _pending.add(_executor.submit(_openbabel_convert_chunk, _backend, self.openbabel_bin, _chunk, _format_in, _format_out,
+          [OS.path.join(_out_dir, f"{_name}.{_format_out}") for _name, _molecule in _chunk], _args, self.openbabel_timeout))
+
+        if len(_pending) >= 2 * _workers:
+          _finished, _pending = FUTURES.wait(_pending, return_when=FUTURES.FIRST_COMPLETED)
+          for _future in _finished:
+            _collect(_future)
+
+      for _future in FUTURES.as_completed(_pending):
+        _collect(_future)
+
+    _failed = [_name for _name, (_status, _message) in _results.items() if _status != "done"]
+    if _failed:
+      self.utility.log_warning(f"{len(_failed)}/{len(_results)} molecule(s) could not be converted: {', '.join(_failed[:20])}")
+
+    return _results
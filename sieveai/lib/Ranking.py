@@ -0,0 +1,142 @@
+import numpy as NP
+import pandas as PD
+
+from .ResultSink import ResultSink
+
+class Ranking(ResultSink):
+  def __init__(self, *args, **kwargs):
+    super(Ranking, self).__init__(**kwargs)
+    self.__update_attr(*args, **kwargs)
+
+  def __update_attr(self, *args, **kwargs):
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "ranking_attributes": ["contacts_count", "hbonds_count", "conformer_score"],
+        "ranking_keys": ["receptor", "ligand"],
+        "ranking_memory_rows": 5000000, # Larger tables are ranked partition by partition
+      }
+
+    # Set all defaults
+    [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
+    self.__defaults = dict() # Unset defaults to prevent running for second time
+    [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  def ranking_columns(self):
+    return [f"rank__{_col}__{_attr}" for _col in self.ranking_keys for _attr in self.ranking_attributes]
+
+  def ranking_add_ids(self, *args, **kwargs):
+    """Adds complex_id and complex_uid, meant for the few rows that are exported"""
+    _df = args[0] if len(args) > 0 else kwargs.get("df")
+    _df["complex_id"] = _df["receptor"].astype(str) + "--" + _df["ligand"].astype(str)
+    _df["complex_uid"] = _df["complex_id"] + "--" + _df["conformer_id"].astype(str)
+    return _df
+
+  def ranking_score(self, *args, **kwargs):
+    """Ranks every attribute within receptor and ligand groups (descending, ties averaged) and sums them to ranking_score"""
+    _df = args[0] if len(args) > 0 else kwargs.get("df")
+    _df = _df.copy()
+
+    for _attr in self.ranking_attributes:
+      _df[_attr] = PD.to_numeric(_df[_attr], errors='coerce')
+      _df[_attr] = _df[_attr].fillna(_df[_attr].mean())
+
+    for _col in self.ranking_keys:
+      # Integer codes group much faster than strings
+      _codes = PD.Categorical(_df[_col]).codes
+      _grouped = _df[self.ranking_attributes].groupby(_codes, sort=False)
+      for _attr in self.ranking_attributes:
+        _df[f"rank__{_col}__{_attr}"] = _grouped[_attr].rank(ascending=False)
+
+    _df["ranking_score"] = _df[self.ranking_columns()].sum(axis="columns")
+    return _df
+
+  def ranking_top(self, *args, **kwargs):
+    """Top `k` rows by ranking_score per group of `by` columns, the first row wins ties"""
+    _df = args[0] if len(args) > 0 else kwargs.get("df")
+    _by = list(args[1] if len(args) > 1 else kwargs.get("by", ["receptor", "ligand"]))
+    _k = int(kwargs.get("k", 1))
+
+    if _k == 1:
+      _codes = _df.groupby(_by, sort=False, observed=True).ngroup()
+      _best = _df["ranking_score"].groupby(_codes.values, sort=False).idxmin()
+      return _df.loc[NP.sort(_best.values)].reset_index(drop=True)
+
+    return _df.sort_values("ranking_score", kind="stable").groupby(_by, sort=False).head(_k).reset_index(drop=True)
+
+  def __ranking_counts(self, _parts):
+    """First pass: per key value counts of every attribute and the attribute means
+
+    Counts are folded part by part, so memory is bounded by the distinct (key, value) pairs and not by the
+    rows. Vina scores have one decimal and contact counts are small integers, so a key holds a few hundred
+    values however many poses it has. A continuous attribute can reach one value per row.
+    """
+    _counts = {(_col, _attr): None for _col in self.ranking_keys for _attr in self.ranking_attributes}
+    _sums = {_attr: [0.0, 0] for _attr in self.ranking_attributes}
+
+    for _part in _parts:
+      for _attr in self.ranking_attributes:
+        _part[_attr] = PD.to_numeric(_part[_attr], errors='coerce')
+        _sums[_attr][0] += float(_part[_attr].sum())
+        _sums[_attr][1] += int(_part[_attr].notna().sum())
+        for _col in self.ranking_keys:
+          _size = _part.groupby([_col, _attr], sort=False, dropna=False).size()
+          if _counts[(_col, _attr)] is not None:
+            _size = PD.concat([_counts[(_col, _attr)], _size]).groupby(level=[0, 1], sort=False, dropna=False).sum()
+          _counts[(_col, _attr)] = _size
+
+    _means = {_attr: (_sum / _n if _n else NP.nan) for _attr, (_sum, _n) in _sums.items()}
+
+    _ranks = {}
+    for (_col, _attr), _series in _counts.items():
+      if _series is None:
+        _series = PD.Series([], dtype="int64", index=PD.MultiIndex.from_arrays([[], []], names=[_col, _attr]))
+      _table = _series.rename("count").reset_index()
+      _table[_attr] = _table[_attr].fillna(_means[_attr])
+      _table = _table.groupby([_col, _attr], sort=False)["count"].sum().reset_index()
+
+      # Average descending rank of a value is the number of greater values plus the midpoint of its ties
+      _table = _table.sort_values([_col, _attr], ascending=[True, False], kind="stable")
+      _greater = _table.groupby(_col, sort=False)["count"].cumsum() - _table["count"]
+      _table["rank"] = _greater + (_table["count"] + 1) / 2
+      _ranks[(_col, _attr)] = _table.set_index([_col, _attr])["rank"]
+
+    return _ranks, _means
+
+  def ranking_stream(self, *args, **kwargs):
+    """Ranks a result table partition by partition in two passes, holding only value counts and top rows, see __ranking_counts
+
+    Returns the top `k` rows per `by` group and the first `head` ranked rows. Both passes read the parts
+    through sink_iter, complexes appended twice are ranked once and scores equal those of ranking_score
+    on sink_read of the table.
+    """
+    _table = args[0] if len(args) > 0 else kwargs.get("table", "interactions")
+    _by = list(kwargs.get("by", ["receptor", "ligand"]))
+    _k = int(kwargs.get("k", 1))
+    _head = int(kwargs.get("head", 0))
+
+    _ranks, _means = self.__ranking_counts(self.sink_iter(_table))
+
+    _best = None
+    _head_rows = []
+    _head_count = 0
+    for _part in self.sink_iter(_table):
+      for _attr in self.ranking_attributes:
+        _part[_attr] = PD.to_numeric(_part[_attr], errors='coerce').fillna(_means[_attr])
+
+      for _col in self.ranking_keys:
+        for _attr in self.ranking_attributes:
+          _index = PD.MultiIndex.from_arrays([_part[_col], _part[_attr]])
+          _part[f"rank__{_col}__{_attr}"] = _ranks[(_col, _attr)].reindex(_index).values
+
+      _part["ranking_score"] = _part[self.ranking_columns()].sum(axis="columns")
+
+      if _head_count < _head:
+        _head_rows.append(_part.head(_head - _head_count))
+        _head_count += _head_rows[-1].shape[0]
+
+      # Bounded top-k: only the best rows of each group are carried to the next partition
+      _candidates = self.ranking_top(_part, _by, k=_k)
+      _best = _candidates if _best is None else self.ranking_top(PD.concat([_best, _candidates], ignore_index=True), _by, k=_k)
+
+    _best = _best if _best is not None else PD.DataFrame()
+    _head_rows = PD.concat(_head_rows, ignore_index=True) if _head_rows else PD.DataFrame()
+    return _best, _head_rows
@@ -0,0 +1,160 @@
+import os as OS
+import time as TIME
+import shutil as SHUTIL
+import pandas as PD
+
+_PARQUET = False
+
+def _parquet():
+  """(pyarrow, pyarrow.parquet) imported on first use as they are slow to load, None when not installed"""
+  global _PARQUET
+  if _PARQUET is False:
+    try:
+      import pyarrow as PA
+      import pyarrow.parquet as PQ
+      _PARQUET = (PA, PQ)
+    except ImportError:
+      _PARQUET = None
+  return _PARQUET
+
+from .LeaseQueue import LeaseQueue
+
+class ResultSink(LeaseQueue):
+  def __init__(self, *args, **kwargs):
+    super(ResultSink, self).__init__(**kwargs)
+    self.__update_attr(*args, **kwargs)
+
+  def __update_attr(self, *args, **kwargs):
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "dir_results": "results",
+        "sink_format": None, # parquet when pyarrow is installed, csv otherwise
+        "sink_flush_rows": 50000, # Rows buffered by a stage before a part is written
+        "sink_excel_max_rows": 100000, # Excel holds at most 1,048,576 rows per sheet
+        "sink_keys": ["receptor", "ligand"], # Parts hold whole complexes, one appended again by an interrupted run is read from its first part
+      }
+
+    # Set all defaults
+    [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
+    self.__defaults = dict() # Unset defaults to prevent running for second time
+    [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  @property
+  def sink_active_format(self):
+    if self.sink_format == "parquet" and _parquet() is None:
+      raise Exception("pyarrow is required for the parquet result sink.")
+
+    return self.sink_format or ("parquet" if _parquet() is not None else "csv")
+
+  def sink_path(self, *args, **kwargs):
+    """Directory of the parts of a result table"""
+    _table = args[0] if len(args) > 0 else kwargs.get("table")
+    return f"{self.path_base}{OS.sep}{self.dir_results}{OS.sep}{_table}"
+
+  def __sink_parts(self, _table):
+    _path = self.sink_path(_table)
+    if not OS.path.isdir(_path):
+      return []
+
+    # Part names start with the write time so that sorting keeps the append order
+    with OS.scandir(_path) as _entries:
+      return sorted(_entry.path for _entry in _entries if _entry.name.startswith("part-") and _entry.name.endswith((".parquet", ".csv")))
+
+  def sink_append(self, *args, **kwargs):
+    """Appends rows, given as DataFrame or {column: values}, to a table as a new immutable part"""
+    _table = args[0] if len(args) > 0 else kwargs.get("table")
+    _rows = args[1] if len(args) > 1 else kwargs.get("rows")
+
+    _rows = _rows if isinstance(_rows, PD.DataFrame) else PD.DataFrame(_rows)
+    if not _rows.shape[0]:
+      return None
+
+    _path = self.sink_path(_table)
+    OS.makedirs(_path, exist_ok=True)
+    _format = self.sink_active_format
+    _part = f"{_path}{OS.sep}part-{TIME.time_ns():020d}-{OS.getpid()}.{_format}"
+
+    # Readers never see a partially written part
+    _temp = f"{_part}.tmp"
+    if _format == "parquet":
+      _PA, _PQ = _parquet()
+      _PQ.write_table(_PA.Table.from_pandas(_rows, preserve_index=False), _temp)
+    else:
+      _rows.to_csv(_temp, index=False)
+    OS.replace(_temp, _part)
+
+    return _part
+
+  def __sink_unique(self, _part, _keys, _seen):
+    """Drops the rows of keys read from earlier parts, `_seen` is updated with the keys of this part"""
+    _part_keys = _part[_keys].astype(str)
+    _unique = list(_part_keys.drop_duplicates().itertuples(index=False, name=None))
+    _repeated = [_key for _key in _unique if _key in _seen]
+    _seen.update(_unique)
+    if not _repeated:
+      return _part
+
+    return _part[~PD.MultiIndex.from_frame(_part_keys).isin(_repeated)].reset_index(drop=True)
+
+  def sink_iter(self, *args, **kwargs):
+    """Yields the parts of a table as DataFrames in append order, optionally only `columns`
+
+    Rows of a `unique` key (sink_keys by default, [] for all rows) are read from the first part holding it.
+    """
+    _table = args[0] if len(args) > 0 else kwargs.get("table")
+    _columns = kwargs.get("columns")
+    _unique = list(kwargs.get("unique", self.sink_keys) or [])
+    _read = None if _columns is None else list(dict.fromkeys([*_columns, *_unique]))
+
+    _seen = set()
+    for _part in self.__sink_parts(_table):
+      if _part.endswith(".parquet"):
+        _df = _parquet()[1].read_table(_part, columns=_read).to_pandas()
+      else:
+        _df = PD.read_csv(_part, usecols=_read, keep_default_na=False, na_values=[""])
+
+      if _unique and set(_unique).issubset(_df.columns):
+        _df = self.__sink_unique(_df, _unique, _seen)
+      yield _df if _columns is None else _df[_columns]
+
+  def sink_read(self, *args, **kwargs):
+    """Whole table as one DataFrame, empty when nothing was appended"""
+    _parts = list(self.sink_iter(*args, **kwargs))
+    return PD.concat(_parts, ignore_index=True) if len(_parts) else PD.DataFrame()
+
+  def sink_exists(self, *args, **kwargs):
+    _table = args[0] if len(args) > 0 else kwargs.get("table")
+    return len(self.__sink_parts(_table)) > 0
+
+  def sink_reset(self, *args, **kwargs):
+    """Deletes all parts of a table"""
+    _table = args[0] if len(args) > 0 else kwargs.get("table")
+    SHUTIL.rmtree(self.sink_path(_table), ignore_errors=True)
+
+  def sink_export_csv(self, *args, **kwargs):
+    """Streams a table or DataFrame chunks into one CSV file, written once and replaced atomically"""
+    _chunks = args[0] if len(args) > 0 else kwargs.get("chunks")
+    _csv_path = args[1] if len(args) > 1 else kwargs.get("csv_path")
+
+    _chunks = self.sink_iter(_chunks) if isinstance(_chunks, str) else _chunks
+    _rows = 0
+    _temp = f"{_csv_path}.tmp"
+    with open(_temp, "w", encoding="utf8", newline="") as _fh:
+      for _chunk in _chunks:
+        _chunk.to_csv(_fh, index=False, header=_rows == 0)
+        _rows += _chunk.shape[0]
+    OS.replace(_temp, _csv_path)
+
+    return _rows
+
+  def sink_export_excel(self, *args, **kwargs):
+    """Writes all {sheet: DataFrame} to one workbook in a single pass, each sheet capped at sink_excel_max_rows"""
+    _excel_path = args[0] if len(args) > 0 else kwargs.get("excel_path")
+    _sheets = args[1] if len(args) > 1 else kwargs.get("sheets", {})
+
+    _max_rows = min(int(self.sink_excel_max_rows), 1048575)
+    with PD.ExcelWriter(_excel_path) as _writer:
+      for _sheet_name, _df in _sheets.items():
+        if _df.shape[0] > _max_rows:
+          self.utility.log_warning(f"Sheet '{_sheet_name}' is capped to {_max_rows} of {_df.shape[0]} rows, the CSV export has all rows.")
+          _df = _df.head(_max_rows)
+        _df.to_excel(_writer, sheet_name=_sheet_name[:31], index=False)
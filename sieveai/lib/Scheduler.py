@@ -0,0 +1,249 @@
+import os as OS
+import time as TIME
+import signal as SIGNAL
+import threading as THREADING
+import contextlib as CONTEXTLIB
+import subprocess as SUBPROCESS
+import psutil as PSUTIL
+
+from .Interactions import Interactions
+
+class Scheduler(Interactions):
+  def __init__(self, *args, **kwargs):
+    super(Scheduler, self).__init__(**kwargs)
+    self.__update_attr(*args, **kwargs)
+
+  def __update_attr(self, *args, **kwargs):
+    if not hasattr(self, "__defaults"): self.__defaults =  {
+        "scheduler_cores": None, # All logical cores by default
+        "scheduler_cpu_min": 1,
+        "scheduler_cpu_max": 4, # Cores of one job, the former fixed `vina --cpu 4`. More jobs of fewer threads keep large nodes busier than few wide Vina runs.
+        "scheduler_job_memory": 512, # MB of available memory required to start a job
+        "scheduler_max_load": 1.25, # Load average per core above which no job is started
+        "scheduler_poll_interval": 0.2,
+        "scheduler_stop_timeout": 10, # Seconds running jobs are given to exit on an interruption before they are killed
+        "scheduler_budget": None, # Cores shared with other projects, see scheduler_budget_new
+      }
+
+    # Set all defaults
+    [setattr(self, _k, self.__defaults[_k]) for _k in self.__defaults.keys() if not hasattr(self, _k)]
+    self.__defaults = dict() # Unset defaults to prevent running for second time
+    [setattr(self, _k, kwargs[_k]) for _k in kwargs.keys()]
+
+  @property
+  def scheduler_total_cores(self):
+    return int(self.scheduler_cores or PSUTIL.cpu_count(logical=True) or 1)
+
+  def scheduler_budget_new(self, *args, **kwargs):
+    """Core budget to be shared by the executables of concurrent projects through `scheduler_budget`"""
+    _cores = args[0] if len(args) > 0 else kwargs.get("cores")
+    return {"lock": THREADING.Condition(), "free": int(_cores or self.scheduler_total_cores)}
+
+  def scheduler_acquire(self, *args, **kwargs):
+    """Takes up to `cores` from the shared budget, returns the cores taken or 0 if fewer than `minimum` are free
+
+    Without a shared budget all requested cores are granted.
+    """
+    _cores = int(args[0] if len(args) > 0 else kwargs.get("cores", 1))
+    _minimum = int(kwargs.get("minimum", _cores))
+    _block = kwargs.get("block", False)
+
+    _budget = self.scheduler_budget
+    if _budget is None:
+      return _cores
+
+    with _budget["lock"]:
+      while _budget["free"] < _minimum:
+        if not _block:
+          return 0
+        _budget["lock"].wait()
+
+      _granted = min(_cores, _budget["free"])
+      _budget["free"] -= _granted
+      return _granted
+
+  def scheduler_release(self, *args, **kwargs):
+    _cores = int(args[0] if len(args) > 0 else kwargs.get("cores", 1))
+
+    _budget = self.scheduler_budget
+    if _budget is None or not _cores:
+      return
+
+    with _budget["lock"]:
+      _budget["free"] += _cores
+      _budget["lock"].notify_all()
+
+  @CONTEXTLIB.contextmanager
+  def scheduler_reserve(self, *args, **kwargs):
+    """Holds cores of the shared budget for long-lived workers such as ChimeraX sessions, waiting until they are free"""
+    _cores = int(args[0] if len(args) > 0 else kwargs.get("cores", 1))
+    _granted = self.scheduler_acquire(_cores, minimum=kwargs.get("minimum", 1), block=True)
+    try:
+      yield _granted
+    finally:
+      self.scheduler_release(_granted)
+
+  def __scheduler_throttled(self, _running):
+    """Holds back new jobs on high load or low memory, but never starves an idle scheduler"""
+    if not _running:
+      return False
+
+    if PSUTIL.virtual_memory().available < float(self.scheduler_job_memory) * 1024 * 1024:
+      return True
+
+    try:
+      _load = PSUTIL.getloadavg()[0]
+    except (AttributeError, OSError):
+      return False
+
+    return _load > self.scheduler_total_cores * float(self.scheduler_max_load)
+
+  def __scheduler_start(self, _task, _cpu):
+    _log = open(_task["log"], "w") if _task.get("log") else SUBPROCESS.DEVNULL
+    try:
+      _process = SUBPROCESS.Popen(_task["command"](_cpu), stdout=_log, stderr=SUBPROCESS.STDOUT)
+    finally:
+      if _log is not SUBPROCESS.DEVNULL:
+        _log.close()
+
+    return _process
+
+  def __scheduler_poll(self, _process):
+    """(exit code, CPU seconds) of a finished job, the CPU time is taken from the kernel where wait4 exists"""
+    if not hasattr(OS, "wait4") or _process.returncode is not None:
+      return _process.poll(), None
+
+    try:
+      _pid, _status, _usage = OS.wait4(_process.pid, OS.WNOHANG)
+    except ChildProcessError:
+      return _process.poll(), None
+
+    if _pid == 0:
+      return None, None
+
+    _process.returncode = -OS.WTERMSIG(_status) if OS.WIFSIGNALED(_status) else OS.WEXITSTATUS(_status)
+    return _process.returncode, _usage.ru_utime + _usage.ru_stime
+
+  def __scheduler_stop(self, _running):
+    """Terminates jobs left running by an interruption, kills those not exiting in time and releases their cores"""
+    if not _running:
+      return
+
+    self.utility.log_warning(f"Stopping {len(_running)} running job(s).")
+    for _process in _running:
+      if _process.returncode is None:
+        try:
+          _process.terminate()
+        except OSError:
+          pass
+
+    _deadline = TIME.time() + float(self.scheduler_stop_timeout)
+    for _process, (_task, _cpu, _start) in list(_running.items()):
+      try:
+        _process.wait(timeout=max(0, _deadline - TIME.time()))
+      except SUBPROCESS.TimeoutExpired:
+        _process.kill()
+        _process.wait()
+      except ChildProcessError:
+        pass
+      self.scheduler_release(_cpu)
+      _running.pop(_process)
+
+  @CONTEXTLIB.contextmanager
+  def __scheduler_sigterm(self):
+    """SIGTERM unwinds the main thread as an exception while jobs run, so that they are stopped instead of orphaned"""
+    def _raise(_signum, _frame):
+      raise SystemExit(128 + _signum)
+
+    try:
+      _previous = SIGNAL.signal(SIGNAL.SIGTERM, _raise)
+    except ValueError:
+      # Signal handlers can only be set by the main thread
+      yield
+      return
+
+    try:
+      yield
+    finally:
+      SIGNAL.signal(SIGNAL.SIGTERM, _previous)
+
+  def scheduler_run(self, *args, **kwargs):
+    """Packs subprocess jobs on the available cores
+
+    Tasks are dicts with a `command` callable returning the argument list for a given CPU count and an
+    optional `log` file receiving stdout and stderr. Tasks are pulled lazily from the iterable, only when
+    cores are free, so large campaigns are never materialised at once. `callback(task, returncode, seconds)`
+    is invoked as each job finishes. Jobs are recorded to the metrics of `stage`, the running stage by
+    default, with progress against the optional `total` number of tasks.
+
+    A job gets up to `cpu_max` cores, `scheduler_cpu_max` by default. Jobs still running when the loop is
+    left by an exception, such as a failing callback, KeyboardInterrupt or SIGTERM, are stopped.
+    """
+    _tasks = args[0] if len(args) > 0 else kwargs.get("tasks", [])
+    _callback = kwargs.get("callback")
+    _max_jobs = kwargs.get("max_jobs")
+    _stage = kwargs.get("stage") or self.metrics_current_stage() or "scheduler"
+
+    _total = self.scheduler_total_cores
+    _cpu_min = max(1, min(int(self.scheduler_cpu_min), _total))
+    _cpu_max = max(_cpu_min, min(int(kwargs.get("cpu_max", self.scheduler_cpu_max)), _total))
+
+    _tasks = iter(_tasks)
+    _running = {}
+    _exhausted = False
+    _summary = {"done": 0, "failed": 0}
+
+    try:
+      with self.__scheduler_sigterm():
+        while not _exhausted or _running:
+          _started = False
+          while not _exhausted and (_max_jobs is None or len(_running) < _max_jobs):
+            _free = _total - sum(_job[1] for _job in _running.values())
+            if _free < _cpu_min or self.__scheduler_throttled(_running):
+              break
+
+            # Cores are taken from the budget shared with other projects before a task is pulled
+            _cpu = self.scheduler_acquire(min(_cpu_max, _free), minimum=_cpu_min)
+            if not _cpu:
+              break
+
+            _task = next(_tasks, None)
+            if _task is None:
+              self.scheduler_release(_cpu)
+              _exhausted = True
+              break
+
+            try:
+              _process = self.__scheduler_start(_task, _cpu)
+            except OSError as _e:
+              self.scheduler_release(_cpu)
+              self.utility.log_error(f"Could not start {_task.get('name')}: {_e}")
+              _summary["failed"] += 1
+              self.metrics_subprocess(_task.get("name"), None, 0, stage=_stage, cores=_cpu)
+              if _callback:
+                _callback(_task, None, 0)
+              continue
+
+            _running[_process] = (_task, _cpu, TIME.time())
+            _started = True
+
+          for _process, (_returncode, _cpu_seconds) in [(_p, self.__scheduler_poll(_p)) for _p in list(_running.keys())]:
+            if _returncode is None:
+              continue
+            _task, _cpu, _start = _running.pop(_process)
+            _duration = TIME.time() - _start
+            self.scheduler_release(_cpu)
+            _summary["done" if _returncode == 0 else "failed"] += 1
+            if _returncode != 0:
+              self.utility.log_error(f"{_task.get('name')} exited with {_returncode}.")
+            self.metrics_subprocess(_task.get("name"), _returncode, _duration, cpu=_cpu_seconds, stage=_stage, cores=_cpu)
+            if _callback:
+              _callback(_task, _returncode, _duration)
+            self.metrics_progress(_stage, _summary["done"] + _summary["failed"], kwargs.get("total"), running=len(_running))
+
+          if not _started and (_running or not _exhausted):
+            TIME.sleep(float(self.scheduler_poll_interval))
+    finally:
+      self.__scheduler_stop(_running)
+
+    return _summary
@@ -2,5 +2,14 @@ from .ChimeraX import ChimeraX
 from .LibManager import LibManager
 from .OpenBabel import OpenBabel
 from .MolConverter import MolConverter
+from .Interactions import Interactions
+from .Scheduler import Scheduler
+from .ArtifactCache import ArtifactCache
+from .JobLedger import JobLedger
+from .ResultSink import ResultSink
+from .Ranking import Ranking
+from .Archive import Archive
+from .LeaseQueue import LeaseQueue
+from .Metrics import Metrics
 
-__all__ = ["ChimeraX", "LibManager", "OpenBabel", "MolConverter"]
+__all__ = ["ChimeraX", "LibManager", "OpenBabel", "MolConverter", "Interactions", "Scheduler", "ArtifactCache", "JobLedger", "ResultSink", "Ranking", "Archive", "LeaseQueue", "Metrics"]
@@ -1,4 +1,5 @@
 from .ProcessBase import ProcessBase
+from ..exe import Vina
 
 class Docking(ProcessBase):
   def __init__(self, *args, **kwargs):
@@ -10,7 +11,10 @@ class Docking(ProcessBase):
     kwargs_copied = kwargs.copy()
     self.utility.update_attributes(self, kwargs)
 
-    if isinstance(self.path_base, (list, set, tuple)):
+    if self.concurrent_projects():
+      self.run_projects(Vina, "run", kwargs_copied)
+
+    elif isinstance(self.path_base, (list, set, tuple)):
       for _base in self.path_base:
         kwargs_copied["path_base"] = _base
         self.vina.add(**kwargs_copied)
@@ -1,24 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
 from UtilityLib import ProjectManager
 from ..exe import Vina, AnnapuRNA
 
 class ProcessBase():
   def __init__(self, *args, **kwargs):
     if not kwargs.get("utility"):
-      # This will add db in first project dir only
-      kwargs["db_path"] = f"{kwargs.get('path_base')[0]}/SieveAI.db"
+      # This will add db in first project dir unless a database is given
+      kwargs["db_path"] = kwargs.get("db_path") or f"{kwargs.get('path_base')[0]}/SieveAI.db"
       _utility = ProjectManager(**kwargs)
       _utility.db_connect()
     else:
       _utility = getattr(self, "utility")
 
     self.utility = _utility
+    self.__settings = dict(kwargs)
 
     self.__defaults = {
       "path_base": None,
       "file_config": "config.yml",
+      "project_workers": None, # Base directories processed at once, all by default
+      "scheduler_cores": None,
       "vina": Vina(**kwargs),
       "annapurna": AnnapuRNA(**kwargs),
     }
 
     self.utility.update_attributes(self, kwargs, self.__defaults)
     self.start_time = self.utility.time_start()
+
+  def concurrent_projects(self):
+    """Whether the base directories are to be processed as concurrent projects"""
+    return isinstance(self.path_base, (list, set, tuple)) and len(self.path_base) > 1 and int(self.project_workers or len(self.path_base)) > 1
+
+  def run_projects(self, *args, **kwargs):
+    """Runs `method` of a new `executable` for every base directory in up to `project_workers` threads
+
+    Every project has its own executable, utility and database under its base directory. Jobs of all
+    projects take cores from one shared budget so that a slow stage of one project leaves the cores to
+    the others. A failing project does not stop the others.
+    """
+    _executable = args[0] if len(args) > 0 else kwargs.get("executable")
+    _method = args[1] if len(args) > 1 else kwargs.get("method")
+    _kwargs = {**self.__settings, **(args[2] if len(args) > 2 else kwargs.get("settings", {}))}
+    _kwargs.pop("utility", None)
+    _kwargs.pop("db_path", None)
+
+    _bases = list(self.path_base)
+    _workers = min(len(_bases), int(self.project_workers or len(_bases)))
+    _budget = self.vina.scheduler_budget_new(self.scheduler_cores)
+    self.utility.log_info(f"Processing {len(_bases)} projects, {_workers} at once, sharing {_budget['free']} cores.")
+
+    def _run_project(_base):
+      _project = _executable(**{**_kwargs, "path_base": [_base], "scheduler_budget": _budget})
+      _project.add(**{**_kwargs, "path_base": _base, "scheduler_budget": _budget})
+      return getattr(_project, _method)()
+
+    _failed = []
+    with ThreadPoolExecutor(max_workers=_workers) as _executor:
+      _futures = {_base: _executor.submit(_run_project, _base) for _base in _bases}
+      for _base, _future in _futures.items():
+        try:
+          _future.result()
+          self.utility.log_info(f"Project {_base} completed.")
+        except Exception as _e:
+          _failed.append(_base)
+          self.utility.log_error(f"Project {_base} failed: {_e}")
+
+    if _failed:
+      raise Exception(f"{len(_failed)}/{len(_bases)} project(s) failed: {', '.join(_failed)}")
@@ -1,4 +1,5 @@
 from .ProcessBase import ProcessBase
+from ..exe import AnnapuRNA
 
 class Rescoring(ProcessBase):
   def __init__(self, *args, **kwargs):
@@ -10,7 +11,10 @@ class Rescoring(ProcessBase):
     kwargs_copied = kwargs.copy()
     self.utility.update_attributes(self, kwargs)
 
-    if isinstance(self.path_base, (list, set, tuple)):
+    if self.concurrent_projects():
+      self.run_projects(AnnapuRNA, "rescoring_AnnapuRNA", kwargs_copied)
+
+    elif isinstance(self.path_base, (list, set, tuple)):
       for _base in self.path_base:
         kwargs_copied["path_base"] = _base
         self.annapurna.rescoring_AnnapuRNA(**kwargs_copied)
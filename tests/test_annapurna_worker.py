@@ -0,0 +1,117 @@
+import os as OS
+import sys as SYS
+
+import pandas as PD
+import pytest
+
+from sieveai.exe import AnnapuRNA
+
+# Records module loads and calls, the behaviour of a request is chosen by its complex id
+_STUB = """
+import os, sys, argparse
+with open(os.path.join(os.path.dirname(__file__), "loads.txt"), "a") as _fh:
+  _fh.write("load\\n")
+_CALLS = []
+
+def main():
+  _parser = argparse.ArgumentParser()
+  _parser.add_argument("-r")
+  _parser.add_argument("-l")
+  _parser.add_argument("-m", action="append", default=[])
+  _parser.add_argument("-o")
+  _parser.add_argument("-s", action="store_true")
+  _parser.add_argument("--overwrite", action="store_true")
+  _args = _parser.parse_args()
+  _complex_id = os.path.basename(_args.o)
+  _CALLS.append(_complex_id)
+  print("printed by annapurna")
+
+  if _complex_id == "raises":
+    raise ValueError("bad pose")
+  if _complex_id == "exits":
+    sys.exit(2)
+  if _complex_id == "crashes":
+    os._exit(1)
+  with open(f"{_args.o}.calls", "w") as _fh:
+    _fh.write(f"{os.getpid()} {len(_CALLS)}")
+"""
+
+@pytest.fixture
+def annapurna(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  _script = tmp_path / "annapurna.py"
+  _script.write_text(_STUB)
+  for _complex_id in ["c1", "c2", "c3", "raises", "exits", "crashes"]:
+    (tmp_path / _complex_id).mkdir()
+  return AnnapuRNA(path_base=[str(tmp_path)], annapurna_env=None, annapurna_path=str(_script), dir_rescoring=str(tmp_path),
+    path_receptor_pdbqt=str(tmp_path), path_docking=str(tmp_path), annapurna_startup_timeout=30, annapurna_timeout=30, metrics_enabled=False)
+
+def _calls(_path, _complex_id):
+  _pid, _calls = (_path / _complex_id / f"{_complex_id}.calls").read_text().split()
+  return int(_pid), int(_calls)
+
+def test_requests_reuse_the_loaded_module(annapurna, tmp_path):
+  _worker = annapurna.annapurna_worker_start(0)
+  try:
+    for _complex_id in ["c1", "c2"]:
+      _response = annapurna.annapurna_worker_run(_worker, _complex_id, "rec")
+      assert _response["id"] == _complex_id and _response["status"] == "done" and _response["message"] is None
+
+    assert annapurna.annapurna_worker_run(_worker, "raises", "rec")["status"] == "failed"
+    assert annapurna.annapurna_worker_run(_worker, "exits", "rec")["message"] == "Exited with 2."
+    assert annapurna.annapurna_worker_run(_worker, "c3", "rec")["status"] == "done"
+  finally:
+    annapurna.annapurna_worker_stop(_worker)
+
+  # One process and one module load served every request
+  assert (tmp_path / "loads.txt").read_text().count("load") == 1
+  assert {_calls(tmp_path, _c)[0] for _c in ["c1", "c2", "c3"]} == {_worker["process"].pid}
+  assert _calls(tmp_path, "c3")[1] == 5
+
+def test_crashed_worker_is_restarted(annapurna, tmp_path):
+  _worker = annapurna.annapurna_worker_start(0)
+  with pytest.raises(OSError, match="exited unexpectedly"):
+    annapurna.annapurna_worker_run(_worker, "crashes", "rec")
+  annapurna.annapurna_worker_stop(_worker)
+  assert _worker["process"].returncode == 1
+
+  _worker = annapurna.annapurna_worker_start(0)
+  try:
+    assert annapurna.annapurna_worker_run(_worker, "c1", "rec")["status"] == "done"
+  finally:
+    annapurna.annapurna_worker_stop(_worker)
+  assert _calls(tmp_path, "c1") == (_worker["process"].pid, 1)
+
+def test_script_without_entry_is_run_per_request(annapurna, tmp_path):
+  annapurna.annapurna_entry = "missing"
+  _worker = annapurna.annapurna_worker_start(0)
+  try:
+    assert annapurna.annapurna_worker_run(_worker, "c1", "rec")["status"] == "done"
+  finally:
+    annapurna.annapurna_worker_stop(_worker)
+  # The script has no __main__ block, every request loads it again
+  assert (tmp_path / "loads.txt").read_text().count("load") == 2
+  assert not (tmp_path / "c1" / "c1.calls").exists()
+
+def test_unexpected_error_marks_the_complex_failed(annapurna, tmp_path, monkeypatch):
+  annapurna.path_base = str(tmp_path)
+  annapurna.annapurna_models = ["kNN_modern"]
+  _run = annapurna.annapurna_worker_run
+  def _worker_run(_worker, _complex_id, _receptor):
+    if _complex_id == "c2":
+      raise KeyError("status")
+    _response = _run(_worker, _complex_id, _receptor)
+    (tmp_path / _complex_id / f"{_complex_id}.kNN_modern.csv").write_text("")
+    return _response
+  monkeypatch.setattr(annapurna, "annapurna_worker_run", _worker_run)
+
+  annapurna._AnnapuRNA__rescoring_pool(PD.DataFrame({"complex_id": ["c1", "c2", "c3"], "receptor": ["rec"] * 3}))
+
+  assert annapurna.ledger_connect().execute("SELECT item, status, message FROM job_ledger WHERE stage = 'rescoring_annapurna' ORDER BY item").fetchall() == \
+    [("c1", "done", None), ("c2", "failed", "KeyError: 'status'"), ("c3", "done", None)]
+
+def test_python_of_the_configured_environment(annapurna):
+  assert annapurna.annapurna_python() == [SYS.executable]
+  annapurna.annapurna_env = "rna"
+  assert annapurna.annapurna_python() == ["conda", "run", "-n", "rna", "--no-capture-output", "python"]
+  assert annapurna.annapurna_worker_command()[:6] == annapurna.annapurna_python()
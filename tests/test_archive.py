@@ -0,0 +1,89 @@
+import os as OS
+import zipfile as ZIPFILE
+
+import pytest
+from UtilityLib import UtilityManager
+
+from sieveai.lib import Archive
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  return Archive(path_base=str(tmp_path), utility=UtilityManager(), metrics_enabled=False, archive_shards=4)
+
+def _write(_dir, _files):
+  _dir.mkdir(exist_ok=True)
+  for _name, _text in _files.items():
+    (_dir / _name).write_text(_text)
+
+def test_packed_files_are_read_in_place(archive, tmp_path):
+  _dir = tmp_path / "analysis"
+  _files = {f"c{_i}.hbonds.txt": f"hbonds {_i}\n" * 50 for _i in range(20)}
+  _write(_dir, {**_files, "c0.cxc": "open c0"})
+
+  assert archive.archive_pack(str(_dir), (".hbonds.txt",)) == 20
+  assert sorted(OS.listdir(_dir)) == ["c0.cxc"]
+  assert archive.archive_names(str(_dir), ".hbonds.txt") == {f"c{_i}" for _i in range(20)}
+  for _name, _text in _files.items():
+    assert archive.archive_exists(str(_dir / _name))
+    assert archive.archive_read(str(_dir / _name)) == _text
+  assert not archive.archive_exists(str(_dir / "missing.hbonds.txt"))
+  assert archive.archive_read(str(_dir / "missing.hbonds.txt")) is None
+
+def test_file_packed_again_replaces_its_stale_member(archive, tmp_path):
+  _dir = tmp_path / "analysis"
+  _write(_dir, {"a.txt": "first", "b.txt": "kept"})
+  assert archive.archive_pack(str(_dir)) == 2
+
+  # Same size, other content: a size check alone would delete it as already archived
+  _write(_dir, {"a.txt": "again"})
+  assert archive.archive_pack(str(_dir)) == 1
+  assert archive.archive_read(str(_dir / "a.txt")) == "again"
+  assert archive.archive_read(str(_dir / "b.txt")) == "kept"
+
+  _shards = [_f for _f in OS.listdir(tmp_path / "analysis.archive") if _f.endswith(".zip")]
+  _names = [_name for _shard in _shards for _name in ZIPFILE.ZipFile(tmp_path / "analysis.archive" / _shard).namelist()]
+  assert sorted(_names) == ["a.txt", "b.txt"]
+
+def test_identical_file_packed_again_is_removed(archive, tmp_path):
+  _dir = tmp_path / "analysis"
+  _write(_dir, {"a.txt": "same"})
+  archive.archive_pack(str(_dir))
+  _shard = next((tmp_path / "analysis.archive").glob("shard-*.zip"))
+  _mtime = _shard.stat().st_mtime_ns
+
+  _write(_dir, {"a.txt": "same"})
+  assert archive.archive_pack(str(_dir)) == 1
+  assert not (_dir / "a.txt").exists()
+  assert _shard.stat().st_mtime_ns == _mtime
+
+def test_crash_while_appending_keeps_the_shard_and_the_files(archive, tmp_path, monkeypatch):
+  # A single shard so that the files are appended to the shard of a.txt
+  archive.archive_shards = 1
+  _dir = tmp_path / "analysis"
+  _write(_dir, {"a.txt": "first"})
+  archive.archive_pack(str(_dir))
+  _shard = tmp_path / "analysis.archive" / "shard-000.zip"
+  _before = _shard.read_bytes()
+
+  # The second file fails half way
+  _write(_dir, {"b.txt": "second", "c.txt": "third"})
+  _zip_write = ZIPFILE.ZipFile.write
+  _calls = []
+  def _crash(_zip, _file_path, *args, **kwargs):
+    _calls.append(_file_path)
+    if len(_calls) == 2:
+      raise OSError("disk full")
+    return _zip_write(_zip, _file_path, *args, **kwargs)
+  monkeypatch.setattr(ZIPFILE.ZipFile, "write", _crash)
+
+  with pytest.raises(OSError):
+    archive.archive_pack(str(_dir))
+  assert _shard.read_bytes() == _before
+  assert archive.archive_read(str(_dir / "a.txt")) == "first"
+  assert sorted(OS.listdir(_dir)) == ["b.txt", "c.txt"]
+
+  monkeypatch.setattr(ZIPFILE.ZipFile, "write", _zip_write)
+  assert archive.archive_pack(str(_dir)) == 2
+  assert [archive.archive_read(str(_dir / _name)) for _name in ["a.txt", "b.txt", "c.txt"]] == ["first", "second", "third"]
+  assert not list((tmp_path / "analysis.archive").glob("*.tmp"))
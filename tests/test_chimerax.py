@@ -0,0 +1,75 @@
+import os as OS
+import stat as STAT
+
+import pytest
+
+from sieveai.lib import ChimeraX
+
+_STUBS = OS.path.join(OS.path.dirname(OS.path.dirname(OS.path.abspath(__file__))), "benchmarks", "stubs")
+
+def _script(_path, _body):
+  _path.write_text(f"#!/bin/sh\n{_body}\n")
+  _path.chmod(_path.stat().st_mode | STAT.S_IXUSR)
+  return str(_path)
+
+def _chimerax(_path, **kwargs):
+  return ChimeraX(path_base=str(_path), metrics_enabled=False, **kwargs)
+
+def test_session_runs_commands(tmp_path):
+  _cx = _chimerax(tmp_path, chimerax_bin=OS.path.join(_STUBS, "chimerax"), chimerax_startup_timeout=30)
+  _session = _cx.chimerax_session_start()
+  try:
+    assert _cx.chimerax_session_alive(_session)
+    assert isinstance(_cx.chimerax_session_run(_session, ["version", "# comment"]), str)
+  finally:
+    _cx.chimerax_session_stop(_session)
+  assert not _cx.chimerax_session_alive(_session)
+
+def test_session_exiting_on_start_raises_oserror(tmp_path):
+  _cx = _chimerax(tmp_path, chimerax_bin=_script(tmp_path / "chimerax", "exit 3"), chimerax_startup_timeout=5)
+  with pytest.raises(OSError, match="exited with 3"):
+    _cx.chimerax_session_start()
+
+def test_session_start_timeout_raises_timeout_error(tmp_path):
+  # Keeps running without serving the remote control, closing stdin stops it
+  _cx = _chimerax(tmp_path, chimerax_bin=_script(tmp_path / "chimerax", "cat > /dev/null"), chimerax_startup_timeout=1)
+  with pytest.raises(TimeoutError):
+    _cx.chimerax_session_start()
+
+_DATA = OS.path.join(OS.path.dirname(OS.path.abspath(__file__)), "data")
+
+def test_contacts_log_is_parsed(tmp_path):
+  _columns = _chimerax(tmp_path).chimerax_parse_log(OS.path.join(_DATA, "receptor--ligand--1.contacts.txt"), "contacts")
+  assert list(_columns["atom1__resname"]) == ["SER", "THR", "HIS", "GLY"]
+  assert list(_columns["atom1__resid"]) == [45, 46, 47, 112]
+  assert list(_columns["atom1__chain"]) == ["A", "A", "A", "B"]
+  assert list(_columns["atom2__model_id"]) == [2] * 4 and list(_columns["atom2__sub_model_id"]) == [1] * 4
+  assert list(_columns["atom2__atom"]) == ["O1", "C3", "N2", "C5"]
+  assert list(_columns["overlap"]) == [0.012, -0.214, -0.101, -0.35]
+  assert list(_columns["distance"]) == [2.888, 3.694, 3.301, 3.83]
+
+def test_hbonds_log_is_parsed_without_unprotonated_donors(tmp_path):
+  _columns = _chimerax(tmp_path).chimerax_parse_log(OS.path.join(_DATA, "receptor--ligand--1.hbonds.txt"), "hbonds")
+  assert list(_columns["donor__resname"]) == ["ARG", "UNL"]
+  assert list(_columns["acceptor__resname"]) == ["UNL", "ASP"]
+  assert list(_columns["hydrogen__atom"]) == ["HH12", "H1"]
+  assert list(_columns["da_distance"]) == [2.912, 3.01]
+  assert list(_columns["dha_distance"]) == [1.935, 2.05]
+
+def test_single_model_and_empty_logs(tmp_path):
+  _cx = _chimerax(tmp_path)
+  _log = tmp_path / "single.contacts.txt"
+  _log.write_text("1 contacts\n atom1 atom2 overlap distance\n/A TYR 7A OH   /B UNL 1 O3   -0.2   3.1\n")
+  _columns = _cx.chimerax_parse_log(str(_log), "contacts")
+  assert list(_columns["atom1__model_id"]) == [1] and list(_columns["atom1__resid"]) == ["7A"]
+
+  _log.write_text("0 contacts\n atom1 atom2 overlap distance\n")
+  assert not len(_cx.chimerax_parse_log(str(_log), "contacts")["overlap"])
+  assert _cx.chimerax_parse_log(str(tmp_path / "missing.contacts.txt"), "contacts") is None
+
+def test_logs_are_summarised_per_pose(tmp_path):
+  _cx = _chimerax(tmp_path, chimerax_parse_workers=1)
+  _summaries = list(_cx.chimerax_summarise_complexes([("receptor", "ligand", [1])], _DATA, ext_contacts="contacts.txt", ext_hbonds="hbonds.txt"))
+  [(_complex, [(_contacts, _hbonds)])] = _summaries
+  assert _contacts == ["SER:45", "THR:46", "HIS:47", "GLY:112"]
+  assert _hbonds == ["ARG:12", "UNL:1"]
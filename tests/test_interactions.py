@@ -0,0 +1,70 @@
+import os as OS
+import importlib as IMPORTLIB
+
+import numpy as NP
+import pytest
+
+from sieveai.lib import Interactions
+from sieveai.lib.Interactions import _CellList, _KDTree, _ckdtree
+
+_DATA = OS.path.join(OS.path.dirname(OS.path.abspath(__file__)), "data")
+_RECEPTOR = OS.path.join(_DATA, "fixture.pdbqt")
+_POSES = OS.path.join(_DATA, "fixture--pose.result.pdbqt")
+
+INTERACTIONS = IMPORTLIB.import_module("sieveai.lib.Interactions")
+
+def _interactions(_path, **kwargs):
+  return Interactions(path_base=str(_path), metrics_enabled=False, chimerax_parse_workers=1, **kwargs)
+
+def _analyse(_engine):
+  _poses = _engine.interactions_analyse_complex(_RECEPTOR, _POSES)
+  return {_conformer: {"contacts_count": len(_pose["contacts"]), "hbonds_count": len(_pose["hbonds"]),
+    "contacts": sorted(_pose["contacts"]), "hbonds": sorted(_pose["hbonds"])} for _conformer, _pose in _poses.items()}
+
+def test_numpy_backend_agrees_with_chimerax_on_the_fixture(tmp_path):
+  """Contacting residues and H-bond donors of both poses, one per atom pair, equal those of the ChimeraX logs"""
+  _engine = _interactions(tmp_path)
+  _numpy = _analyse(_engine)
+  [(_complex, _chimerax)] = list(_engine.chimerax_summarise_complexes([("fixture", "pose", [1, 2])], _DATA,
+    ext_contacts="contacts.txt", ext_hbonds="hbonds.txt"))
+
+  assert _numpy == {_conformer: {"contacts_count": len(_contacts), "hbonds_count": len(_hbonds), "contacts": sorted(_contacts), "hbonds": sorted(_hbonds)}
+    for _conformer, (_contacts, _hbonds) in zip([1, 2], _chimerax)}
+
+  # Atoms of SER 10 and ASP 20 in H-bonds make no contacts, as with `contacts (#1 & ~hbonds)`
+  assert _numpy[1] == {"contacts_count": 2, "hbonds_count": 2, "contacts": ["ALA:50", "LEU:30"], "hbonds": ["SER:10", "UNL:1"]}
+  assert _numpy[2] == {"contacts_count": 0, "hbonds_count": 0, "contacts": [], "hbonds": []}
+
+def test_cell_list_fallback_gives_the_same_interactions(tmp_path, monkeypatch):
+  _kdtree = _analyse(_interactions(tmp_path))
+  monkeypatch.setattr(INTERACTIONS, "_ckdtree", lambda: None)
+  _engine = _interactions(tmp_path)
+  assert isinstance(_engine.interactions_load_receptor(_RECEPTOR)["index"], _CellList)
+  assert _analyse(_engine) == _kdtree
+
+def test_hbonds_need_the_donor_angle(tmp_path):
+  _engine = _interactions(tmp_path, interactions_hbond_angle=181)
+  _poses = _engine.interactions_analyse_complex(_RECEPTOR, _POSES)
+  assert _poses[1]["hbonds"] == []
+  # The donor and acceptor atoms then make contacts
+  assert sorted(_poses[1]["contacts"]) == ["ALA:50", "ASP:20", "ASP:20", "LEU:30", "SER:10", "SER:10"]
+
+def test_receptor_index_is_built_once(tmp_path):
+  _engine = _interactions(tmp_path)
+  _receptor = _engine.interactions_load_receptor(_RECEPTOR)
+  assert _engine.interactions_load_receptor(_RECEPTOR) is _receptor
+  assert _receptor["donor_h"].tolist() == [[3, 4]]
+  assert NP.flatnonzero(_receptor["acceptor"]).tolist() == [3, 7]
+
+def _brute_force(_coords, _points, _cutoff):
+  _distance = NP.linalg.norm(_points[:, None, :] - _coords[None, :, :], axis=2)
+  return sorted(zip(*NP.nonzero(_distance <= _cutoff)))
+
+@pytest.mark.parametrize("_index_class", [_CellList, pytest.param(_KDTree, marks=pytest.mark.skipif(_ckdtree() is None, reason="scipy is not installed"))])
+def test_spatial_index_finds_all_pairs(_index_class):
+  _random = NP.random.default_rng(3)
+  _coords = _random.uniform(-15, 15, (800, 3))
+  _points = _random.uniform(-18, 18, (200, 3))
+  _index = _index_class(_coords, 4.0)
+  _query, _found = _index.pairs(_points, 4.0)
+  assert sorted(zip(_query.tolist(), _found.tolist())) == _brute_force(_coords, _points, 4.0)
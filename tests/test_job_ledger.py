@@ -0,0 +1,46 @@
+from sieveai.lib import JobLedger
+
+_STAGE = "perform_docking"
+
+def _ledger(_path, **kwargs):
+  return JobLedger(path_base=str(_path), metrics_enabled=False, **kwargs)
+
+def _row(_ledger_, _item, _columns="status, attempts, exit_code, started, finished, duration, message"):
+  return _ledger_.ledger_connect().execute(f"SELECT {_columns} FROM job_ledger WHERE stage = ? AND item = ?", (_STAGE, _item)).fetchone()
+
+def test_items_and_counts_by_status(tmp_path):
+  _ledger_ = _ledger(tmp_path)
+  assert _ledger_.ledger_mark(_STAGE, ["r1--l1", "r1--l2", "r2--l1"], "done") == 3
+  assert _ledger_.ledger_mark(_STAGE, "r2--l2", "failed", message="no output") == 1
+  assert _ledger_.ledger_mark(_STAGE, [], "done") == 0
+
+  assert _ledger_.ledger_items(_STAGE) == {"r1--l1", "r1--l2", "r2--l1"}
+  assert _ledger_.ledger_items(_STAGE, ["done", "failed"]) == {"r1--l1", "r1--l2", "r2--l1", "r2--l2"}
+  assert _ledger_.ledger_items("prepare_receptor") == set()
+  assert _ledger_.ledger_count(_STAGE) == {"done": 3, "failed": 1}
+
+def test_prefix_selects_items_of_one_receptor(tmp_path):
+  _ledger_ = _ledger(tmp_path)
+  _ledger_.ledger_mark(_STAGE, ["r1--l1", "r1--l2", "r10--l1", "r2--l1"], "done")
+  assert _ledger_.ledger_items(_STAGE, prefix="r1--") == {"r1--l1", "r1--l2"}
+  assert _ledger_.ledger_items(_STAGE, prefix="r1") == {"r1--l1", "r1--l2", "r10--l1"}
+
+def test_attempts_and_timing_of_reruns(tmp_path):
+  _ledger_ = _ledger(tmp_path)
+  _ledger_.ledger_mark(_STAGE, "c1", "running")
+  _ledger_.ledger_mark(_STAGE, "c1", "failed", exit_code=1, message="crashed")
+  _status, _attempts, _exit_code, _started, _finished, _duration, _message = _row(_ledger_, "c1")
+  assert (_status, _attempts, _exit_code, _message) == ("failed", 1, 1, "crashed")
+  assert _finished >= _started and _duration == _finished - _started
+
+  _ledger_.ledger_mark(_STAGE, "c1", "running")
+  _ledger_.ledger_mark(_STAGE, "c1", "done", exit_code=0, duration=2.5)
+  assert _row(_ledger_, "c1")[:3] == ("done", 2, 0)
+  assert _row(_ledger_, "c1", "duration, message") == (2.5, None)
+
+def test_ledger_persists_across_connections(tmp_path):
+  _ledger(tmp_path).ledger_mark(_STAGE, "c1", "done")
+  _other = _ledger(tmp_path)
+  assert _other.ledger_items(_STAGE) == {"c1"}
+  _other.ledger_close()
+  assert _other.ledger_count(_STAGE) == {"done": 1}
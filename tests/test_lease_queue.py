@@ -0,0 +1,236 @@
+import os as OS
+import sys as SYS
+import time as TIME
+import signal as SIGNAL
+import sqlite3 as SQLITE
+import threading as THREADING
+import contextlib as CONTEXTLIB
+import subprocess as SUBPROCESS
+
+import pytest
+
+from sieveai.lib import LeaseQueue
+
+_STAGE = "perform_docking"
+
+def _worker(_path, **kwargs):
+  return LeaseQueue(path_base=str(_path), metrics_enabled=False, **kwargs)
+
+@pytest.fixture
+def workers(tmp_path):
+  """Two owners of one project database with short leases"""
+  _workers = [_worker(tmp_path, queue_lease=0.2), _worker(tmp_path, queue_lease=0.2)]
+  yield _workers
+  for _w in _workers:
+    _w.queue_heartbeat_stop()
+
+def test_owners_never_claim_the_same_item(tmp_path):
+  _a, _b = _worker(tmp_path), _worker(tmp_path)
+  assert _a.queue_owner != _b.queue_owner
+  _a.queue_submit(_STAGE, ((f"c{_i}", [_i]) for _i in range(200)))
+
+  _claimed = {_a.queue_owner: [], _b.queue_owner: []}
+  def _drain(_w):
+    while True:
+      _items = _w.queue_claim(_STAGE, 3)
+      if not _items:
+        return
+      for _item, _payload in _items:
+        _claimed[_w.queue_owner].append(_item)
+        assert _w.queue_complete(_STAGE, _item, "done")
+
+  _threads = [THREADING.Thread(target=_drain, args=(_w,)) for _w in (_a, _b)]
+  for _t in _threads:
+    _t.start()
+  for _t in _threads:
+    _t.join()
+
+  _all = _claimed[_a.queue_owner] + _claimed[_b.queue_owner]
+  assert sorted(_all) == sorted(f"c{_i}" for _i in range(200))
+  assert _a.queue_count(_STAGE) == {"done": 200}
+
+def test_expired_lease_is_taken_over(workers):
+  _a, _b = workers
+  _a.queue_submit(_STAGE, [("c1", [1])])
+  assert _a.queue_claim(_STAGE) == [("c1", [1])]
+  assert _b.queue_claim(_STAGE) == []
+
+  TIME.sleep(0.3)
+  assert _b.queue_claim(_STAGE) == [("c1", [1])]
+
+  # The first owner lost its lease, its outputs are not published and the item is committed once
+  _published = []
+  assert not _a.queue_complete(_STAGE, "c1", "done", publish=lambda: _published.append("a"))
+  assert _b.queue_complete(_STAGE, "c1", "done", publish=lambda: _published.append("b"))
+  assert _published == ["b"]
+  assert _a.queue_count(_STAGE) == {"done": 1}
+
+def test_heartbeat_keeps_the_lease(workers):
+  _a, _b = workers
+  _a.queue_heartbeat = 0.05
+  _a.queue_submit(_STAGE, [("c1", None)])
+  assert _a.queue_claim(_STAGE)
+
+  _a.queue_heartbeat_start()
+  TIME.sleep(0.5)
+  assert _b.queue_claim(_STAGE) == []
+  _a.queue_heartbeat_stop()
+
+  TIME.sleep(0.3)
+  assert _b.queue_claim(_STAGE) == [("c1", None)]
+
+def test_item_fails_after_max_attempts(workers):
+  _a, _b = workers
+  _b.queue_max_attempts = 2
+  _a.queue_submit(_STAGE, [("c1", None)])
+  assert _a.queue_claim(_STAGE)
+  TIME.sleep(0.3)
+  assert _b.queue_claim(_STAGE)
+  TIME.sleep(0.3)
+
+  assert _b.queue_claim(_STAGE) == []
+  assert _b.queue_count(_STAGE) == {"failed": 1}
+
+def test_crash_between_claim_and_complete(tmp_path):
+  _a = _worker(tmp_path, queue_lease=0.2)
+  _a.queue_submit(_STAGE, [("c1", None), ("c2", None)])
+  assert len(_a.queue_claim(_STAGE, 2)) == 2
+
+  # Crash while publishing, the item must stay leased and not be committed
+  def _crash():
+    raise OSError("disk full")
+  with pytest.raises(OSError):
+    _a.queue_complete(_STAGE, "c1", "done", publish=_crash)
+  assert _a.queue_count(_STAGE) == {"leased": 2}
+
+  # The worker dies without releasing its leases
+  _a.queue_connect().close()
+  del _a
+
+  _b = _worker(tmp_path, queue_lease=0.2)
+  assert _b.queue_claim(_STAGE, 2) == []
+  TIME.sleep(0.3)
+  assert sorted(_i for _i, _p in _b.queue_claim(_STAGE, 2)) == ["c1", "c2"]
+  assert _b.queue_complete(_STAGE, "c1", "done") and _b.queue_complete(_STAGE, "c2", "failed")
+
+def test_release_returns_items_without_an_attempt(workers):
+  _a, _b = workers
+  _a.queue_submit(_STAGE, [("c1", None)])
+  assert _a.queue_claim(_STAGE)
+  assert _a.queue_release() == 1
+  assert _b.queue_claim(_STAGE) == [("c1", None)]
+  _attempts = _b.queue_connect().execute("SELECT attempts FROM work_queue WHERE item = 'c1'").fetchone()[0]
+  assert _attempts == 1
+
+def test_submit_requeues_items_not_done_in_the_ledger(workers):
+  _a, _b = workers
+  _a.queue_submit(_STAGE, [("lost", None), ("failed", None), ("kept", None)])
+  assert len(_a.queue_claim(_STAGE, 3)) == 3
+  for _item, _status in (("lost", "done"), ("failed", "failed"), ("kept", "done")):
+    assert _a.queue_complete(_STAGE, _item, _status)
+
+  # Only "kept" reached the ledger, "lost" was committed to the queue by a worker which crashed before
+  _a.ledger_mark(_STAGE, "kept", "done")
+  _a.ledger_mark(_STAGE, "failed", "failed")
+
+  assert _b.queue_submit(_STAGE, [("lost", None), ("failed", None), ("kept", None)]) == 2
+  assert _b.queue_count(_STAGE) == {"pending": 2, "done": 1}
+  assert sorted(_i for _i, _p in _b.queue_claim(_STAGE, 5)) == ["failed", "lost"]
+
+def _journal(_path):
+  return SQLITE.connect(str(_path / "SieveAI.db")).execute("PRAGMA journal_mode").fetchone()[0].upper()
+
+def test_queue_uses_the_delete_journal(tmp_path):
+  _a = _worker(tmp_path, queue_enabled=True)
+  _a.queue_submit(_STAGE, [("c1", None)])
+  assert _journal(tmp_path) == "DELETE"
+
+def test_ledger_alone_uses_the_wal_journal(tmp_path):
+  _a = _worker(tmp_path)
+  _a.ledger_mark(_STAGE, "c1", "done")
+  assert _journal(tmp_path) == "WAL"
+
+_ROOT = OS.path.dirname(OS.path.dirname(OS.path.abspath(__file__)))
+
+# Docking stage of one node of the project given as the first argument, started as submitter or worker
+_NODE = """
+import sys as SYS
+from sieveai.exe import Vina
+_settings = {"metrics_enabled": False, "queue_lease": 2, "queue_heartbeat": 0.5, "queue_poll_interval": 0.2, SYS.argv[2]: True}
+_vina = Vina(path_base=[SYS.argv[1]], **_settings)
+_vina.add(path_base=SYS.argv[1], **_settings)
+_vina.perform_docking()
+"""
+
+def _project(_path, _receptors, _ligands):
+  for _dir in ["receptor-pdbqt", "receptor-config", "ligand-pdbqt", "bin"]:
+    (_path / _dir).mkdir()
+  for _rec in _receptors:
+    (_path / "receptor-pdbqt" / f"{_rec}.pdbqt").write_text("ATOM      1  OG  SER A  10       0.000   0.000   0.000  1.00  0.00    -0.398 OA\n")
+    (_path / "receptor-config" / f"{_rec}.config").write_text("center_x = 0\ncenter_y = 0\ncenter_z = 0\nsize_x = 20\nsize_y = 20\nsize_z = 20\n")
+  for _lig in _ligands:
+    (_path / "ligand-pdbqt" / f"{_lig}.pdbqt").write_text("HETATM    1  O1  UNL     1       2.850   0.000   0.000  1.00  0.00    -0.393 OA\n")
+
+  # Vina of the benchmarks recording its completed runs
+  _vina = _path / "bin" / "vina"
+  _vina.write_text(f'#!/bin/sh\n"{_ROOT}/benchmarks/stubs/vina" "$@" || exit $?\necho "$*" >> "{_path}/calls.log"\n')
+  _vina.chmod(0o755)
+
+def _node(_path, _role, **kwargs):
+  _env = {**OS.environ, "PATH": f"{_path / 'bin'}{OS.pathsep}{OS.environ['PATH']}", "PYTHONPATH": _ROOT, **kwargs.get("env", {})}
+  return SUBPROCESS.Popen([SYS.executable, "-c", _NODE, str(_path), _role], cwd=str(_path), env=_env,
+    stdout=SUBPROCESS.DEVNULL, stderr=SUBPROCESS.DEVNULL, start_new_session=True)
+
+def _leased(_path):
+  try:
+    with CONTEXTLIB.closing(SQLITE.connect(str(_path / "SieveAI.db"), timeout=30)) as _connection:
+      return _connection.execute("SELECT item, owner FROM work_queue WHERE status = 'leased'").fetchall()
+  except SQLITE.OperationalError:
+    return []
+
+def test_worker_processes_dock_each_complex_once(tmp_path):
+  _receptors, _ligands = ["r1", "r2"], [f"l{_i}" for _i in range(1, 7)]
+  _complexes = {f"{_r}--{_l}" for _r in _receptors for _l in _ligands}
+  _project(tmp_path, _receptors, _ligands)
+
+  # The submitting node hangs in its first Vina run and is killed holding the lease
+  _submitter = _node(tmp_path, "queue_enabled", env={"SIEVEAI_STUB_LATENCY_VINA": "600"})
+  _deadline = TIME.time() + 60
+  while not _leased(tmp_path) and TIME.time() < _deadline:
+    TIME.sleep(0.1)
+  _lost = _leased(tmp_path)
+  OS.killpg(_submitter.pid, SIGNAL.SIGKILL)
+  _submitter.wait()
+  assert len(_lost) == 1
+
+  _workers = [_node(tmp_path, "queue_worker") for _ in range(3)]
+  assert [_worker.wait(timeout=120) for _worker in _workers] == [0, 0, 0]
+
+  # Every complex was docked by one completed Vina run and committed once
+  with open(tmp_path / "calls.log") as _fh:
+    _docked = [OS.path.basename(_line.split("--out ")[1].split()[0]).split(".")[0] for _line in _fh]
+  assert sorted(_docked) == sorted(_complexes)
+
+  with CONTEXTLIB.closing(SQLITE.connect(str(tmp_path / "SieveAI.db"))) as _connection:
+    _queue = {_row[0]: _row[1:] for _row in _connection.execute("SELECT item, status, owner, attempts FROM work_queue")}
+    _ledger = dict(_connection.execute("SELECT item, status FROM job_ledger WHERE stage = 'perform_docking'").fetchall())
+
+  assert _ledger == {_comp: "done" for _comp in _complexes}
+  assert {_status for _status, _owner, _attempts in _queue.values()} == {"done"}
+
+  # The lease of the killed node was taken over by a worker
+  _item, _owner = _lost[0]
+  assert _queue[_item][1] != _owner and _queue[_item][2] == 2
+  assert sorted(OS.listdir(tmp_path / "docking")) == sorted(f"{_comp}.result.{_ext}" for _comp in _complexes for _ext in ("pdbqt", "log"))
+
+def test_queue_and_ledger_use_the_configured_database(tmp_path):
+  (tmp_path / "shared").mkdir()
+  _db_path = str(tmp_path / "shared" / "campaign.db")
+  _queue = _worker(tmp_path, db_path=_db_path)
+  _queue.queue_submit(_STAGE, [("c1", [1])])
+  _queue.ledger_mark(_STAGE, "c1", "done")
+
+  assert not (tmp_path / "SieveAI.db").exists()
+  with CONTEXTLIB.closing(SQLITE.connect(_db_path)) as _connection:
+    assert _connection.execute("SELECT item FROM work_queue").fetchall() == [("c1",)]
+    assert _connection.execute("SELECT item, status FROM job_ledger").fetchall() == [("c1", "done")]
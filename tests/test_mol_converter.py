@@ -0,0 +1,53 @@
+import gzip as GZIP
+
+import pytest
+from UtilityLib import UtilityManager
+
+from sieveai.lib import MolConverter
+
+_MOLECULE = "{name}\n  test\n\n  1  0  0  0  0  0  0  0  0  0999 V2000\n    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0\nM  END\n$$$$\n"
+
+@pytest.fixture
+def converter(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  return MolConverter(path_base=str(tmp_path), utility=UtilityManager(), metrics_enabled=False)
+
+def test_library_index_of_plain_and_gzipped_sdf(converter, tmp_path):
+  _text = "".join(_MOLECULE.format(name=_name) for _name in ["a", "b", "b", ""])
+  (tmp_path / "lib.sdf").write_text(_text)
+  with GZIP.open(tmp_path / "lib2.sdf.gz", "wt") as _fh:
+    _fh.write(_text)
+
+  for _path in [tmp_path / "lib.sdf", tmp_path / "lib2.sdf.gz"]:
+    _index = converter.mol_library_index(str(_path))
+    assert _index["format"] == "sdf" and _index["count"] == 4
+    # Repeated and missing names fall back to the library name and serial number
+    _stem = _path.name.split(".")[0]
+    assert _index["names"] == ["a", "b", f"{_stem}_3", f"{_stem}_4"]
+    assert b"".join(_content for _name, _content in converter.mol_library_iter(_index)).decode() == _text
+    assert [_name for _name, _content in converter.mol_library_iter(_index, names={"b"})] == ["b"]
+
+def test_sdf_is_split_from_its_index(converter, tmp_path):
+  (tmp_path / "lib.sdf").write_text(_MOLECULE.format(name="a") + _MOLECULE.format(name="b"))
+  (tmp_path / "one.sdf").write_text(_MOLECULE.format(name="one"))
+
+  _split = converter.mol_split_multimodel(str(tmp_path / "lib.sdf"))
+  assert _split == [str(tmp_path / "a.sdf"), str(tmp_path / "b.sdf")]
+  assert (tmp_path / "b.sdf").read_text() == _MOLECULE.format(name="b")
+  assert converter.mol_validate_sdf(str(tmp_path / "one.sdf")) == [str(tmp_path / "one.sdf")]
+
+def _models(_count):
+  return "".join(f"MODEL {_m}\nATOM      1  C1  UNL     1       0.000   0.000   0.000  1.00  0.00           C\nENDMDL\n" for _m in range(1, _count + 1))
+
+def test_names_are_unique_across_libraries(converter, tmp_path):
+  (tmp_path / "a.sdf").write_text("".join(_MOLECULE.format(name=_name) for _name in ["lig1", "lig2"]))
+  (tmp_path / "b.sdf").write_text("".join(_MOLECULE.format(name=_name) for _name in ["lig1", "lig3", "lig4"]))
+  (tmp_path / "models.pdb").write_text(_models(2))
+
+  _indexes = [converter.mol_library_index(str(tmp_path / _name)) for _name in ["a.sdf", "b.sdf", "models.pdb"]]
+  # Models are named after their library
+  assert _indexes[2]["names"] == ["models_1", "models_2"]
+
+  _unique = converter.mol_library_unique(_indexes, {"lig4", "b_lig4"})
+  assert [_index["names"] for _index in _unique] == [["lig1", "lig2"], ["b_lig1", "lig3", "b_lig4_2"], ["models_1", "models_2"]]
+  assert [_name for _name, _content in converter.mol_library_iter(_unique[1], names={"b_lig1"})] == ["b_lig1"]
@@ -0,0 +1,39 @@
+import numpy as NP
+import pandas as PD
+
+from sieveai.lib import Ranking
+
+def _interactions(_receptors, _ligands, _seed):
+  _random = NP.random.default_rng(_seed)
+  _rows = []
+  for _rec in _receptors:
+    for _lig in _ligands:
+      for _conformer in range(1, 4):
+        _rows.append({"receptor": _rec, "ligand": _lig, "conformer_id": _conformer,
+          "conformer_score": float(_random.integers(-12, -5)),
+          "contacts_count": int(_random.integers(0, 6)), "hbonds_count": int(_random.integers(0, 3))})
+  _df = PD.DataFrame(_rows)
+  # Missing values are ranked at the attribute mean
+  _df.loc[_df.index[::7], "hbonds_count"] = NP.nan
+  return _df
+
+def test_streamed_ranks_equal_in_memory_ranks(tmp_path):
+  _ranking = Ranking(path_base=str(tmp_path), metrics_enabled=False, sink_format="csv")
+  _ligands = [f"l{_i}" for _i in range(6)]
+  _ranking.sink_append("interactions", _interactions(["r1", "r2"], _ligands[:4], 1))
+  _ranking.sink_append("interactions", _interactions(["r3"], _ligands, 2))
+  # Complexes of the first part appended again by an interrupted run
+  _ranking.sink_append("interactions", _interactions(["r1"], _ligands[:4], 1))
+
+  _table = _ranking.sink_read("interactions")
+  assert _table.shape[0] == (2 * 4 + 6) * 3
+  _scored = _ranking.ranking_score(_table)
+  _top = _ranking.ranking_top(_scored, ["receptor", "ligand"], k=1)
+
+  _streamed_top, _streamed = _ranking.ranking_stream("interactions", by=["receptor", "ligand"], k=1, head=_table.shape[0])
+  _columns = ["receptor", "ligand", "conformer_id", "ranking_score", *_ranking.ranking_columns()]
+  PD.testing.assert_frame_equal(_streamed[_columns], _scored[_columns], check_dtype=False)
+
+  _key = ["receptor", "ligand"]
+  PD.testing.assert_frame_equal(_streamed_top.sort_values(_key)[_columns].reset_index(drop=True),
+    _top.sort_values(_key)[_columns].reset_index(drop=True), check_dtype=False)
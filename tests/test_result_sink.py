@@ -0,0 +1,50 @@
+import pandas as PD
+
+from sieveai.lib import ResultSink
+
+def _rows(_complexes, _poses=3, _score=-7.0):
+  _data = {"receptor": [], "ligand": [], "conformer_id": [], "conformer_score": []}
+  for _rec, _lig in _complexes:
+    for _conformer in range(1, _poses + 1):
+      _data["receptor"].append(_rec)
+      _data["ligand"].append(_lig)
+      _data["conformer_id"].append(_conformer)
+      _data["conformer_score"].append(_score - _conformer)
+  return _data
+
+def _sink(_path, **kwargs):
+  return ResultSink(path_base=str(_path), metrics_enabled=False, sink_format="csv", **kwargs)
+
+def test_parts_are_read_in_append_order(tmp_path):
+  _sink_ = _sink(tmp_path)
+  assert not _sink_.sink_exists("scores")
+  _sink_.sink_append("scores", _rows([("r1", "l1")]))
+  _sink_.sink_append("scores", _rows([("r1", "l2")]))
+
+  _read = _sink_.sink_read("scores")
+  assert _read["ligand"].tolist() == ["l1"] * 3 + ["l2"] * 3
+  assert _sink_.sink_read("scores", columns=["ligand"]).columns.tolist() == ["ligand"]
+  assert _sink_.sink_append("scores", _rows([])) is None
+
+def test_complexes_appended_again_after_a_crash_are_read_once(tmp_path):
+  _sink_ = _sink(tmp_path)
+  # The part of r1--l2 was written but its ledger mark was lost, the next run appends it again
+  _sink_.sink_append("interactions", _rows([("r1", "l1"), ("r1", "l2")]))
+  _sink_.sink_append("interactions", _rows([("r1", "l2"), ("r2", "l1")], _score=-9.0))
+
+  _read = _sink_.sink_read("interactions")
+  assert _read.shape[0] == 9
+  assert not _read.duplicated(subset=["receptor", "ligand", "conformer_id"]).any()
+  assert _read.loc[_read["ligand"] == "l2", "conformer_score"].tolist() == [-8.0, -9.0, -10.0]
+  assert _sink_.sink_read("interactions", unique=[]).shape[0] == 12
+
+  _csv = tmp_path / "results.csv"
+  assert _sink_.sink_export_csv("interactions", str(_csv)) == 9
+  PD.testing.assert_frame_equal(PD.read_csv(_csv), _read)
+
+def test_reset_removes_the_table(tmp_path):
+  _sink_ = _sink(tmp_path)
+  _sink_.sink_append("scores", _rows([("r1", "l1")]))
+  _sink_.sink_reset("scores")
+  assert not _sink_.sink_exists("scores")
+  assert _sink_.sink_read("scores").empty
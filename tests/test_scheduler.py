@@ -0,0 +1,65 @@
+import os as OS
+import time as TIME
+import signal as SIGNAL
+import threading as THREADING
+
+import pytest
+from UtilityLib import UtilityManager
+
+from sieveai.lib import Scheduler
+
+@pytest.fixture
+def scheduler(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  _scheduler = Scheduler(path_base=str(tmp_path), utility=UtilityManager(), metrics_enabled=False,
+    scheduler_cores=4, scheduler_cpu_max=1, scheduler_max_load=1000, scheduler_job_memory=0, scheduler_poll_interval=0.05)
+  _scheduler.scheduler_budget = _scheduler.scheduler_budget_new(4)
+  return _scheduler
+
+def _task(_name, _seconds):
+  return {"name": _name, "command": lambda _cpu: ["sh", "-c", f"echo $$ >> pids; exec sleep {_seconds}"]}
+
+def _alive(_pid):
+  try:
+    OS.kill(_pid, 0)
+  except ProcessLookupError:
+    return False
+  return True
+
+def _started(_path):
+  return [int(_pid) for _pid in (_path / "pids").read_text().split()]
+
+def test_failing_callback_stops_the_running_jobs(scheduler, tmp_path):
+  def _callback(_task, _returncode, _duration):
+    raise RuntimeError("callback failed")
+
+  _start = TIME.time()
+  with pytest.raises(RuntimeError, match="callback failed"):
+    scheduler.scheduler_run([_task("short", 0), *[_task(f"long{_i}", 60) for _i in range(3)]], callback=_callback)
+
+  assert TIME.time() - _start < 30
+  assert len(_started(tmp_path)) == 4
+  assert not any(_alive(_pid) for _pid in _started(tmp_path))
+  assert scheduler.scheduler_budget["free"] == 4
+
+def test_sigterm_stops_the_running_jobs(scheduler, tmp_path):
+  _timer = THREADING.Timer(1, OS.kill, args=(OS.getpid(), SIGNAL.SIGTERM))
+  _timer.start()
+  _previous = SIGNAL.getsignal(SIGNAL.SIGTERM)
+  with pytest.raises(SystemExit):
+    scheduler.scheduler_run([_task(f"long{_i}", 60) for _i in range(2)])
+
+  assert SIGNAL.getsignal(SIGNAL.SIGTERM) == _previous
+  assert not any(_alive(_pid) for _pid in _started(tmp_path))
+  assert scheduler.scheduler_budget["free"] == 4
+
+def test_jobs_ignoring_terminate_are_killed(scheduler, tmp_path):
+  scheduler.scheduler_stop_timeout = 0.5
+  _stubborn = {"name": "stubborn", "command": lambda _cpu: ["sh", "-c", "trap '' TERM; echo $$ >> pids; while :; do sleep 0.1; done"]}
+  _timer = THREADING.Timer(1, OS.kill, args=(OS.getpid(), SIGNAL.SIGINT))
+  _timer.start()
+  with pytest.raises(KeyboardInterrupt):
+    scheduler.scheduler_run([_stubborn])
+
+  assert not any(_alive(_pid) for _pid in _started(tmp_path))
+  assert scheduler.scheduler_budget["free"] == 4
@@ -0,0 +1,200 @@
+import os as OS
+import types as TYPES
+
+from sieveai.exe import Vina
+
+_STUBS = OS.path.join(OS.path.dirname(OS.path.dirname(OS.path.abspath(__file__))), "benchmarks", "stubs")
+
+def _vina(_path, **kwargs):
+  _vina_ = Vina(path_base=[str(_path)], metrics_enabled=False, **kwargs)
+  _vina_.add(path_base=str(_path), metrics_enabled=False, **kwargs)
+  return _vina_
+
+def test_receptor_failing_before_preparation_is_marked_failed(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  (tmp_path / "receptor").mkdir()
+  (tmp_path / "receptor" / "broken.pdb").write_bytes(b"ATOM      1  N   SER A   1    \xff\xfe\n")
+
+  _vina_ = _vina(tmp_path, receptor_workers=1)
+  _vina_.prepare_receptor()
+
+  assert _vina_.ledger_count("prepare_receptor") == {"failed": 1}
+  _message = _vina_.ledger_connect().execute("SELECT message FROM job_ledger WHERE item = 'broken'").fetchone()[0]
+  assert _message.startswith("UnicodeDecodeError")
+
+def _sdf(_names):
+  return "".join(f"{_name}\n  test\n\n  2  1  0  0  0  0  0  0  0  0999 V2000\n"
+    "    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0\n"
+    "    1.5000    0.0000    0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0\n"
+    "  1  2  1  0\nM  END\n$$$$\n" for _name in _names)
+
+def test_unchanged_single_molecule_files_are_indexed_once(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv("PATH", f"{_STUBS}{OS.pathsep}{OS.environ['PATH']}")
+  (tmp_path / "ligand").mkdir()
+  (tmp_path / "ligand" / "single.sdf").write_text(_sdf(["single"]))
+  (tmp_path / "ligand" / "library.sdf").write_text(_sdf(["lig1", "lig2", "lig3"]))
+
+  _vina_ = _vina(tmp_path)
+  _indexed = []
+  _index = _vina_.mol_library_index
+  monkeypatch.setattr(_vina_, "mol_library_index", lambda _path, **kwargs: _indexed.append(OS.path.basename(_path)) or _index(_path, **kwargs))
+
+  _vina_.prepare_ligand()
+  assert sorted(_indexed) == ["library.sdf", "single.sdf"]
+  assert sorted(OS.listdir(tmp_path / "ligand-pdbqt")) == ["lig1.pdbqt", "lig2.pdbqt", "lig3.pdbqt", "single.pdbqt"]
+
+  # single.pdb converted by the first run is new to the second one
+  _indexed.clear()
+  _vina_.prepare_ligand()
+  assert sorted(_indexed) == ["library.sdf", "single.pdb"]
+
+  # Libraries are indexed from their saved index, unchanged single molecule files are not read
+  _indexed.clear()
+  _vina_.prepare_ligand()
+  assert _indexed == ["library.sdf"]
+
+  (tmp_path / "ligand" / "single.sdf").write_text(_sdf(["single", "second"]))
+  _indexed.clear()
+  _vina_.prepare_ligand()
+  assert sorted(_indexed) == ["library.sdf", "single.sdf"]
+  assert "second.pdbqt" in OS.listdir(tmp_path / "ligand-pdbqt")
+
+def test_queue_workers_only_dock(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  assert _vina(tmp_path, processes=None).run_stages()[0] == "prepare_ligand"
+  assert _vina(tmp_path, processes="perform_docking").run_stages() == ["perform_docking"]
+  assert _vina(tmp_path, processes=["prepare_grid", "perform_docking"]).run_stages() == ["prepare_grid", "perform_docking"]
+
+  # The submitting node prepares, analyses and exports the project
+  assert _vina(tmp_path, queue_worker=True, processes=None).run_stages() == ["perform_docking"]
+  assert _vina(tmp_path, queue_worker=True, processes=["prepare_grid", "perform_docking", "analyse_docking"]).run_stages() == ["perform_docking"]
+
+def test_molecules_of_two_libraries_sharing_names_are_all_prepared(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv("PATH", f"{_STUBS}{OS.pathsep}{OS.environ['PATH']}")
+  _model = "MODEL {0}\nATOM      1  C1  UNL     1       {0}.000   0.000   0.000  1.00  0.00           C\nENDMDL\n"
+  (tmp_path / "ligand").mkdir()
+  (tmp_path / "ligand" / "first.sdf").write_text(_sdf(["lig1", "lig2"]))
+  (tmp_path / "ligand" / "second.sdf").write_text(_sdf(["lig1", "lig3"]))
+  (tmp_path / "ligand" / "screen1.pdb").write_text(_model.format(1) + _model.format(2))
+  (tmp_path / "ligand" / "screen2.pdb").write_text(_model.format(1) + _model.format(2))
+
+  _vina_ = _vina(tmp_path)
+  _vina_.prepare_ligand()
+  _prepared = sorted(OS.listdir(tmp_path / "ligand-pdbqt"))
+  assert _prepared == sorted(f"{_name}.pdbqt" for _name in ["lig1", "lig2", "second_lig1", "lig3", "screen1_1", "screen1_2", "screen2_1", "screen2_2"])
+
+  # Renamed molecules keep their names and are not converted again
+  _vina_.prepare_ligand()
+  assert sorted(OS.listdir(tmp_path / "ligand-pdbqt")) == _prepared
+  assert _vina_.ledger_count("prepare_ligand") == {"done": 8}
+
+def test_library_molecules_are_restored_from_the_cache(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv("PATH", f"{_STUBS}{OS.pathsep}{OS.environ['PATH']}")
+  _projects = [tmp_path / "first", tmp_path / "second"]
+  for _project in _projects:
+    (_project / "ligand").mkdir(parents=True)
+    (_project / "ligand" / "library.sdf").write_text(_sdf(["lig1", "lig2", "lig3"]))
+
+  _first = _vina(_projects[0], cache_dir=str(tmp_path / "cache"))
+  _first.prepare_ligand()
+
+  _second = _vina(_projects[1], cache_dir=str(tmp_path / "cache"))
+  _converted = []
+  _convert = _second.openbabel_convert_batch
+  monkeypatch.setattr(_second, "openbabel_convert_batch", lambda _records, *args, **kwargs: _convert([_converted.append(_r) or _r for _r in _records], *args, **kwargs))
+  _second.prepare_ligand()
+
+  assert _converted == []
+  assert sorted(OS.listdir(_projects[1] / "ligand-pdbqt")) == ["lig1.pdbqt", "lig2.pdbqt", "lig3.pdbqt"]
+  assert [(_projects[1] / "ligand-pdbqt" / _name).read_bytes() for _name in ["lig1.pdbqt", "lig3.pdbqt"]] == \
+    [(_projects[0] / "ligand-pdbqt" / _name).read_bytes() for _name in ["lig1.pdbqt", "lig3.pdbqt"]]
+  assert _second.ledger_connect().execute("SELECT status, message, COUNT(*) FROM job_ledger WHERE stage = 'prepare_ligand' GROUP BY 1, 2").fetchall() == [("done", "cache", 3)]
+
+def test_upgraded_prepare_receptor_is_not_served_from_the_cache(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  _bin = tmp_path / "bin"
+  _bin.mkdir()
+  (_bin / "prepare_receptor").write_text(f"#!/bin/sh\nexec {OS.path.join(_STUBS, 'prepare_receptor')} \"$@\"\n")
+  (_bin / "prepare_receptor").chmod(0o755)
+  monkeypatch.setenv("PATH", f"{_bin}{OS.pathsep}{_STUBS}{OS.pathsep}{OS.environ['PATH']}")
+  _atom = "ATOM      1  CA  ALA A   1       0.000   0.000   0.000  1.00  0.00           C\n"
+
+  def _prepare(_project):
+    (_project / "receptor").mkdir(parents=True)
+    (_project / "receptor" / "rec.pdb").write_text(_atom)
+    _vina_ = _vina(_project, cache_dir=str(tmp_path / "cache"), receptor_workers=1)
+    _vina_.prepare_receptor()
+    return _vina_.ledger_connect().execute("SELECT status, message = 'Restored from cache.' FROM job_ledger WHERE stage = 'prepare_receptor'").fetchall()
+
+  assert _prepare(tmp_path / "first") == [("done", 0)]
+  assert _prepare(tmp_path / "second") == [("done", 1)]
+
+  with open(_bin / "prepare_receptor", "a") as _fh:
+    _fh.write("# upgraded\n")
+  assert _prepare(tmp_path / "third") == [("done", 0)]
+
+def test_single_ligands_are_read_lazily_and_cached(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv("PATH", f"{_STUBS}{OS.pathsep}{OS.environ['PATH']}")
+  _projects = [tmp_path / "first", tmp_path / "second"]
+  for _project in _projects:
+    (_project / "ligand").mkdir(parents=True)
+    for _name in ["lig1", "lig2"]:
+      (_project / "ligand" / f"{_name}.sdf").write_text(_sdf([_name]))
+
+  _vina(_projects[0], cache_dir=str(tmp_path / "cache")).prepare_ligand()
+
+  _second = _vina(_projects[1], cache_dir=str(tmp_path / "cache"))
+  _batches = []
+  _convert = _second.openbabel_convert_batch
+  monkeypatch.setattr(_second, "openbabel_convert_batch", lambda _records, *args, **kwargs: _batches.append(_records) or _convert(_records, *args, **kwargs))
+  _second.prepare_ligand()
+
+  assert all(isinstance(_records, TYPES.GeneratorType) for _records in _batches)
+  assert sorted(OS.listdir(_projects[1] / "ligand-pdbqt")) == ["lig1.pdbqt", "lig2.pdbqt"]
+  assert _second.ledger_connect().execute("SELECT status, message, COUNT(*) FROM job_ledger WHERE stage = 'prepare_ligand' GROUP BY 1, 2").fetchall() == [("done", "cache", 2)]
+
+def test_dock_runs_through_the_scheduler(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  _vina_ = _vina(tmp_path)
+  _vina_.scheduler_budget = _vina_.scheduler_budget_new(2)
+  _jobs = []
+  _run = _vina_.scheduler_run
+  monkeypatch.setattr(_vina_, "scheduler_run", lambda *args, **kwargs: _jobs.append(kwargs.get("max_jobs")) or _run(*args, **kwargs))
+
+  assert _vina_.dock("sh -c 'echo docked'", str(tmp_path / "complex.log"))
+  assert not _vina_.dock(["sh", "-c", "exit 3"], str(tmp_path / "failed.log"))
+  assert (tmp_path / "complex.log").read_text() == "docked\n"
+  assert _jobs == [1, 1] and _vina_.scheduler_budget["free"] == 2
+
+def test_project_database_is_not_overwritten(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  _vina_ = _vina(tmp_path, db_path=str(tmp_path / "campaign.db"))
+  _vina_.ledger_mark("perform_docking", "r--l", "done")
+
+  assert _vina_.db_path == str(tmp_path / "campaign.db")
+  assert OS.path.isfile(tmp_path / "campaign.db") and not OS.path.isfile(tmp_path / "SieveAI.db")
+
+def test_grid_of_missing_residues_and_empty_receptors_is_not_written(tmp_path, monkeypatch, caplog):
+  monkeypatch.chdir(tmp_path)
+  (tmp_path / "receptor-pdbqt").mkdir()
+  (tmp_path / "receptor-pdbqt" / "empty.pdbqt").write_text("REMARK no atoms\n")
+  (tmp_path / "receptor-pdbqt" / "rec.pdbqt").write_text("".join(
+    f"ATOM  {_i:5d}  CA  {_resname} A{_resid:4d}    {_x:8.3f}{0.0:8.3f}{0.0:8.3f}  1.00  0.00     0.000 C \n"
+    for _i, (_resname, _resid, _x) in enumerate([("HIS", 45, 2.0), ("HIS", 45, 4.0), ("ALA", 50, 40.0)], 1)))
+
+  _vina_ = _vina(tmp_path, path_receptor_pdbqt=str(tmp_path / "receptor-pdbqt"), grid_residues=["45", "A:99", "TRP"])
+  _vina_.prepare_grid()
+
+  assert sorted(_f for _f in OS.listdir(tmp_path / "receptor-config") if _f.endswith(".config")) == ["rec.config"]
+  _config = (tmp_path / "receptor-config" / "rec.config").read_text()
+  assert "center_x = 3.0" in _config and "size_x = 3.0" in _config
+  assert "Residues A:99, TRP not found" in caplog.text
+  assert "No atoms found in" in caplog.text and "empty.pdbqt" in caplog.text
+
+  _vina_.grid_residues = ["A:99"]
+  _vina_.prepare_grid()
+  assert "None of the residues A:99 found" in caplog.text